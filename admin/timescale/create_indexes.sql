@@ -1,7 +1,8 @@
 BEGIN;
 
-CREATE INDEX listened_at_user_name_ndx_listen ON listen (listened_at DESC, user_name);
+CREATE INDEX user_name_listened_at_track_name_ndx_listen ON listen (user_name, listened_at DESC, track_name);
 CREATE UNIQUE INDEX listened_at_track_name_user_name_ndx_listen ON listen (listened_at DESC, track_name, user_name);
+CREATE INDEX recording_msid_ndx_listen ON listen (recording_msid);
 
 -- View indexes are created in listenbrainz/db/timescale.py
 
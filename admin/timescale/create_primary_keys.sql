@@ -1,5 +1,7 @@
 BEGIN;
 
+ALTER TABLE listen_user_day_count ADD CONSTRAINT listen_user_day_count_pkey PRIMARY KEY (user_name, day);
+ALTER TABLE listen_user_metadata ADD CONSTRAINT listen_user_metadata_pkey PRIMARY KEY (user_name);
 ALTER TABLE playlist.playlist ADD CONSTRAINT playlist_pkey PRIMARY KEY (id);
 ALTER TABLE playlist.playlist_recording ADD CONSTRAINT playlist_recording_pkey PRIMARY KEY (id);
 
@@ -5,12 +5,31 @@ CREATE TABLE listen (
         track_name      TEXT                     NOT NULL,
         user_name       TEXT                     NOT NULL,
         created         TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
-        data            JSONB                    NOT NULL
+        data            JSONB                    NOT NULL,
+        recording_msid  UUID -- the recording_msid in data, NULL until backfilled for older listens
 );
 
 -- 86400 seconds * 5 = 432000 seconds = 5 days
 SELECT create_hypertable('listen', 'listened_at', chunk_time_interval => 432000);
 
+-- The number of listens of each user on each day, maintained by the listen store as listens are
+-- inserted and deleted. Used to find the time range holding the listens of a fetch.
+CREATE TABLE listen_user_day_count (
+        user_name       TEXT                     NOT NULL,
+        day             BIGINT                   NOT NULL, -- listened_at of the start of the day
+        count           INTEGER                  NOT NULL
+);
+
+-- The number of listens of each user and the listened_at of their first and last listen (NULL if
+-- they have none), maintained by the listen store in the transactions which insert and delete
+-- listens. The listen counts and timestamps cached in redis are read from here.
+CREATE TABLE listen_user_metadata (
+        user_name       TEXT                     NOT NULL,
+        count           BIGINT                   NOT NULL,
+        min_listened_at BIGINT,
+        max_listened_at BIGINT
+);
+
 -- Playlists
 
 CREATE TABLE playlist.playlist (
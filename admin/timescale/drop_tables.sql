@@ -1,5 +1,7 @@
 BEGIN;
 
 DROP TABLE IF EXISTS listen CASCADE;
+DROP TABLE IF EXISTS listen_user_day_count CASCADE;
+DROP TABLE IF EXISTS listen_user_metadata CASCADE;
 
 COMMIT;
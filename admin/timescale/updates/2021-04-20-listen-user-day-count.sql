@@ -0,0 +1,19 @@
+-- Stop the timescale writers before running this and restart them with the code which maintains
+-- listen_user_day_count afterwards, so that no listens are inserted while the counts are filled in.
+
+BEGIN;
+
+CREATE TABLE listen_user_day_count (
+        user_name       TEXT                     NOT NULL,
+        day             BIGINT                   NOT NULL, -- listened_at of the start of the day
+        count           INTEGER                  NOT NULL
+);
+
+INSERT INTO listen_user_day_count (user_name, day, count)
+     SELECT user_name, listened_at - listened_at % 86400 AS day, count(*)
+       FROM listen
+   GROUP BY user_name, day;
+
+ALTER TABLE listen_user_day_count ADD CONSTRAINT listen_user_day_count_pkey PRIMARY KEY (user_name, day);
+
+COMMIT;
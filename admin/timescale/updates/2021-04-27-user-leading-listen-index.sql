@@ -0,0 +1,13 @@
+-- Index the listens of each user in the order in which they are fetched, so that the queries of the
+-- listens of a user read a few index entries in each chunk instead of every listen of the chunk.
+-- Queries by time alone use listened_at_track_name_user_name_ndx_listen, which makes
+-- listened_at_user_name_ndx_listen redundant.
+--
+-- The index of each chunk is built in a transaction of its own, so that inserts into a chunk are
+-- only blocked while that chunk is indexed. Because of that this file cannot be run in a transaction,
+-- run it with psql without --single-transaction.
+
+CREATE INDEX user_name_listened_at_track_name_ndx_listen ON listen (user_name, listened_at DESC, track_name)
+       WITH (timescaledb.transaction_per_chunk);
+
+DROP INDEX listened_at_user_name_ndx_listen;
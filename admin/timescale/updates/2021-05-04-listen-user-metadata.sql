@@ -0,0 +1,19 @@
+-- Stop the timescale writers before running this and restart them with the code which maintains
+-- listen_user_metadata afterwards, so that no listens are inserted while the counts are filled in.
+-- The counts are taken from listen_user_day_count, see 2021-04-20-listen-user-day-count.sql.
+
+BEGIN;
+
+CREATE TABLE listen_user_metadata (
+        user_name       TEXT                     NOT NULL,
+        count           BIGINT                   NOT NULL
+);
+
+INSERT INTO listen_user_metadata (user_name, count)
+     SELECT user_name, sum(count)
+       FROM listen_user_day_count
+   GROUP BY user_name;
+
+ALTER TABLE listen_user_metadata ADD CONSTRAINT listen_user_metadata_pkey PRIMARY KEY (user_name);
+
+COMMIT;
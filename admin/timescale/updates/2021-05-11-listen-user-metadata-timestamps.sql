@@ -0,0 +1,15 @@
+-- Stop the timescale writers before running this and restart them with the code which maintains
+-- the timestamps in listen_user_metadata afterwards, so that no listens are inserted while the
+-- timestamps are filled in. Users without listens keep NULL timestamps.
+
+BEGIN;
+
+ALTER TABLE listen_user_metadata ADD COLUMN min_listened_at BIGINT;
+ALTER TABLE listen_user_metadata ADD COLUMN max_listened_at BIGINT;
+
+UPDATE listen_user_metadata
+   SET min_listened_at = (SELECT min(listened_at) FROM listen WHERE listen.user_name = listen_user_metadata.user_name),
+       max_listened_at = (SELECT max(listened_at) FROM listen WHERE listen.user_name = listen_user_metadata.user_name)
+ WHERE count > 0;
+
+COMMIT;
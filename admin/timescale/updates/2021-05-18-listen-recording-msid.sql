@@ -0,0 +1,16 @@
+-- Store the recording_msid of each listen in a column of its own, so that the queries which filter or
+-- join on it can use an index instead of reading it from data. Adding the nullable column does not
+-- rewrite the chunks.
+--
+-- The index of each chunk is built in a transaction of its own, so that inserts into a chunk are
+-- only blocked while that chunk is indexed. Because of that this file cannot be run in a transaction,
+-- run it with psql without --single-transaction.
+--
+-- Restart the timescale writers with the code which fills the column afterwards, then fill it in for
+-- the existing listens with `python manage.py backfill_recording_msids`, which updates the listens
+-- chunk by chunk while they are being inserted.
+
+ALTER TABLE listen ADD COLUMN recording_msid UUID;
+
+CREATE INDEX recording_msid_ndx_listen ON listen (recording_msid)
+       WITH (timescaledb.transaction_per_chunk);
@@ -0,0 +1,55 @@
+""" Sharding of the incoming listens by user, so that several timescale writers can insert listens
+in parallel while all listens of a user are inserted by the same writer, in order.
+
+With INCOMING_QUEUE_SHARDS > 1, listens are published to one of that many fanout exchanges and
+queues, named after INCOMING_EXCHANGE and INCOMING_QUEUE with the shard number appended (e.g.
+"incoming.0"), and each timescale writer consumes the queue of the shard given in its
+TIMESCALE_WRITER_SHARD environment variable. Otherwise listens go to INCOMING_EXCHANGE and
+INCOMING_QUEUE, consumed by a single writer.
+
+To move from the single queue to shards: start one writer for each shard, then set
+INCOMING_QUEUE_SHARDS and restart the producers (the API and the listen augmenter). Keep the
+unsharded writer running until INCOMING_QUEUE is empty. The shard count can be changed the
+same way, keeping the writers of the old shards until their queues are empty.
+"""
+import zlib
+
+
+def get_incoming_shard_count(config):
+    """ Return the number of incoming shards configured, 1 if the incoming queue is not sharded """
+    return max(int(config.get('INCOMING_QUEUE_SHARDS') or 1), 1)
+
+
+def get_incoming_shard(user_name, shard_count):
+    """ Return the shard of the listens of a user. The hash must be the same in all processes,
+    so Python's hash() which is randomized per process cannot be used. """
+    return zlib.crc32(user_name.encode('utf-8')) % shard_count
+
+
+def get_incoming_exchange_and_queue(config, shard=None):
+    """ Return the names of the incoming exchange and queue of a shard, or the unsharded ones
+    if shard is None. """
+    if shard is None:
+        return config['INCOMING_EXCHANGE'], config['INCOMING_QUEUE']
+    return "%s.%d" % (config['INCOMING_EXCHANGE'], shard), "%s.%d" % (config['INCOMING_QUEUE'], shard)
+
+
+def group_listens_by_incoming_shard(config, listens):
+    """ Split listens into the groups which go to the same incoming exchange.
+
+    Args:
+        config: the app config
+        listens (list): the listens to split, dicts with a user_name key
+    Returns:
+        a list of (exchange, queue, listens) tuples
+    """
+    shard_count = get_incoming_shard_count(config)
+    if shard_count == 1:
+        exchange, queue = get_incoming_exchange_and_queue(config)
+        return [(exchange, queue, listens)]
+
+    shards = {}
+    for listen in listens:
+        shards.setdefault(get_incoming_shard(listen['user_name'], shard_count), []).append(listen)
+    return [(*get_incoming_exchange_and_queue(config, shard), shard_listens)
+            for shard, shard_listens in sorted(shards.items())]
@@ -1,13 +1,20 @@
 # coding=utf-8
 import calendar
+import json
+import re
 import time
 import ujson
 import yaml
-from copy import deepcopy
 
 from datetime import datetime
+from werkzeug.http import http_date
 from listenbrainz.utils import escape
 
+# The data stored for a listen has the member track_metadata and the scalar members user_id and, for old
+# listens, dedup_tag. track_metadata is the last member both in the JSON written by Listen.to_timescale
+# and in the JSONB text of postgres, which orders the members by the length of their keys.
+STORED_DATA_PREFIX = re.compile(r'\{(?:"(?:user_id|dedup_tag)": ?(?:-?\d+|null), ?)*"track_metadata": ?')
+
 
 def flatten_dict(d, seperator='', parent_key=''):
     """
@@ -48,7 +55,16 @@ def check_listen_data_for_nulls(**kwargs):
 
 
 class Listen(object):
-    """ Represents a listen object """
+    """ Represents a listen object
+
+    Listens read from the listenstore may keep their data as the JSON stored in the
+    listenstore, which is only parsed when the data, user_id, msids or dedup_tag of the
+    listen are first accessed. The datetime of the timestamp is also only created when
+    it is first accessed.
+    """
+
+    __slots__ = ('user_name', 'ts_since_epoch', 'inserted_timestamp', '_user_id', '_artist_msid',
+                 '_release_msid', '_recording_msid', '_dedup_tag', '_data', '_timestamp', '_stored_data')
 
     # keys that we use ourselves for private usage
     PRIVATE_KEYS = (
@@ -82,31 +98,23 @@ class Listen(object):
 
     def __init__(self, user_id=None, user_name=None, timestamp=None, artist_msid=None, release_msid=None,
                  recording_msid=None, dedup_tag=0, inserted_timestamp=None, data=None):
-        self.user_id = user_id
+        self._stored_data = None
+        self._user_id = user_id
         self.user_name = user_name
 
         check_listen_data_for_nulls(user_name=user_name, artist_msid=artist_msid, release_msid=release_msid,
                                     recording_msid=recording_msid)
 
         # determine the type of timestamp and do the right thing
-        if isinstance(timestamp, int) or isinstance(timestamp, float):
-            self.ts_since_epoch = int(timestamp)
-            self.timestamp = datetime.utcfromtimestamp(self.ts_since_epoch)
-        else:
-            if timestamp:
-                self.timestamp = timestamp
-                self.ts_since_epoch = calendar.timegm(self.timestamp.utctimetuple())
-            else:
-                self.timestamp = None
-                self.ts_since_epoch = None
-
-        self.artist_msid = artist_msid
-        self.release_msid = release_msid
-        self.recording_msid = recording_msid
-        self.dedup_tag = dedup_tag
+        self._set_timestamp(timestamp)
+
+        self._artist_msid = artist_msid
+        self._release_msid = release_msid
+        self._recording_msid = recording_msid
+        self._dedup_tag = dedup_tag
         self.inserted_timestamp = inserted_timestamp
         if data is None:
-            self.data = {'additional_info': {}}
+            self._data = {'additional_info': {}}
         else:
             try:
                 flattened_data = flatten_dict(data['additional_info'])
@@ -117,7 +125,70 @@ class Listen(object):
                 # to data sometimes. If that occurs, we don't need to do anything.
                 pass
 
-            self.data = data
+            self._data = data
+
+    def _set_timestamp(self, timestamp):
+        """ Set the timestamp from a unix timestamp or a datetime. The datetime of a unix
+        timestamp is created when it is first accessed. """
+        if isinstance(timestamp, int) or isinstance(timestamp, float):
+            self.ts_since_epoch = int(timestamp)
+            self._timestamp = None
+        elif timestamp:
+            self._timestamp = timestamp
+            self.ts_since_epoch = calendar.timegm(timestamp.utctimetuple())
+        else:
+            self._timestamp = None
+            self.ts_since_epoch = None
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self.ts_since_epoch is not None:
+            self._timestamp = datetime.utcfromtimestamp(self.ts_since_epoch)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
+
+    def _load_stored_data(self):
+        """ Parse the JSON of a listen read from the listenstore, see from_timescale """
+        track_name, stored_data = self._stored_data
+        self._stored_data = None
+
+        j = ujson.loads(stored_data)
+        track_metadata = j['track_metadata']
+        track_metadata['track_name'] = track_name
+        additional_info = track_metadata['additional_info']
+        self._user_id = j.get('user_id')
+        self._artist_msid = additional_info.get('artist_msid')
+        self._release_msid = additional_info.get('release_msid')
+        self._recording_msid = additional_info.get('recording_msid')
+        self._dedup_tag = j.get('dedup_tag', 0)
+        self._data = track_metadata
+
+    def _stored_property(name):
+        """ Make a property for a field which is set by _load_stored_data """
+        attribute = '_' + name
+
+        def getter(self):
+            if self._stored_data is not None:
+                self._load_stored_data()
+            return getattr(self, attribute)
+
+        def setter(self, value):
+            if self._stored_data is not None:
+                self._load_stored_data()
+            setattr(self, attribute, value)
+
+        return property(getter, setter)
+
+    user_id = _stored_property('user_id')
+    artist_msid = _stored_property('artist_msid')
+    release_msid = _stored_property('release_msid')
+    recording_msid = _stored_property('recording_msid')
+    dedup_tag = _stored_property('dedup_tag')
+    data = _stored_property('data')
+    del _stored_property
 
     @classmethod
     def from_json(cls, j):
@@ -147,22 +218,34 @@ class Listen(object):
         )
 
     @classmethod
-    def from_timescale(cls, listened_at, track_name, user_name, created, j):
-        """Factory to make Listen() objects from a timescale dict"""
+    def from_timescale(cls, listened_at, track_name, user_name, created, j, recording_msid=None):
+        """Factory to make Listen() objects from a timescale row.
 
-        j['listened_at'] = datetime.utcfromtimestamp(float(listened_at))
-        j['track_metadata']['track_name'] = track_name
-        return cls(
-            user_id=j.get('user_id'),
-            user_name=user_name,
-            timestamp=j['listened_at'],
-            artist_msid=j['track_metadata']['additional_info'].get('artist_msid'),
-            release_msid=j['track_metadata']['additional_info'].get('release_msid'),
-            recording_msid=j['track_metadata']['additional_info'].get('recording_msid'),
-            dedup_tag=j.get('dedup_tag', 0),
-            inserted_timestamp=created,
-            data=j.get('track_metadata')
-        )
+        The data of the row (j) is either a dict or the JSON text of the data column, which
+        is then parsed when it is first needed. The data was flattened and checked when the
+        listen was inserted, so that isn't done again. The recording_msid column of the row, if
+        given, lets to_api_json serialize the listen without parsing the JSON text.
+        """
+        listen = cls.__new__(cls)
+        listen.user_name = user_name
+        listen.ts_since_epoch = int(float(listened_at))
+        listen._timestamp = None
+        listen.inserted_timestamp = created
+
+        if isinstance(j, (str, bytes)):
+            listen._stored_data = (track_name, j)
+            listen._recording_msid = recording_msid
+        else:
+            listen._stored_data = None
+            j['track_metadata']['track_name'] = track_name
+            additional_info = j['track_metadata']['additional_info']
+            listen._user_id = j.get('user_id')
+            listen._artist_msid = additional_info.get('artist_msid')
+            listen._release_msid = additional_info.get('release_msid')
+            listen._recording_msid = additional_info.get('recording_msid')
+            listen._dedup_tag = j.get('dedup_tag', 0)
+            listen._data = j.get('track_metadata')
+        return listen
 
     def to_api(self):
         """
@@ -173,8 +256,9 @@ class Listen(object):
             dict with fields 'track_metadata', 'listened_at' and 'recording_msid'
         """
         track_metadata = self.data.copy()
-        track_metadata['additional_info']['artist_msid'] = self.artist_msid
-        track_metadata['additional_info']['release_msid'] = self.release_msid
+        track_metadata['additional_info'] = dict(track_metadata['additional_info'],
+                                                 artist_msid=self.artist_msid,
+                                                 release_msid=self.release_msid)
 
         data = {
             'track_metadata': track_metadata,
@@ -186,6 +270,34 @@ class Listen(object):
 
         return data
 
+    def to_api_json(self):
+        """
+        Returns the JSON text of to_api, serialized like the api serializes it.
+
+        The data of a listen read from the listenstore which wasn't parsed yet is spliced into
+        the JSON as stored, with the track_name added, instead of being parsed and serialized
+        again. Its additional_info already holds the msids which to_api sets, see to_timescale.
+        """
+        inserted_at = self.inserted_timestamp or 0
+        if isinstance(inserted_at, datetime):
+            inserted_at = http_date(inserted_at.utctimetuple())
+
+        track_metadata = None
+        if self._stored_data is not None and self._recording_msid is not None:
+            track_metadata = _stored_track_metadata_json(*self._stored_data)
+        if track_metadata is None:
+            data = self.to_api()
+            data['inserted_at'] = inserted_at
+            return json.dumps(data, separators=(',', ':'))
+
+        fields = json.dumps({
+            'listened_at': self.ts_since_epoch,
+            'recording_msid': self._recording_msid,
+            'user_name': self.user_name,
+            'inserted_at': inserted_at,
+        }, separators=(',', ':'))
+        return '{"track_metadata":' + track_metadata + ',' + fields[1:]
+
     def to_json(self):
         return {
             'user_id': self.user_id,
@@ -196,16 +308,17 @@ class Listen(object):
         }
 
     def to_timescale(self):
-        track_metadata = deepcopy(self.data)
-        track_metadata['additional_info']['artist_msid'] = self.artist_msid
-        track_metadata['additional_info']['release_msid'] = self.release_msid
-        track_metadata['additional_info']['recording_msid'] = self.recording_msid
-        track_name = track_metadata['track_name']
-        del track_metadata['track_name']
+        # only the dicts which are changed are copied, the values are shared with self.data
+        track_metadata = self.data.copy()
+        track_metadata['additional_info'] = dict(track_metadata['additional_info'],
+                                                 artist_msid=self.artist_msid,
+                                                 release_msid=self.release_msid,
+                                                 recording_msid=self.recording_msid)
+        track_name = track_metadata.pop('track_name')
         return (self.ts_since_epoch, track_name, self.user_name, ujson.dumps({
             'user_id': self.user_id,
             'track_metadata': track_metadata
-        }))
+        }), self.recording_msid)
 
 
     def validate(self):
@@ -218,13 +331,58 @@ class Listen(object):
 
     def __repr__(self):
         from pprint import pformat
-        return pformat(vars(self))
+        return pformat({
+            'user_id': self.user_id,
+            'user_name': self.user_name,
+            'timestamp': self.timestamp,
+            'ts_since_epoch': self.ts_since_epoch,
+            'artist_msid': self.artist_msid,
+            'release_msid': self.release_msid,
+            'recording_msid': self.recording_msid,
+            'dedup_tag': self.dedup_tag,
+            'inserted_timestamp': self.inserted_timestamp,
+            'data': self.data,
+        })
 
     def __unicode__(self):
         return "<Listen: user_name: %s, time: %s, artist_msid: %s, release_msid: %s, recording_msid: %s, artist_name: %s, track_name: %s>" % \
                (self.user_name, self.ts_since_epoch, self.artist_msid, self.release_msid, self.recording_msid, self.data['artist_name'], self.data['track_name'])
 
 
+def _stored_track_metadata_json(track_name, stored_data):
+    """ Return the JSON text of the track_metadata of a listen with its track_name, taken from the JSON
+    text of its stored data without parsing it, or None if the stored data doesn't have the layout
+    described at STORED_DATA_PREFIX. """
+    if isinstance(stored_data, bytes):
+        stored_data = stored_data.decode('utf-8')
+
+    match = STORED_DATA_PREFIX.match(stored_data)
+    if match is None or not stored_data.endswith('}}'):
+        return None
+
+    track_metadata = stored_data[match.end():-1]
+    separator = ',' if track_metadata[1:-1].strip() else ''
+    # the track_name is the last member, so that it takes precedence over a track_name in the stored
+    # data like it does in _load_stored_data
+    return track_metadata[:-1] + separator + '"track_name":' + json.dumps(track_name) + '}'
+
+
+def listens_to_timescale_rows(listens):
+    """ Convert listens in the format submitted to the API into the rows inserted into the
+    listen table, see Listen.to_timescale. The listens are not modified.
+
+    Listens which cannot be stored, because they contain null characters, are skipped.
+    """
+    rows = []
+    for listen in listens:
+        try:
+            listen = dict(listen, track_metadata=dict(listen['track_metadata']))
+            rows.append(Listen.from_json(listen).to_timescale())
+        except ValueError:
+            pass
+    return rows
+
+
 def convert_dump_row_to_spark_row(row):
     data = {
         'listened_at': str(datetime.utcfromtimestamp(row['timestamp'])),
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import traceback
+from time import sleep, monotonic
+
+import pika
+from flask import current_app
+
+from listenbrainz import listen_codec
+from listenbrainz.incoming_shards import group_listens_by_incoming_shard, get_incoming_shard_count, \
+    get_incoming_exchange_and_queue
+from listenbrainz.listen import listens_to_timescale_rows
+from listenbrainz.listen_writer import ListenWriter
+from listenbrainz.webserver import create_app
+from listenbrainz.webserver.errors import APIBadRequest
+from listenbrainz.webserver.views.api_tools import get_augmented_listens
+from brainzutils import metrics
+
+METRIC_UPDATE_INTERVAL = 60  # seconds
+
+# Listens from different messages (and hence users) are looked up in MessyBrainz together.
+# A batch is processed once it holds this many listens or its first message arrived BATCH_TIMEOUT ago.
+BATCH_SIZE = 1000  # listens
+BATCH_TIMEOUT = 1  # seconds
+PREFETCH_COUNT = 200  # messages
+
+
+class ListenAugmenter(ListenWriter):
+    """ Consumes the raw listens submitted with deferred augmentation, looks up their
+    MessyBrainz ids in large batches and forwards them to the incoming exchange. """
+
+    def __init__(self):
+        super().__init__()
+
+        self.raw_ch = None
+        self.incoming_ch = None
+
+        # list of (delivery_tag, properties, body, listens) of the messages in the current batch
+        self.messages = []
+        self.listen_count = 0
+        self.batch_start_time = None
+
+        self.augmented_listens = 0
+        self.dropped_listens = 0
+        self.metric_submission_time = monotonic() + METRIC_UPDATE_INTERVAL
+
+    def add_message(self, method, properties, body):
+        """ Add a message to the current batch and process the batch if it is full or old enough. """
+        if not self.messages:
+            self.batch_start_time = monotonic()
+        listens = listen_codec.decode(body, properties)
+        self.messages.append((method.delivery_tag, properties, body, listens))
+        self.listen_count += len(listens)
+        if self.listen_count >= BATCH_SIZE or monotonic() - self.batch_start_time >= BATCH_TIMEOUT:
+            self.process_batch()
+
+    def process_batch(self):
+        """ Augment all listens of the current batch, publish them to the incoming exchange
+        and ack all messages of the batch at once. On MessyBrainz errors the messages are
+        requeued so that they are retried later. """
+        if not self.messages:
+            return
+
+        last_delivery_tag = self.messages[-1][0]
+        try:
+            augmented = self.augment(self.messages)
+        except Exception as e:
+            current_app.logger.error("Cannot augment listens: %s. Sleep." % str(e), exc_info=True)
+            self.raw_ch.basic_nack(delivery_tag=last_delivery_tag, multiple=True, requeue=True)
+            self.messages = []
+            self.listen_count = 0
+            sleep(self.ERROR_RETRY_DELAY)
+            return
+
+        # if the connection is closed while publishing, the consumer loop reconnects and the
+        # unacked messages of the batch are redelivered
+        if augmented:
+            for exchange, _, listens in group_listens_by_incoming_shard(current_app.config, augmented):
+                rows = listens_to_timescale_rows(listens)
+                if not rows:
+                    continue
+                body, properties = listen_codec.encode(rows, current_app.config.get('LISTEN_MESSAGE_CODEC', listen_codec.JSON_CODEC))
+                properties.type = listen_codec.TIMESCALE_ROWS_MESSAGE_TYPE
+                self.incoming_ch.basic_publish(
+                    exchange=exchange,
+                    routing_key='',
+                    body=body,
+                    properties=properties,
+                )
+
+        self.raw_ch.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+        self.messages = []
+        self.listen_count = 0
+
+        self.augmented_listens += len(augmented)
+        if monotonic() > self.metric_submission_time:
+            self.metric_submission_time += METRIC_UPDATE_INTERVAL
+            metrics.set("listen_augmenter", augmented_listens=self.augmented_listens,
+                        dropped_listens=self.dropped_listens)
+
+    def augment(self, messages):
+        """ Look up the MessyBrainz ids of the listens in the given messages.
+
+        If MessyBrainz rejects the batch, each message is looked up on its own and the
+        messages which are rejected again are dropped, the API has already accepted them
+        so there is no one to report the error to.
+
+        Args:
+            messages: list of (delivery_tag, properties, body, listens) of the raw listens messages
+        Returns:
+            the augmented listens of all messages
+        """
+        try:
+            return get_augmented_listens([listen for _, _, _, listens in messages for listen in listens])
+        except APIBadRequest:
+            pass
+
+        augmented = []
+        for _, properties, body, _ in messages:
+            # the listens of the failed lookup may have been mutated, so decode them again
+            listens = listen_codec.decode(body, properties)
+            try:
+                augmented.extend(get_augmented_listens(listens))
+            except APIBadRequest as e:
+                current_app.logger.error("MessyBrainz rejected listens: %s, dropping: %s", str(e), body)
+                self.dropped_listens += len(listens)
+        return augmented
+
+    def start(self):
+        app = create_app()
+        with app.app_context():
+            current_app.logger.info("listen-augmenter init")
+            self._verify_hosts_in_config()
+
+            try:
+                while True:
+                    self.connect_to_rabbitmq()
+                    self.raw_ch = self.connection.channel()
+                    self.raw_ch.exchange_declare(exchange=current_app.config['RAW_LISTENS_EXCHANGE'], exchange_type='fanout')
+                    self.raw_ch.queue_declare(current_app.config['RAW_LISTENS_QUEUE'], durable=True)
+                    self.raw_ch.queue_bind(exchange=current_app.config['RAW_LISTENS_EXCHANGE'],
+                                           queue=current_app.config['RAW_LISTENS_QUEUE'])
+                    self.raw_ch.basic_qos(prefetch_count=PREFETCH_COUNT)
+
+                    self.incoming_ch = self.connection.channel()
+                    shard_count = get_incoming_shard_count(current_app.config)
+                    for shard in (range(shard_count) if shard_count > 1 else [None]):
+                        exchange, queue = get_incoming_exchange_and_queue(current_app.config, shard)
+                        self.incoming_ch.exchange_declare(exchange=exchange, exchange_type='fanout')
+                        self.incoming_ch.queue_declare(queue, durable=True)
+                        self.incoming_ch.queue_bind(exchange=exchange, queue=queue)
+
+                    try:
+                        for method, properties, body in self.raw_ch.consume(current_app.config['RAW_LISTENS_QUEUE'],
+                                                                            inactivity_timeout=BATCH_TIMEOUT):
+                            if method is None:
+                                self.process_batch()
+                            else:
+                                self.add_message(method, properties, body)
+                    except pika.exceptions.ConnectionClosed:
+                        current_app.logger.warn("Connection to rabbitmq closed. Re-opening.", exc_info=True)
+                        # unacked messages are redelivered by rabbitmq on the new connection
+                        self.messages = []
+                        self.listen_count = 0
+                        self.connection = None
+                        continue
+
+                    self.connection.close()
+
+            except Exception as err:
+                traceback.print_exc()
+                current_app.logger.error("failed to start listen augmenter loop: %s", str(err))
+
+
+if __name__ == "__main__":
+    la = ListenAugmenter()
+    la.start()
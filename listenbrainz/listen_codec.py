@@ -0,0 +1,94 @@
+""" Encoding and decoding of the messages sent through the RabbitMQ listen queues.
+
+Each message carries its format in the AMQP content_type and content_encoding properties,
+so consumers can decode messages of any supported format, whichever format the producers
+are configured to use. Messages without a content type are JSON, as published before
+formats were introduced. A change to the structure of a format must use a new content type.
+
+To switch producers to a new format, first deploy consumers which can decode it and only
+then change LISTEN_MESSAGE_CODEC.
+"""
+import calendar
+import zlib
+from datetime import datetime
+
+import msgpack
+import pika
+import ujson
+
+JSON_CODEC = "json"
+MSGPACK_CODEC = "msgpack"
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/vnd.listenbrainz.v1+msgpack"
+ZLIB_CONTENT_ENCODING = "zlib"
+
+# fast compression levels are enough for the repetitive listen payloads
+ZLIB_COMPRESSION_LEVEL = 1
+
+# The AMQP type of incoming messages which carry (listened_at, track_name, user_name, data, recording_msid)
+# rows of the listen table, see Listen.to_timescale, instead of listens. Incoming messages without a type
+# carry listens, as published before the rows were rendered by the producers.
+TIMESCALE_ROWS_MESSAGE_TYPE = "timescale_rows"
+
+
+def _encode_object(obj):
+    """ Convert objects which msgpack cannot serialize like ujson does, so that the decoded
+    message has the same structure for both formats: datetimes become unix timestamps and
+    other objects (e.g. Listen) a dict of their public, non callable attributes. """
+    if isinstance(obj, datetime):
+        return calendar.timegm(obj.utctimetuple())
+
+    data = {}
+    for name in dir(obj):
+        if name.startswith("_"):
+            continue
+        value = getattr(obj, name)
+        if not callable(value):
+            data[name] = value
+    return data
+
+
+def encode(data, codec=JSON_CODEC):
+    """ Encode the data of a message in the given format.
+
+    Args:
+        data: the data to encode
+        codec (str): the name of the format, JSON_CODEC or MSGPACK_CODEC
+    Returns:
+        a tuple of the message body and the pika.BasicProperties to publish it with
+    """
+    if codec == MSGPACK_CODEC:
+        body = zlib.compress(msgpack.packb(data, use_bin_type=True, default=_encode_object), ZLIB_COMPRESSION_LEVEL)
+        properties = pika.BasicProperties(delivery_mode=2, content_type=MSGPACK_CONTENT_TYPE,
+                                          content_encoding=ZLIB_CONTENT_ENCODING)
+    elif codec == JSON_CODEC:
+        body = ujson.dumps(data)
+        properties = pika.BasicProperties(delivery_mode=2, content_type=JSON_CONTENT_TYPE)
+    else:
+        raise ValueError("Unknown listen message codec: %s" % codec)
+    return body, properties
+
+
+def decode(body, properties=None):
+    """ Decode a message body according to the content type and encoding in its properties.
+
+    Args:
+        body (bytes): the message body
+        properties (pika.BasicProperties): the properties the message was delivered with
+    Returns:
+        the decoded data
+    """
+    content_type = getattr(properties, "content_type", None)
+    content_encoding = getattr(properties, "content_encoding", None)
+
+    if content_encoding == ZLIB_CONTENT_ENCODING:
+        body = zlib.decompress(body)
+    elif content_encoding is not None:
+        raise ValueError("Unknown listen message content encoding: %s" % content_encoding)
+
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.unpackb(body, raw=False)
+    elif content_type is None or content_type == JSON_CONTENT_TYPE:
+        return ujson.loads(body)
+    raise ValueError("Unknown listen message content type: %s" % content_type)
@@ -0,0 +1,36 @@
+""" Continuation cursors for paging through the listens of a user.
+
+The listens of a user are ordered by listened_at descending, then track_name ascending, which is
+a total order as (listened_at, track_name) is unique per user. A cursor holds the position of a
+listen in that order and the direction in which to continue from it: ORDER_DESC for the older
+listens after it, ORDER_ASC for the newer listens before it. Cursors are opaque to clients.
+"""
+import base64
+import binascii
+
+import ujson
+
+from listenbrainz.listenstore import ORDER_ASC, ORDER_DESC
+
+
+def encode_listens_cursor(listen, order):
+    """ Return the cursor continuing from a listen in the given direction """
+    data = ujson.dumps([order, listen.ts_since_epoch, listen.data["track_name"]])
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_listens_cursor(cursor):
+    """ Decode a cursor returned by encode_listens_cursor.
+
+    Returns: a (listened_at, track_name, order) tuple
+    Raises: ValueError if the cursor is invalid
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        order, listened_at, track_name = ujson.loads(data.decode("utf-8"))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+    if order not in (ORDER_ASC, ORDER_DESC) or type(listened_at) is not int or not isinstance(track_name, str):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    return listened_at, track_name, order
@@ -16,9 +16,35 @@ class RedisListenStore(ListenStore):
     RECENT_LISTENS_KEY = "rl-"
     RECENT_LISTENS_MAX = 100
     PLAYING_NOW_KEY = "pn."
+    PLAYING_NOW_MSID_KEY = "pnm."
     LISTEN_COUNT_PER_DAY_EXPIRY_TIME = 3 * 24 * 60 * 60  # 3 days in seconds
     LISTEN_COUNT_PER_DAY_KEY = "lc-day-"
 
+    # Stores playing now listens and their recording msids, skipping each listen whose user's
+    # stored playing now listen already has the same recording msid. An expiry of 0 means no expiry.
+    # KEYS: for each listen, the playing now listen key and the recording msid key
+    # ARGV: for each listen, the listen JSON, the recording msid and the expiry in seconds
+    # Returns a list with 1 for each listen that was stored and 0 for the others
+    PUT_PLAYING_NOW_IF_CHANGED_SCRIPT = """
+        local stored = {}
+        for i = 1, #KEYS / 2 do
+            local listen_key, msid_key = KEYS[2 * i - 1], KEYS[2 * i]
+            local listen, msid, expiry = ARGV[3 * i - 2], ARGV[3 * i - 1], ARGV[3 * i]
+            if redis.call('GET', msid_key) == msid then
+                stored[i] = 0
+            else
+                if tonumber(expiry) > 0 then
+                    redis.call('SET', listen_key, listen, 'EX', expiry)
+                    redis.call('SET', msid_key, msid, 'EX', expiry)
+                else
+                    redis.call('SET', listen_key, listen)
+                    redis.call('SET', msid_key, msid)
+                end
+                stored[i] = 1
+            end
+        end
+        return stored
+    """
 
     def __init__(self, log, conf):
         super(RedisListenStore, self).__init__(log)
@@ -28,6 +54,7 @@ class RedisListenStore(ListenStore):
                    namespace=conf['REDIS_NAMESPACE'])
         # This is used in tests. Leave for cleanup in LB-879
         self.redis = cache._r
+        self.put_playing_now_if_changed_script = cache._r.register_script(self.PUT_PLAYING_NOW_IF_CHANGED_SCRIPT)
 
     def get_playing_now(self, user_id):
         """ Return the current playing song of the user
@@ -39,10 +66,14 @@ class RedisListenStore(ListenStore):
                 Listen object which is the currently playing song of the user
 
         """
-        data = cache.get(self.PLAYING_NOW_KEY + str(user_id))
+        data = cache.get(self.PLAYING_NOW_KEY + str(user_id), decode=False)
         if not data:
             return None
-        data = ujson.loads(data)
+        try:
+            data = ujson.loads(data)
+        except ValueError:
+            # playing now listens stored before they were saved as plain JSON, these expire soon
+            return None
         data.update({'playing_now': True})
         return Listen.from_json(data)
 
@@ -54,7 +85,42 @@ class RedisListenStore(ListenStore):
             listen (dict): the listen data
             expire_time (int): the time in seconds in which the `playing_now` listen should expire
         """
-        cache.set(self.PLAYING_NOW_KEY + str(user_id), ujson.dumps(listen).encode('utf-8'), expirein=expire_time)
+        pipe = cache._r.pipeline()
+        pipe.set(cache._prep_key(self.PLAYING_NOW_KEY + str(user_id)), ujson.dumps(listen).encode('utf-8'),
+                 ex=expire_time or None)
+        pipe.set(cache._prep_key(self.PLAYING_NOW_MSID_KEY + str(user_id)), str(listen.get('recording_msid')),
+                 ex=expire_time or None)
+        pipe.execute()
+
+    def put_playing_now_many(self, items):
+        """ Save listens as `playing_now` unless the user's current `playing_now` listen is the same
+        recording. The comparison and the update are done atomically by a script in Redis, in a
+        single round trip for all listens.
+
+        Args:
+            items: a list of (user_id, listen, expire_time) tuples, see put_playing_now
+        Returns:
+            a list of booleans, True for each listen that was saved
+        """
+        if not items:
+            return []
+
+        keys = []
+        args = []
+        for user_id, listen, expire_time in items:
+            keys.append(cache._prep_key(self.PLAYING_NOW_KEY + str(user_id)))
+            keys.append(cache._prep_key(self.PLAYING_NOW_MSID_KEY + str(user_id)))
+            args.extend([ujson.dumps(listen).encode('utf-8'), str(listen.get('recording_msid')), expire_time or 0])
+        return [bool(result) for result in self.put_playing_now_if_changed_script(keys=keys, args=args)]
+
+    def put_playing_now_if_changed(self, user_id, listen, expire_time):
+        """ Save a listen as `playing_now` unless the user's current `playing_now` listen is the same
+        recording, see put_playing_now_many.
+
+        Returns:
+            True if the listen was saved, False otherwise
+        """
+        return self.put_playing_now_many([(user_id, listen, expire_time)])[0]
 
     def check_connection(self):
         """ Pings the redis server to check if the connection works or not """
@@ -71,18 +137,21 @@ class RedisListenStore(ListenStore):
             is not a critical action, so if it fails, it fails. Let's live with it.
         """
 
+        pipe = cache._r.pipeline(transaction=False)
+        self._update_recent_listens(pipe, unique)
+        pipe.execute()
+
+    def _update_recent_listens(self, pipe, unique):
+        """ Queue the commands of update_recent_listens on a redis pipeline """
         recent = {}
         for listen in unique:
             recent[ujson.dumps(listen.to_json()).encode('utf-8')] = float(listen.ts_since_epoch)
 
         # Don't take this very seriously -- if it fails, really no big deal. Let is go.
         if recent:
-            cache._r.zadd(cache._prep_key(self.RECENT_LISTENS_KEY), recent, nx=True)
-
-            # Don't prune the sorted list each time, but only when it reaches twice the desired size 
-            count = cache._r.zcard(cache._prep_key(self.RECENT_LISTENS_KEY))
-            if count > (self.RECENT_LISTENS_MAX * 2):
-                cache._r.zpopmin(cache._prep_key(self.RECENT_LISTENS_KEY), count - self.RECENT_LISTENS_MAX - 1)
+            pipe.zadd(cache._prep_key(self.RECENT_LISTENS_KEY), recent, nx=True)
+            # Keep at most twice the desired size, so that the list doesn't need pruning on each update
+            pipe.zremrangebyrank(cache._prep_key(self.RECENT_LISTENS_KEY), 0, -(self.RECENT_LISTENS_MAX * 2) - 1)
 
 
     def get_recent_listens(self, max = RECENT_LISTENS_MAX):
@@ -99,9 +168,24 @@ class RedisListenStore(ListenStore):
         """ Increment the number of listens submitted on the day `day`
         by `count`.
         """
-        key = self.LISTEN_COUNT_PER_DAY_KEY + day.strftime('%Y%m%d')
-        cache.increment(key, amount=count)
-        cache.expire(key, self.LISTEN_COUNT_PER_DAY_EXPIRY_TIME)
+        pipe = cache._r.pipeline(transaction=False)
+        self._increment_listen_count_for_day(pipe, day, count)
+        pipe.execute()
+
+    def _increment_listen_count_for_day(self, pipe, day: datetime, count: int):
+        """ Queue the commands of increment_listen_count_for_day on a redis pipeline """
+        key = cache._prep_key(self.LISTEN_COUNT_PER_DAY_KEY + day.strftime('%Y%m%d'))
+        pipe.incrby(key, count)
+        pipe.expire(key, self.LISTEN_COUNT_PER_DAY_EXPIRY_TIME)
+
+    def update_for_inserted_listens(self, day: datetime, count: int, unique):
+        """ Increment the number of listens submitted on the day `day` by `count` and add
+        the unique listens to the recent listens, in one round trip.
+        """
+        pipe = cache._r.pipeline(transaction=False)
+        self._increment_listen_count_for_day(pipe, day, count)
+        self._update_recent_listens(pipe, unique)
+        pipe.execute()
 
     def get_listen_count_for_day(self, day: datetime) -> Optional[int]:
         """ Get the number of listens submitted for day `day`, return None if not available.
@@ -50,6 +50,46 @@ class RedisListenStoreTestCase(DatabaseTestCase):
         self.assertEqual(playing_now.data['artist_name'], 'The Strokes')
         self.assertEqual(playing_now.data['track_name'], 'Call It Fate, Call It Karma')
 
+    def _playing_now_listen(self, user, recording_msid):
+        return {
+            'user_id': user['id'],
+            'user_name': user['musicbrainz_id'],
+            'recording_msid': recording_msid,
+            'track_metadata': {
+                'artist_name': 'The Strokes',
+                'track_name': recording_msid,
+                'additional_info': {},
+            },
+        }
+
+    def test_put_playing_now_if_changed(self):
+        first = self._playing_now_listen(self.testuser, str(uuid.uuid4()))
+        self.assertTrue(self._redis.put_playing_now_if_changed(self.testuser['id'], first, config.PLAYING_NOW_MAX_DURATION))
+
+        # the same recording is not stored again
+        same = self._playing_now_listen(self.testuser, first['recording_msid'])
+        same['track_metadata']['artist_name'] = 'Julian Casablancas'
+        self.assertFalse(self._redis.put_playing_now_if_changed(self.testuser['id'], same, config.PLAYING_NOW_MAX_DURATION))
+        self.assertEqual(self._redis.get_playing_now(self.testuser['id']).data['artist_name'], 'The Strokes')
+
+        second = self._playing_now_listen(self.testuser, str(uuid.uuid4()))
+        self.assertTrue(self._redis.put_playing_now_if_changed(self.testuser['id'], second, config.PLAYING_NOW_MAX_DURATION))
+        self.assertEqual(self._redis.get_playing_now(self.testuser['id']).recording_msid, second['recording_msid'])
+
+    def test_put_playing_now_many(self):
+        other_user = db_user.get_or_create(2, "other")
+        msid = str(uuid.uuid4())
+        self._redis.put_playing_now(self.testuser['id'], self._playing_now_listen(self.testuser, msid), 0)
+
+        stored = self._redis.put_playing_now_many([
+            (self.testuser['id'], self._playing_now_listen(self.testuser, msid), config.PLAYING_NOW_MAX_DURATION),
+            (other_user['id'], self._playing_now_listen(other_user, msid), config.PLAYING_NOW_MAX_DURATION),
+            (other_user['id'], self._playing_now_listen(other_user, msid), config.PLAYING_NOW_MAX_DURATION),
+        ])
+        self.assertEqual(stored, [False, True, False])
+        self.assertEqual(self._redis.get_playing_now(other_user['id']).recording_msid, msid)
+        self.assertEqual(self._redis.put_playing_now_many([]), [])
+
 
     def test_update_and_get_recent_listens(self):
 
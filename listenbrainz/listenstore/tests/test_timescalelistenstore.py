@@ -21,8 +21,10 @@ from listenbrainz import config
 from listenbrainz.listenstore.tests.util import create_test_data_for_timescalelistenstore, generate_data
 from listenbrainz.webserver.timescale_connection import init_timescale_connection
 from listenbrainz.db.dump import SchemaMismatchException
-from listenbrainz.listenstore import LISTENS_DUMP_SCHEMA_VERSION
-from listenbrainz.listenstore.timescale_listenstore import REDIS_USER_LISTEN_COUNT, REDIS_USER_TIMESTAMPS
+from listenbrainz.listenstore import LISTENS_DUMP_SCHEMA_VERSION, ORDER_ASC, ORDER_DESC
+from listenbrainz.listenstore.timescale_listenstore import REDIS_USER_LISTEN_COUNT, REDIS_USER_TIMESTAMPS, \
+    INSERT_METHOD_VALUES, INSERT_METHOD_COPY, REDIS_USER_LATEST_LISTENS, REDIS_USER_TIMESTAMPS_LOCK, \
+    REDIS_USER_METADATA_VERSION
 from brainzutils import cache
 
 TIMESCALE_SQL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..', 'admin', 'timescale')
@@ -85,7 +87,7 @@ class TestTimescaleListenStore(DatabaseTestCase):
         for listen in listens:
             submit.append((*listen.to_timescale(), listen.inserted_timestamp))
 
-        query = """INSERT INTO listen (listened_at, track_name, user_name, data, created)
+        query = """INSERT INTO listen (listened_at, track_name, user_name, data, recording_msid, created)
                         VALUES %s
                    ON CONFLICT (listened_at, track_name, user_name)
                     DO NOTHING
@@ -121,6 +123,76 @@ class TestTimescaleListenStore(DatabaseTestCase):
         listens, min_ts, max_ts = self.logstore.fetch_listens(user_name=self.testuser_name, from_ts=1399999999)
         self.assertEqual(len(listens), count)
 
+    def _insert_with_method(self, insert_method, user_name, listens):
+        self.logstore.insert_method = insert_method
+        for listen in listens:
+            listen.user_name = user_name
+        return self.logstore.insert(listens)
+
+    def test_insert_methods_skip_the_same_duplicates(self):
+        # the second batch repeats two listens of the first batch and one of its own
+        first = generate_data(self.testuser_id, self.testuser_name, 1400000000, 5)
+        second = generate_data(self.testuser_id, self.testuser_name, 1400000003, 5)
+        second.append(generate_data(self.testuser_id, self.testuser_name, 1400000007, 1)[0])
+        second[2].data['track_name'] = 'Tab\tNew\nLine\\Back\\\\slash \\N'
+
+        inserted = {}
+        for insert_method in (INSERT_METHOD_VALUES, INSERT_METHOD_COPY):
+            user_name = "user_" + insert_method
+            self.assertEqual(len(self._insert_with_method(insert_method, user_name, first)), 5)
+            rows = self._insert_with_method(insert_method, user_name, second)
+            inserted[insert_method] = sorted((listened_at, track_name) for listened_at, track_name, _ in rows)
+
+            listens, _, _ = self.logstore.fetch_listens(user_name=user_name, from_ts=1399999999)
+            self.assertEqual(len(listens), 8)
+            self.assertIn(second[2].data['track_name'], [listen.data['track_name'] for listen in listens])
+
+        self.assertEqual(inserted[INSERT_METHOD_VALUES], inserted[INSERT_METHOD_COPY])
+        self.assertEqual(len(inserted[INSERT_METHOD_COPY]), 3)
+
+    def test_insert_methods_fill_recording_msid(self):
+        for insert_method in (INSERT_METHOD_VALUES, INSERT_METHOD_COPY):
+            user_name = "user_" + insert_method
+            listens = generate_data(self.testuser_id, user_name, 1400000000, 3)
+            self._insert_with_method(insert_method, user_name, listens)
+
+            with ts.engine.connect() as connection:
+                result = connection.execute(sqlalchemy.text("""
+                    SELECT listened_at, recording_msid::text FROM listen WHERE user_name = :user_name
+                """), user_name=user_name)
+                recording_msids = {row["listened_at"]: row["recording_msid"] for row in result}
+            self.assertEqual(recording_msids, {listen.ts_since_epoch: listen.recording_msid for listen in listens})
+
+        # rows rendered without recording_msid get it from their data
+        row = generate_data(self.testuser_id, self.testuser_name, 1400000000, 1)[0].to_timescale()
+        self.logstore.insert_rows([row[:4]])
+        with ts.engine.connect() as connection:
+            result = connection.execute(sqlalchemy.text("""
+                SELECT recording_msid::text FROM listen WHERE user_name = :user_name
+            """), user_name=self.testuser_name)
+            self.assertEqual([row["recording_msid"] for row in result], [row[4]])
+
+    def test_delete_listen_without_recording_msid_column(self):
+        listen = generate_data(self.testuser_id, self.testuser_name, 1400000000, 1)[0]
+        self.logstore.insert([listen])
+        # a listen inserted before the recording_msid column was added and backfilled
+        with ts.engine.connect() as connection:
+            connection.execute(sqlalchemy.text("UPDATE listen SET recording_msid = NULL WHERE user_name = :user_name"),
+                               user_name=self.testuser_name)
+
+        self.logstore.delete_listen(1400000000, self.testuser_name, listen.recording_msid)
+        listens, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, from_ts=1399999999)
+        self.assertEqual(listens, [])
+
+    def test_insert_methods_reject_untranslatable_characters(self):
+        for insert_method in (INSERT_METHOD_VALUES, INSERT_METHOD_COPY):
+            listens = generate_data(self.testuser_id, self.testuser_name, 1400000000, 2)
+            listens[1].data['artist_name'] = 'Frank\u0000Ocean'
+            self.assertIsNone(self._insert_with_method(insert_method, self.testuser_name, listens))
+
+        listens, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, from_ts=1399999999)
+        self.assertEqual(listens, [])
+
     def test_fetch_listens_0(self):
         self._create_test_data(self.testuser_name)
         listens, min_ts, max_ts = self.logstore.fetch_listens(user_name=self.testuser_name, from_ts=1400000000, limit=1)
@@ -193,6 +265,84 @@ class TestTimescaleListenStore(DatabaseTestCase):
         self.assertEqual(listens[2].ts_since_epoch, 1400000050)
         self.assertEqual(listens[3].ts_since_epoch, 1400000000)
 
+    def test_fetch_listens_with_gaps_and_limit(self):
+        self._create_test_data(self.testuser_name,
+                               test_data_file_name='timescale_listenstore_test_listens_over_greater_time_range.json')
+
+        with ts.engine.connect() as connection:
+            result = connection.execute(sqlalchemy.text("""
+                SELECT day, count FROM listen_user_day_count WHERE user_name = :user_name ORDER BY day
+            """), user_name=self.testuser_name)
+            self.assertEqual([tuple(row) for row in result], [(1399939200, 2), (1419984000, 2)])
+
+        # the ranges found with the day counts hold the next listens across the gap
+        listens, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, to_ts=1420000001, limit=2)
+        self.assertEqual([l.ts_since_epoch for l in listens], [1420000000, 1400000050])
+
+        listens, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, from_ts=1400000000, limit=2)
+        self.assertEqual([l.ts_since_epoch for l in listens], [1420000000, 1400000050])
+
+    def test_fetch_listens_after_cursor(self):
+        listens = generate_data(self.testuser_id, self.testuser_name, 1400000000, 4)
+        # two more listens which share a timestamp with the others
+        for listen, track_name in zip(generate_data(self.testuser_id, self.testuser_name, 1400000001, 2), ["A", "Z"]):
+            listen.data["track_name"] = track_name
+            listens.append(listen)
+        self.logstore.insert(listens)
+
+        expected = [(1400000003, "Crack Rock"), (1400000002, "Crack Rock"), (1400000002, "Z"),
+                    (1400000001, "A"), (1400000001, "Crack Rock"), (1400000000, "Crack Rock")]
+        page, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, limit=2)
+        pages = [page]
+        while pages[-1]:
+            last = pages[-1][-1]
+            pages.append(self.logstore.fetch_listens_after_cursor(self.testuser_name, last.ts_since_epoch,
+                                                                  last.data["track_name"], 2, ORDER_DESC))
+        self.assertEqual([(l.ts_since_epoch, l.data["track_name"]) for page in pages for l in page], expected)
+
+        # and back to the newer listens
+        first = pages[2][0]
+        page = self.logstore.fetch_listens_after_cursor(self.testuser_name, first.ts_since_epoch,
+                                                        first.data["track_name"], 3, ORDER_ASC)
+        self.assertEqual([(l.ts_since_epoch, l.data["track_name"]) for l in page], expected[1:4])
+
+    def test_fetch_latest_listens_from_cache(self):
+        self.logstore.latest_listens_cache_size = 3
+        self.logstore.insert(generate_data(self.testuser_id, self.testuser_name, 1400000000, 2))
+        cache_key = REDIS_USER_LATEST_LISTENS + self.testuser_name
+
+        # the first fetch reads timescale and caches all listens of the user
+        listens, _, max_ts = self.logstore.fetch_listens(user_name=self.testuser_name, limit=3)
+        self.assertEqual([l.ts_since_epoch for l in listens], [1400000001, 1400000000])
+        self.assertEqual(max_ts, 1400000001)
+        self.assertEqual(self.logstore.latest_listens_cache_misses, 1)
+        self.assertEqual(cache._r.zcard(cache._prep_key(cache_key)), 3)
+
+        # new listens are added to the cache, which keeps the latest 3 of them
+        self.logstore.insert(generate_data(self.testuser_id, self.testuser_name, 1400000002, 2))
+        self.assertEqual(cache._r.zcard(cache._prep_key(cache_key)), 3)
+        listens, _, max_ts = self.logstore.fetch_listens(user_name=self.testuser_name, limit=2)
+        self.assertEqual([l.ts_since_epoch for l in listens], [1400000003, 1400000002])
+        self.assertEqual(listens[0].data['track_name'], 'Crack Rock')
+        self.assertIsNotNone(listens[0].inserted_timestamp)
+        self.assertEqual(max_ts, 1400000003)
+        self.assertEqual(self.logstore.latest_listens_cache_hits, 1)
+
+        # a listen cached with differently serialized data by a cache miss and by its insert is returned once
+        member, score = cache._r.zrevrange(cache._prep_key(cache_key), 0, 0, withscores=True)[0]
+        row = ujson.loads(member)
+        row[4] = ujson.dumps(ujson.loads(row[4]), indent=1)
+        cache._r.zadd(cache._prep_key(cache_key), {ujson.dumps(row): score})
+        listens, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, limit=2)
+        self.assertEqual([l.ts_since_epoch for l in listens], [1400000003, 1400000002])
+
+        # deleting a listen removes the cached listens
+        self.logstore.delete_listen(1400000003, self.testuser_name, listens[0].recording_msid)
+        self.assertEqual(cache._r.zcard(cache._prep_key(cache_key)), 0)
+        listens, _, _ = self.logstore.fetch_listens(user_name=self.testuser_name, limit=3)
+        self.assertEqual([l.ts_since_epoch for l in listens], [1400000002, 1400000001, 1400000000])
+        self.assertEqual(self.logstore.latest_listens_cache_misses, 2)
+
     def test_get_listen_count_for_user(self):
         uid = random.randint(2000, 1 << 31)
         testuser = db_user.get_or_create(uid, "user_%d" % uid)
@@ -222,6 +372,32 @@ class TestTimescaleListenStore(DatabaseTestCase):
         self.assertEqual(len(recent), 1)
         self.assertEqual(recent[0].ts_since_epoch, 1400000200)
 
+    def test_fetch_listens_for_multiple_users(self):
+        # the listens of the users interleave, the third user has no listens
+        self.logstore.insert(generate_data(self.testuser_id, "user_a", 1400000000, 3) +
+                             generate_data(self.testuser_id, "user_b", 1400000001, 3))
+        user_names = ["user_a", "user_b", "user_c"]
+
+        listens, min_ts, max_ts = self.logstore.fetch_listens_for_multiple_users_from_storage(
+            user_names, None, None, 4, ORDER_DESC)
+        self.assertEqual([(l.ts_since_epoch, l.user_name) for l in listens],
+                         [(1400000003, "user_b"), (1400000002, "user_a"), (1400000002, "user_b"),
+                          (1400000001, "user_a")])
+        self.assertEqual((min_ts, max_ts), (1400000000, 1400000003))
+
+        listens, _, _ = self.logstore.fetch_listens_for_multiple_users_from_storage(
+            user_names, 1400000000, None, 3, ORDER_ASC)
+        self.assertEqual([(l.ts_since_epoch, l.user_name) for l in listens],
+                         [(1400000002, "user_a"), (1400000001, "user_b"), (1400000001, "user_a")])
+
+        listens, _, _ = self.logstore.fetch_listens_for_multiple_users_from_storage(
+            user_names, 1400000000, 1400000002, 10, ORDER_DESC)
+        self.assertEqual([(l.ts_since_epoch, l.user_name) for l in listens],
+                         [(1400000001, "user_a"), (1400000001, "user_b")])
+
+        self.assertEqual(self.logstore.fetch_listens_for_multiple_users_from_storage(
+            ["user_c"], None, None, 10, ORDER_DESC), ([], 0, 0))
+
     def test_dump_listens(self):
         self._create_test_data(self.testuser_name)
         temp_dir = tempfile.mkdtemp()
@@ -341,6 +517,24 @@ class TestTimescaleListenStore(DatabaseTestCase):
         self.assertEqual(listens[4].ts_since_epoch, 1400000000)
         shutil.rmtree(temp_dir)
 
+    def test_import_listens_with_copy(self):
+        self._create_test_data(self.testuser_name)
+        temp_dir = tempfile.mkdtemp()
+        dump_location = self.logstore.dump_listens(
+            location=temp_dir,
+            dump_id=1,
+            end_time=datetime.now(),
+        )
+        self.reset_timescale_db()
+
+        self.logstore.insert_method = INSERT_METHOD_COPY
+        self.logstore.import_listens_dump(dump_location)
+        listens, min_ts, max_ts = self.logstore.fetch_listens(user_name=self.testuser_name, to_ts=1400000300)
+        self.assertEqual(len(listens), 5)
+        self.assertEqual(listens[0].ts_since_epoch, 1400000200)
+        self.assertEqual(listens[4].ts_since_epoch, 1400000000)
+        shutil.rmtree(temp_dir)
+
     # test test_import_dump_many_users is gone -- why are we testing user dump/restore here??
 
     def create_test_dump(self, archive_name, archive_path, schema_version=None):
@@ -410,6 +604,90 @@ class TestTimescaleListenStore(DatabaseTestCase):
         self.logstore.insert(batch)
         self.assertEqual(count + 1, int(cache.get(user_key, decode=False) or 0))
 
+    def test_timestamps_from_listen_user_metadata(self):
+        self._create_test_data(self.testuser_name)
+        cache.delete(REDIS_USER_TIMESTAMPS + self.testuser_name)
+        self.assertEqual(self.logstore.get_timestamps_for_user(self.testuser_name), (1400000000, 1400000200))
+
+        # deleting the last listen moves the max timestamp back to the listen before it
+        self.logstore.delete_listen(1400000200, self.testuser_name, "4269ddbc-9241-46da-935d-4fa9e0f7f371")
+        self.assertEqual(self.logstore.get_timestamps_for_user(self.testuser_name), (1400000000, 1400000150))
+
+        # a cache miss while another process reads the timestamps waits for it to cache them
+        cache.set(REDIS_USER_TIMESTAMPS_LOCK + self.testuser_name, 1)
+        cache.set(REDIS_USER_TIMESTAMPS + self.testuser_name, "1,2", expirein=0)
+        self.assertEqual(self.logstore._select_timestamps_for_user(self.testuser_name), (1, 2))
+
+        # a lock which was taken by another process after ours expired is not released
+        lock_key = cache._prep_key(REDIS_USER_TIMESTAMPS_LOCK + self.testuser_name)
+        cache._r.set(lock_key, "other")
+        self.assertEqual(self.logstore.release_lock_script(keys=[lock_key], args=["ours"]), 0)
+        self.assertEqual(cache._r.get(lock_key), b"other")
+        cache._r.delete(lock_key)
+
+        # timestamps read before an insert committed are not cached after it
+        cache.delete(REDIS_USER_TIMESTAMPS + self.testuser_name)
+        timestamps_key = cache._prep_key(REDIS_USER_TIMESTAMPS + self.testuser_name)
+        version_key = cache._prep_key(REDIS_USER_METADATA_VERSION + self.testuser_name)
+        version = cache._r.get(version_key) or b""
+        self.logstore.insert(generate_data(1, self.testuser_name, 1500000000, 1))
+        self.assertEqual(self.logstore.set_user_metadata_script(keys=[timestamps_key, version_key],
+                                                                args=[version, "1400000000,1400000150", 1]), 0)
+        self.assertIsNone(cache.get(REDIS_USER_TIMESTAMPS + self.testuser_name))
+        self.assertEqual(self.logstore.get_timestamps_for_user(self.testuser_name), (1400000000, 1500000000))
+        self.assertEqual(cache.get(REDIS_USER_TIMESTAMPS + self.testuser_name), "1400000000,1500000000")
+
+    def test_listen_counts_are_exact(self):
+        self._create_test_data("user_a")
+        self._create_test_data("user_b")
+        # duplicates are not counted
+        self._create_test_data("user_b")
+        self.logstore.delete_listen(1400000050, "user_b", "c7a41965-9f1e-456c-8b1d-27c0f0dde280")
+
+        # the counts are read from the database if they are not cached
+        cache.delete(REDIS_USER_LISTEN_COUNT + "user_a")
+        self.assertEqual(self.logstore.get_listen_count_for_user("user_a"), 5)
+        self.assertEqual(self.logstore.get_listen_count_for_user("user_b"), 4)
+        self.assertEqual(self.logstore.get_total_listen_count(cache_value=False), 9)
+
+        self.logstore.delete("user_a")
+        self.assertEqual(self.logstore.reset_listen_count("user_a"), 0)
+        self.assertEqual(self.logstore.get_total_listen_count(cache_value=False), 4)
+
+    def test_listen_count_read_before_insert_is_not_cached(self):
+        self._create_test_data("user_a")
+        count_key = cache._prep_key(REDIS_USER_LISTEN_COUNT + "user_a")
+        version_key = cache._prep_key(REDIS_USER_METADATA_VERSION + "user_a")
+        cache.delete(REDIS_USER_LISTEN_COUNT + "user_a")
+
+        # a count read from the database before an insert committed is not cached after it
+        version = cache._r.get(version_key) or b""
+        self.logstore.insert(generate_data(1, "user_a", 1500000000, 1))
+        self.assertEqual(self.logstore.set_user_metadata_script(keys=[count_key, version_key], args=[version, 5, 0]), 0)
+        self.assertIsNone(cache._r.get(count_key))
+        self.assertEqual(self.logstore.get_listen_count_for_user("user_a"), 6)
+
+    def test_timestamps_in_cache_for_multiple_users(self):
+        user_names = []
+        for i in range(3):
+            uid = random.randint(2000, 1 << 31)
+            user_names.append(db_user.get_or_create(uid, "user_%d" % uid)['musicbrainz_id'])
+            self._create_test_data(user_names[i])
+            self.assertEqual(self.logstore.get_timestamps_for_user(user_names[i]), (1400000000, 1400000200))
+        cache.delete(REDIS_USER_TIMESTAMPS + user_names[2])
+
+        batch = []
+        for i, user_name in enumerate(user_names):
+            batch.extend(generate_data(1, user_name, 1300000000 + i, 1))
+            batch.extend(generate_data(1, user_name, 1500000000 + i, 1))
+        self.logstore.insert(batch)
+
+        self.assertEqual(cache.get(REDIS_USER_TIMESTAMPS + user_names[0]), "1300000000,1500000000")
+        self.assertEqual(cache.get(REDIS_USER_TIMESTAMPS + user_names[1]), "1300000001,1500000001")
+        # timestamps which were not cached are read from the listenstore when needed
+        self.assertIsNone(cache.get(REDIS_USER_TIMESTAMPS + user_names[2]))
+        self.assertEqual(self.logstore.get_timestamps_for_user(user_names[2]), (1300000002, 1500000002))
+
     def test_delete_listens(self):
         uid = random.randint(2000, 1 << 31)
         testuser = db_user.get_or_create(uid, "user_%d" % uid)
@@ -426,6 +704,7 @@ class TestTimescaleListenStore(DatabaseTestCase):
         self.logstore.delete(testuser_name)
         listens, min_ts, max_ts = self.logstore.fetch_listens(user_name=testuser_name, to_ts=1400000300)
         self.assertEqual(len(listens), 0)
+        self.assertEqual(self.logstore.get_users_with_deleted_listens([testuser_name, "other_user"]), {testuser_name})
 
     def test_delete_single_listen(self):
         uid = random.randint(2000, 1 << 31)
@@ -440,7 +719,14 @@ class TestTimescaleListenStore(DatabaseTestCase):
         self.assertEqual(listens[3].ts_since_epoch, 1400000050)
         self.assertEqual(listens[4].ts_since_epoch, 1400000000)
 
+        self.assertEqual(self.logstore.get_users_with_deleted_listens([testuser_name]), set())
         self.logstore.delete_listen(1400000050, testuser_name, "c7a41965-9f1e-456c-8b1d-27c0f0dde280")
+        self.assertEqual(self.logstore.get_users_with_deleted_listens([testuser_name]), {testuser_name})
+        with ts.engine.connect() as connection:
+            result = connection.execute(sqlalchemy.text("""
+                SELECT sum(count) FROM listen_user_day_count WHERE user_name = :user_name
+            """), user_name=testuser_name)
+            self.assertEqual(result.fetchone()[0], 4)
         listens, min_ts, max_ts = self.logstore.fetch_listens(user_name=testuser_name, to_ts=1400000300)
         self.assertEqual(len(listens), 4)
         self.assertEqual(listens[0].ts_since_epoch, 1400000200)
@@ -1,5 +1,9 @@
 # coding=utf-8
 
+import heapq
+import io
+import itertools
+import math
 import os
 import subprocess
 import tarfile
@@ -16,7 +20,7 @@ from psycopg2.errors import UntranslatableCharacter
 from typing import List
 import sqlalchemy
 
-from brainzutils import cache
+from brainzutils import cache, metrics
 
 import listenbrainz.db.user as db_user
 from listenbrainz.db import timescale
@@ -25,14 +29,140 @@ from listenbrainz.db import DUMP_DEFAULT_THREAD_COUNT
 from listenbrainz.db.dump import SchemaMismatchException
 from listenbrainz.listen import Listen
 from listenbrainz.listenstore import ListenStore
-from listenbrainz.listenstore import ORDER_ASC, ORDER_TEXT, LISTENS_DUMP_SCHEMA_VERSION
+from listenbrainz.listenstore import ORDER_ASC, ORDER_DESC, ORDER_TEXT, LISTENS_DUMP_SCHEMA_VERSION
 from listenbrainz.utils import create_path, init_cache
 
 # Append the user name for both of these keys
 REDIS_USER_LISTEN_COUNT = "lc."
 REDIS_USER_TIMESTAMPS = "ts."
+# Held while the timestamps of a user are read from the listenstore and cached, so that concurrent
+# cache misses for the user wait for the first one instead of all reading the listenstore.
+REDIS_USER_TIMESTAMPS_LOCK = "tsl."
+TIMESTAMPS_LOCK_EXPIRY_TIME = 10  # seconds
+TIMESTAMPS_LOCK_WAIT_TIME = 2  # seconds
+TIMESTAMPS_LOCK_POLL_INTERVAL = 0.05  # seconds
+# Set when listens of a user are deleted, so that the timescale writers stop dropping resubmissions
+# of the user's recently written listens as duplicates. Writers must not remember written listens
+# for longer than this marker lives.
+REDIS_USER_LISTENS_DELETED = "ld."
+LISTENS_DELETED_EXPIRY_TIME = 24 * 60 * 60  # 1 day in seconds
+# A counter of the changes to the listen count and timestamps of a user, which is used to detect
+# concurrent changes while they are read from timescale, see SET_USER_METADATA_SCRIPT.
+REDIS_USER_METADATA_VERSION = "lmv."
+USER_METADATA_VERSION_EXPIRY_TIME = 24 * 60 * 60  # 1 day in seconds
 REDIS_TOTAL_LISTEN_COUNT = "lc-total"
-REDIS_POST_IMPORT_LISTEN_COUNT_EXPIRY = 86400  # 24 hours
+TOTAL_LISTEN_COUNT_EXPIRY_TIME = 5 * 60  # 5 minutes in seconds
+# The latest listens of a user, see TimescaleListenStore.fetch_listens_from_storage, and a counter
+# of the changes to the user's listens which is used to detect concurrent changes while the latest
+# listens are read from timescale.
+REDIS_USER_LATEST_LISTENS = "ull."
+REDIS_USER_LATEST_LISTENS_VERSION = "ullv."
+LATEST_LISTENS_CACHE_EXPIRY_TIME = 60 * 60  # 1 hour in seconds
+METRIC_UPDATE_INTERVAL = 60  # seconds
+
+# Increments the listen counts of users and widens their cached timestamps atomically, for any
+# number of users in one call. Counts and timestamps which are not cached are left alone, they are
+# read from the listenstore, including the new listens, the next time they are needed. Their
+# versions are incremented so that counts read before the insert are not stored, see
+# SET_USER_METADATA_SCRIPT. The timestamps are stored msgpack encoded, like brainzutils cache does.
+# KEYS: for each user, the listen count key, the timestamps key and the version key
+# ARGV: the expiry of the version keys, then for each user the number of inserted listens and their
+# min and max listened_at
+UPDATE_USER_COUNTS_AND_TIMESTAMPS_SCRIPT = """
+    local expiry = ARGV[1]
+    for i = 1, #KEYS / 3 do
+        local count_key, timestamps_key, version_key = KEYS[3 * i - 2], KEYS[3 * i - 1], KEYS[3 * i]
+        local min_ts, max_ts = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+        redis.call('INCR', version_key)
+        redis.call('EXPIRE', version_key, expiry)
+        if redis.call('EXISTS', count_key) == 1 then
+            redis.call('INCRBY', count_key, ARGV[3 * i - 1])
+        end
+
+        local cached = redis.call('GET', timestamps_key)
+        if cached then
+            local timestamps = cmsgpack.unpack(cached)
+            local separator = string.find(timestamps, ',', 1, true)
+            local cached_min_ts = tonumber(string.sub(timestamps, 1, separator - 1))
+            local cached_max_ts = tonumber(string.sub(timestamps, separator + 1))
+            if min_ts < cached_min_ts or max_ts > cached_max_ts then
+                redis.call('SET', timestamps_key, cmsgpack.pack(string.format('%d,%d',
+                    math.min(min_ts, cached_min_ts), math.max(max_ts, cached_max_ts))))
+            end
+        end
+    end
+"""
+
+# Adds inserted listens to the cached latest listens of their users and keeps the latest size
+# of them. Users whose latest listens are not cached are skipped, but their versions are
+# incremented so that latest listens read before the insert are not stored, see
+# SET_LATEST_LISTENS_SCRIPT.
+# KEYS: for each user, the latest listens key and the version key
+# ARGV: the cache size and the expiry of the version keys, then for each user the number of
+# listens followed by the listened_at and the cached listen of each listen
+UPDATE_LATEST_LISTENS_SCRIPT = """
+    local size, expiry = tonumber(ARGV[1]), ARGV[2]
+    local arg = 3
+    for i = 1, #KEYS / 2 do
+        local listens_key, version_key = KEYS[2 * i - 1], KEYS[2 * i]
+        local count = tonumber(ARGV[arg])
+        redis.call('INCR', version_key)
+        redis.call('EXPIRE', version_key, expiry)
+        if redis.call('EXISTS', listens_key) == 1 then
+            for j = 1, count do
+                redis.call('ZADD', listens_key, ARGV[arg + 2 * j - 1], ARGV[arg + 2 * j])
+            end
+            redis.call('ZREMRANGEBYRANK', listens_key, 0, -size - 1)
+        end
+        arg = arg + 2 * count + 1
+    end
+"""
+
+# Stores the latest listens of a user read from timescale, unless the user's listens changed
+# since the read started.
+# KEYS: the latest listens key and the version key
+# ARGV: the version before the read ('' if there was none), the expiry of the latest listens, then
+# the listened_at and the cached listen of each listen
+SET_LATEST_LISTENS_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    for i = 3, #ARGV, 2 do
+        redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+"""
+# Stores the listen count or the timestamps of a user read from timescale, unless they changed since
+# the read started. The timestamps are msgpack encoded, like brainzutils cache does.
+# KEYS: the listen count or timestamps key and the version key
+# ARGV: the version before the read ('' if there was none), the value and '1' to msgpack encode it
+SET_USER_METADATA_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+        return 0
+    end
+    if ARGV[3] == '1' then
+        redis.call('SET', KEYS[1], cmsgpack.pack(ARGV[2]))
+    else
+        redis.call('SET', KEYS[1], ARGV[2])
+    end
+    return 1
+"""
+
+# Releases a lock if it is still held with the given token, so that a lock which expired and was
+# taken by another process is not released.
+# KEYS: the lock key
+# ARGV: the token the lock was taken with
+RELEASE_LOCK_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+"""
+# A member of the cached latest listens of a user which holds all the user's listens, at the
+# lowest score. It is trimmed off like a listen once the user has more listens than the cache holds.
+LATEST_LISTENS_ALL_CACHED = ""
 
 DUMP_CHUNK_SIZE = 100000
 NUMBER_OF_USERS_PER_DIRECTORY = 1000
@@ -40,14 +170,60 @@ DUMP_FILE_SIZE_LIMIT = 1024 * 1024 * 1024  # 1 GB
 DATA_START_YEAR = 2005
 DATA_START_YEAR_IN_SECONDS = 1104537600
 
-# How many listens to fetch on the first attempt. If we don't fetch enough, increase it by WINDOW_SIZE_MULTIPLIER
-DEFAULT_FETCH_WINDOW = 30 * 86400  # 30 days
-
-# When expanding the search, how fast should the bounds be moved out
-WINDOW_SIZE_MULTIPLIER = 3
+# The width of the buckets of the listen_user_day_count table, which holds the number of listens of
+# each user in each bucket and is used to find the time range holding the listens of a fetch.
+LISTEN_DAY_COUNT_BUCKET_WIDTH = 86400  # 1 day
 
 LISTEN_COUNT_BUCKET_WIDTH = 2592000
 
+# How listens are inserted, selected with the LISTEN_INSERT_METHOD config key. "values" sends the
+# listens as a multi row INSERT ... VALUES, "copy" COPYs them into a temporary staging table and
+# inserts them from there, which is faster for large batches like dump imports.
+INSERT_METHOD_VALUES = "values"
+INSERT_METHOD_COPY = "copy"
+INSERT_VALUES_PAGE_SIZE = 1000
+
+
+def _escape_copy_text(value):
+    """ Escape a value for the text format of COPY """
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _latest_listens_cache_member(listened_at, track_name, user_name, created, data, recording_msid):
+    """ Return the member of a listen in the cached latest listens of its user """
+    if not isinstance(data, str):
+        data = ujson.dumps(data)
+    return ujson.dumps([listened_at, track_name, user_name, created.isoformat(), data, recording_msid])
+
+
+def invalidate_cached_user_metadata(user_names):
+    """ Remove the cached listen counts and timestamps of users after their listens were deleted or
+        their metadata was corrected, and increment their versions so that values read before that
+        are not cached.
+    """
+    pipe = cache._r.pipeline()
+    for user_name in user_names:
+        version_key = cache._prep_key(REDIS_USER_METADATA_VERSION + user_name)
+        pipe.delete(cache._prep_key(REDIS_USER_LISTEN_COUNT + user_name))
+        pipe.delete(cache._prep_key(REDIS_USER_TIMESTAMPS + user_name))
+        pipe.incr(version_key)
+        pipe.expire(version_key, USER_METADATA_VERSION_EXPIRY_TIME)
+    pipe.execute()
+
+
+def _recording_msid_from_data(data):
+    """ Return the recording_msid in the JSON data of a listen row, for rows which don't carry it """
+    if isinstance(data, str):
+        data = ujson.loads(data)
+    return data['track_metadata']['additional_info'].get('recording_msid')
+
+
+def _merge_listen_rows(user_rows, order):
+    """ Merge lists of listen rows which are each ordered by listened_at and track_name in the given
+        order into one iterator of rows in that order. """
+    # the lists in ascending order are in descending order of the key of the descending order
+    return heapq.merge(*user_rows, key=lambda row: (-row[0], row[1]), reverse=order == ORDER_ASC)
+
 
 class TimescaleListenStore(ListenStore):
     '''
@@ -62,8 +238,22 @@ class TimescaleListenStore(ListenStore):
         # Initialize brainzutils cache
         init_cache(host=conf['REDIS_HOST'], port=conf['REDIS_PORT'],
                    namespace=conf['REDIS_NAMESPACE'])
+        self.update_user_counts_and_timestamps_script = cache._r.register_script(UPDATE_USER_COUNTS_AND_TIMESTAMPS_SCRIPT)
+        self.update_latest_listens_script = cache._r.register_script(UPDATE_LATEST_LISTENS_SCRIPT)
+        self.set_latest_listens_script = cache._r.register_script(SET_LATEST_LISTENS_SCRIPT)
+        self.set_user_metadata_script = cache._r.register_script(SET_USER_METADATA_SCRIPT)
+        self.release_lock_script = cache._r.register_script(RELEASE_LOCK_SCRIPT)
         self.dump_temp_dir_root = conf.get(
             'LISTEN_DUMP_TEMP_DIR_ROOT', tempfile.mkdtemp())
+        self.insert_method = conf.get('LISTEN_INSERT_METHOD') or INSERT_METHOD_VALUES
+        if self.insert_method not in (INSERT_METHOD_VALUES, INSERT_METHOD_COPY):
+            raise ValueError("Unknown listen insert method: %s" % self.insert_method)
+
+        # the number of latest listens of each user kept in redis, 0 if they aren't cached
+        self.latest_listens_cache_size = int(conf.get('LATEST_LISTENS_CACHE_SIZE') or 0)
+        self.latest_listens_cache_hits = 0
+        self.latest_listens_cache_misses = 0
+        self.metric_submission_time = time.monotonic() + METRIC_UPDATE_INTERVAL
 
     def set_empty_cache_values_for_user(self, user_name):
         """When a user is created, set the listen_count and timestamp keys so that we
@@ -72,6 +262,17 @@ class TimescaleListenStore(ListenStore):
         cache.set(REDIS_USER_LISTEN_COUNT + user_name, 0, expirein=0, encode=False)
         cache.set(REDIS_USER_TIMESTAMPS + user_name, "0,0", expirein=0)
 
+    def mark_listens_deleted(self, user_name):
+        """ Record that listens of a user are being deleted, see REDIS_USER_LISTENS_DELETED """
+        cache.set(REDIS_USER_LISTENS_DELETED + user_name, 1, expirein=LISTENS_DELETED_EXPIRY_TIME)
+
+    def get_users_with_deleted_listens(self, user_names):
+        """ Return the set of the given users whose listens were deleted in the last
+        LISTENS_DELETED_EXPIRY_TIME seconds. """
+        user_names = list(user_names)
+        deleted = cache.get_many([REDIS_USER_LISTENS_DELETED + user_name for user_name in user_names])
+        return set(user_name for user_name in user_names if REDIS_USER_LISTENS_DELETED + user_name in deleted)
+
     def get_listen_count_for_user(self, user_name):
         """Get the total number of listens for a user. The number of listens comes from
            brainzutils cache unless an exact number is asked for.
@@ -87,20 +288,24 @@ class TimescaleListenStore(ListenStore):
             return int(count)
 
     def reset_listen_count(self, user_name):
-        """ Reset the listen count of a user from cache and put in a new calculated value.
-            returns the re-calculated listen count.
+        """ Reset the listen count of a user from cache and put in the count from listen_user_metadata.
+            returns the listen count.
 
             Args:
                 user_name: the musicbrainz id of user whose listen count needs to be reset
         """
-        query = "SELECT SUM(count) FROM listen_count_30day WHERE user_name = :user_name"
+        query = "SELECT count FROM listen_user_metadata WHERE user_name = :user_name"
+        # read before the count, so that any insert or delete after which it is outdated also changes it
+        version_key = cache._prep_key(REDIS_USER_METADATA_VERSION + user_name)
+        version = cache._r.get(version_key) or b""
         t0 = time.monotonic()
         try:
             with timescale.engine.connect() as connection:
                 result = connection.execute(sqlalchemy.text(query), {
                     "user_name": user_name,
                 })
-                count = int(result.fetchone()[0] or 0)
+                row = result.fetchone()
+                count = row["count"] if row else 0
 
         except psycopg2.OperationalError as e:
             self.log.error("Cannot query timescale listen_count: %s" %
@@ -110,21 +315,10 @@ class TimescaleListenStore(ListenStore):
         # intended for production monitoring
         self.log.info("listen counts %s %.2fs" % (user_name, time.monotonic() - t0))
         # put this value into brainzutils cache without an expiry time
-        cache.set(REDIS_USER_LISTEN_COUNT + user_name,
-                  count, expirein=0, encode=False)
+        self.set_user_metadata_script(keys=[cache._prep_key(REDIS_USER_LISTEN_COUNT + user_name), version_key],
+                                      args=[version, count, 0])
         return count
 
-    def set_listen_count_expiry_for_user(self, user_name):
-        """ Set an expire time for the listen count cache item. This is called after
-            a bulk import which allows for timescale continuous aggregates to catch up
-            to listen counts. Once the key expires, the correct value can be calculated
-            from the aggregate.
-
-            Args:
-                user_name: the musicbrainz id of user whose listen count needs an expiry time
-        """
-        cache._r.expire(cache._prep_key(REDIS_USER_LISTEN_COUNT + user_name), REDIS_POST_IMPORT_LISTEN_COUNT_EXPIRY)
-
     def update_timestamps_for_user(self, user_name, min_ts, max_ts):
         """
             If any code adds/removes listens it should update the timestamps for the user
@@ -150,20 +344,74 @@ class TimescaleListenStore(ListenStore):
         tss = cache.get(REDIS_USER_TIMESTAMPS + user_name)
         if tss:
             (min_ts, max_ts) = tss.split(",")
-            min_ts = int(min_ts)
-            max_ts = int(max_ts)
-        else:
+            return int(min_ts), int(max_ts)
+
+        return self._select_timestamps_for_user(user_name)
+
+    def get_timestamps_for_users(self, user_names):
+        """ Return a dict of the (min_ts, max_ts) of each of the given users, like get_timestamps_for_user
+            does for one user, reading the cached timestamps of all users in one redis round trip.
+        """
+        if not user_names:
+            return {}
+        cached = cache.get_many([REDIS_USER_TIMESTAMPS + user_name for user_name in user_names])
+
+        timestamps = {}
+        for user_name in user_names:
+            tss = cached.get(REDIS_USER_TIMESTAMPS + user_name)
+            if tss:
+                (min_ts, max_ts) = tss.split(",")
+                timestamps[user_name] = int(min_ts), int(max_ts)
+            elif user_name not in timestamps:
+                timestamps[user_name] = self._select_timestamps_for_user(user_name)
+        return timestamps
+
+    def _select_timestamps_for_user(self, user_name):
+        """ Fetch the min_ts and max_ts of a user from listen_user_metadata and cache them. If another
+            process is already doing that for the user, wait for it to cache them instead.
+        """
+        lock_key = cache._prep_key(REDIS_USER_TIMESTAMPS_LOCK + user_name)
+        lock_token = uuid.uuid4().hex
+        locked = cache._r.set(lock_key, lock_token, nx=True, ex=TIMESTAMPS_LOCK_EXPIRY_TIME)
+        if not locked:
+            deadline = time.monotonic() + TIMESTAMPS_LOCK_WAIT_TIME
+            while time.monotonic() < deadline:
+                time.sleep(TIMESTAMPS_LOCK_POLL_INTERVAL)
+                tss = cache.get(REDIS_USER_TIMESTAMPS + user_name)
+                if tss:
+                    (min_ts, max_ts) = tss.split(",")
+                    return int(min_ts), int(max_ts)
+            # the other process failed or is too slow, read them anyway
+
+        query = """SELECT min_listened_at, max_listened_at
+                     FROM listen_user_metadata
+                    WHERE user_name = :user_name"""
+        # read before the timestamps, so that any insert or delete after which they are outdated also changes it
+        version_key = cache._prep_key(REDIS_USER_METADATA_VERSION + user_name)
+        try:
+            version = cache._r.get(version_key) or b""
             t0 = time.monotonic()
-            min_ts = self._select_single_timestamp(True, user_name)
-            max_ts = self._select_single_timestamp(False, user_name)
-            cache.set(REDIS_USER_TIMESTAMPS + user_name, "%d,%d" % (min_ts, max_ts), expirein=0)
+            with timescale.engine.connect() as connection:
+                row = connection.execute(sqlalchemy.text(query), user_name=user_name).fetchone()
+            # users without listens have the timestamps 0, 0
+            min_ts = (row["min_listened_at"] or 0) if row else 0
+            max_ts = (row["max_listened_at"] or 0) if row else 0
+            self.set_user_metadata_script(keys=[cache._prep_key(REDIS_USER_TIMESTAMPS + user_name), version_key],
+                                          args=[version, "%d,%d" % (min_ts, max_ts), 1])
             # intended for production monitoring
             self.log.info("timestamps %s %.2fs" % (user_name, time.monotonic() - t0))
+        except psycopg2.OperationalError as e:
+            self.log.error("Cannot fetch min/max timestamp: %s" %
+                           str(e), exc_info=True)
+            raise
+        finally:
+            if locked:
+                self.release_lock_script(keys=[lock_key], args=[lock_token])
 
         return min_ts, max_ts
 
-    def _select_single_timestamp(self, select_min_timestamp, user_name):
-        """ Fetch a single timestamp (min or max) from the listenstore for a given user.
+    def _select_single_timestamp(self, connection, select_min_timestamp, user_name):
+        """ Fetch a single timestamp (min or max) from the listen table for a given user.
 
             Args:
                 select_min_timestamp: boolean. Select the min timestamp if true, max if false.
@@ -171,31 +419,39 @@ class TimescaleListenStore(ListenStore):
 
             Returns:
 
-                The selected timestamp for the user or 0 if no timestamp was found.
+                The selected timestamp for the user or None if no timestamp was found.
         """
+        day_range = self._get_listen_day_range(connection, user_name)
+        if day_range is None:
+            return None
 
-        function = "max"
-        if select_min_timestamp:
-            function = "min"
-
+        # only the chunk of the first or last day of the user's listens is scanned
+        day = day_range[0] if select_min_timestamp else day_range[1]
         query = """SELECT %s(listened_at) AS ts
                      FROM listen
-                     WHERE user_name = :user_name""" % function
-        try:
-            with timescale.engine.connect() as connection:
-                result = connection.execute(sqlalchemy.text(query), {
-                    "user_name": user_name
-                })
-                row = result.fetchone()
-                if row is None or row['ts'] is None:
-                    return 0
-
-                return row['ts']
-
-        except psycopg2.OperationalError as e:
-            self.log.error("Cannot fetch min/max timestamp: %s" %
-                           str(e), exc_info=True)
-            raise
+                    WHERE user_name = :user_name
+                      AND listened_at >= :day_start
+                      AND listened_at < :day_end""" % ("min" if select_min_timestamp else "max")
+        result = connection.execute(sqlalchemy.text(query), {
+            "user_name": user_name,
+            "day_start": day,
+            "day_end": day + LISTEN_DAY_COUNT_BUCKET_WIDTH,
+        })
+        return result.fetchone()["ts"]
+
+    def _get_listen_day_range(self, connection, user_name):
+        """ Return the first and the last day holding listens of a user from listen_user_day_count,
+            or None if the user has no listens. Queries of all listens of a user are bounded with it,
+            so that timescale only reads the chunks which may hold the user's listens.
+        """
+        query = """SELECT min(day) AS first_day, max(day) AS last_day
+                     FROM listen_user_day_count
+                    WHERE user_name = :user_name
+                      AND count > 0"""
+        row = connection.execute(sqlalchemy.text(query), user_name=user_name).fetchone()
+        if row is None or row["first_day"] is None:
+            return None
+        return row["first_day"], row["last_day"]
 
     def get_total_listen_count(self, cache_value=True):
         """ Returns the total number of listens stored in the ListenStore.
@@ -208,7 +464,7 @@ class TimescaleListenStore(ListenStore):
             if count:
                 return int(count)
 
-        query = "SELECT SUM(count) AS value FROM listen_count_30day"
+        query = "SELECT SUM(count) AS value FROM listen_user_metadata"
 
         try:
             with timescale.engine.connect() as connection:
@@ -216,11 +472,11 @@ class TimescaleListenStore(ListenStore):
                 count = int(result.fetchone()["value"] or "0")
         except psycopg2.OperationalError as e:
             self.log.error(
-                "Cannot query timescale listen_count_30day: %s" % str(e), exc_info=True)
+                "Cannot query timescale listen_user_metadata: %s" % str(e), exc_info=True)
             raise
 
         if cache_value:
-            cache.set(REDIS_TOTAL_LISTEN_COUNT, count, expirein=0)
+            cache.set(REDIS_TOTAL_LISTEN_COUNT, count, expirein=TOTAL_LISTEN_COUNT_EXPIRY_TIME)
         return count
 
     def insert(self, listens):
@@ -233,50 +489,213 @@ class TimescaleListenStore(ListenStore):
         for listen in listens:
             submit.append(listen.to_timescale())
 
-        query = """INSERT INTO listen (listened_at, track_name, user_name, data)
-                        VALUES %s
-                   ON CONFLICT (listened_at, track_name, user_name)
-                    DO NOTHING
-                     RETURNING listened_at, track_name, user_name"""
+        return self.insert_rows(submit)
+
+    def insert_rows(self, submit, method=None):
+        """
+            Insert a batch of (listened_at, track_name, user_name, data, recording_msid) rows, as returned by
+            Listen.to_timescale. Returns the same as insert.
+
+            The rows are inserted with the given insert method, or the configured one if None.
+        """
+        # rows rendered before recording_msid was added to them, e.g. in the spool, get it from their data
+        submit = [row if len(row) > 4 else (*row, _recording_msid_from_data(row[3])) for row in submit]
 
-        inserted_rows = []
         conn = timescale.engine.raw_connection()
         with conn.cursor() as curs:
             try:
-                execute_values(curs, query, submit, template=None)
-                while True:
-                    result = curs.fetchone()
-                    if not result:
-                        break
-                    inserted_rows.append((result[0], result[1], result[2]))
+                if (method or self.insert_method) == INSERT_METHOD_COPY:
+                    inserted_rows = self._insert_rows_with_copy(curs, submit)
+                else:
+                    inserted_rows = self._insert_rows_with_values(curs, submit)
             except UntranslatableCharacter:
                 conn.rollback()
                 return
+            self._increment_listen_day_counts(curs, inserted_rows)
+            self._update_listen_user_metadata(curs, inserted_rows)
 
         conn.commit()
 
-        # update the listen counts and timestamps for the users
+        inserted_keys = [(listened_at, track_name, user_name) for listened_at, track_name, user_name, _ in inserted_rows]
+        # the cached timestamps must include the new listens before the cached latest listens are
+        # updated, see _fetch_latest_listens
+        self.update_counts_and_timestamps_for_users(inserted_keys)
+        try:
+            if self.latest_listens_cache_size:
+                self.update_latest_listens_cache(submit, inserted_rows)
+            elif inserted_keys:
+                # other processes may cache the latest listens
+                self.invalidate_latest_listens_cache(set(user_name for _, _, user_name in inserted_keys))
+        except Exception:
+            # the cached latest listens expire after LATEST_LISTENS_CACHE_EXPIRY_TIME
+            self.log.error("Could not update the cached latest listens", exc_info=True)
+        return inserted_keys
+
+    def update_counts_and_timestamps_for_users(self, inserted_rows):
+        """ Increment the cached listen counts and widen the cached timestamps of the users
+            of newly inserted listens, for all users in one redis round trip.
+
+            Args:
+                inserted_rows: list of (listened_at, track_name, user_name) of the inserted listens
+        """
         user_timestamps = {}
         user_counts = defaultdict(int)
         for ts, _, user_name in inserted_rows:
-            if listen.user_name in user_timestamps:
-                if ts < user_timestamps[listen.user_name][0]:
-                    user_timestamps[listen.user_name][0] = ts
-                if ts > user_timestamps[listen.user_name][1]:
-                    user_timestamps[listen.user_name][1] = ts
+            if user_name in user_timestamps:
+                if ts < user_timestamps[user_name][0]:
+                    user_timestamps[user_name][0] = ts
+                if ts > user_timestamps[user_name][1]:
+                    user_timestamps[user_name][1] = ts
             else:
-                user_timestamps[listen.user_name] = [ts, ts]
+                user_timestamps[user_name] = [ts, ts]
 
             user_counts[user_name] += 1
 
-        for user_name in user_counts:
-            cache.increment(REDIS_USER_LISTEN_COUNT + user_name, amount=user_counts[user_name])
+        if not user_counts:
+            return
+
+        keys = []
+        args = [USER_METADATA_VERSION_EXPIRY_TIME]
+        for user_name, count in user_counts.items():
+            keys.append(cache._prep_key(REDIS_USER_LISTEN_COUNT + user_name))
+            keys.append(cache._prep_key(REDIS_USER_TIMESTAMPS + user_name))
+            keys.append(cache._prep_key(REDIS_USER_METADATA_VERSION + user_name))
+            args.extend([count, user_timestamps[user_name][0], user_timestamps[user_name][1]])
+        self.update_user_counts_and_timestamps_script(keys=keys, args=args)
+
+    def update_latest_listens_cache(self, submit, inserted_rows):
+        """ Add newly inserted listens to the cached latest listens of their users, for all users in
+            one redis round trip.
 
-        for user in user_timestamps:
-            self.update_timestamps_for_user(
-                user, user_timestamps[user][0], user_timestamps[user][1])
+            Args:
+                submit: the (listened_at, track_name, user_name, data, recording_msid) rows given to insert_rows
+                inserted_rows: list of (listened_at, track_name, user_name, created) of the inserted listens
+        """
+        # the first of several rows with the same key is the inserted one
+        data = {}
+        for row in submit:
+            data.setdefault((row[0], row[1], row[2]), (row[3], row[4]))
+
+        user_listens = defaultdict(list)
+        for listened_at, track_name, user_name, created in inserted_rows:
+            member = _latest_listens_cache_member(listened_at, track_name, user_name, created,
+                                                  *data[(listened_at, track_name, user_name)])
+            user_listens[user_name].append((listened_at, member))
+
+        keys = []
+        args = [self.latest_listens_cache_size, LATEST_LISTENS_CACHE_EXPIRY_TIME]
+        for user_name, listens in user_listens.items():
+            keys.append(cache._prep_key(REDIS_USER_LATEST_LISTENS + user_name))
+            keys.append(cache._prep_key(REDIS_USER_LATEST_LISTENS_VERSION + user_name))
+            args.append(len(listens))
+            for listened_at, member in listens:
+                args.extend((listened_at, member))
+
+        if keys:
+            self.update_latest_listens_script(keys=keys, args=args)
+
+    def invalidate_latest_listens_cache(self, user_names):
+        """ Remove the cached latest listens of users whose listens changed without updating the cache """
+        pipe = cache._r.pipeline()
+        for user_name in user_names:
+            version_key = cache._prep_key(REDIS_USER_LATEST_LISTENS_VERSION + user_name)
+            pipe.delete(cache._prep_key(REDIS_USER_LATEST_LISTENS + user_name))
+            pipe.incr(version_key)
+            pipe.expire(version_key, LATEST_LISTENS_CACHE_EXPIRY_TIME)
+        pipe.execute()
 
-        return inserted_rows
+    def _increment_listen_day_counts(self, curs, inserted_rows):
+        """ Add the inserted listens to the listen counts of their users and days in listen_user_day_count.
+
+            Args:
+                inserted_rows: list of (listened_at, track_name, user_name, created) of the inserted listens
+        """
+        day_counts = defaultdict(int)
+        for listened_at, _, user_name, _ in inserted_rows:
+            day_counts[(user_name, listened_at - listened_at % LISTEN_DAY_COUNT_BUCKET_WIDTH)] += 1
+        if not day_counts:
+            return
+
+        query = """INSERT INTO listen_user_day_count (user_name, day, count)
+                        VALUES %s
+                   ON CONFLICT (user_name, day)
+                 DO UPDATE SET count = listen_user_day_count.count + EXCLUDED.count"""
+        # sorted, so that concurrent inserts lock the rows in the same order and cannot deadlock
+        values = sorted((user_name, day, count) for (user_name, day), count in day_counts.items())
+        execute_values(curs, query, values, page_size=INSERT_VALUES_PAGE_SIZE)
+
+    def _update_listen_user_metadata(self, curs, inserted_rows):
+        """ Add the inserted listens to the listen counts of their users in listen_user_metadata and
+            widen the users' timestamps to include them.
+
+            Args:
+                inserted_rows: list of (listened_at, track_name, user_name, created) of the inserted listens
+        """
+        user_metadata = {}
+        for listened_at, _, user_name, _ in inserted_rows:
+            if user_name in user_metadata:
+                count, min_ts, max_ts = user_metadata[user_name]
+                user_metadata[user_name] = (count + 1, min(min_ts, listened_at), max(max_ts, listened_at))
+            else:
+                user_metadata[user_name] = (1, listened_at, listened_at)
+        if not user_metadata:
+            return
+
+        # the timestamps of users without listens are NULL, which LEAST and GREATEST ignore
+        query = """INSERT INTO listen_user_metadata (user_name, count, min_listened_at, max_listened_at)
+                        VALUES %s
+                   ON CONFLICT (user_name)
+                 DO UPDATE SET count = listen_user_metadata.count + EXCLUDED.count,
+                               min_listened_at = LEAST(listen_user_metadata.min_listened_at, EXCLUDED.min_listened_at),
+                               max_listened_at = GREATEST(listen_user_metadata.max_listened_at, EXCLUDED.max_listened_at)"""
+        # sorted, so that concurrent inserts lock the rows in the same order and cannot deadlock
+        values = sorted((user_name, count, min_ts, max_ts) for user_name, (count, min_ts, max_ts) in user_metadata.items())
+        execute_values(curs, query, values, page_size=INSERT_VALUES_PAGE_SIZE)
+
+    def _insert_rows_with_values(self, curs, rows):
+        """ Insert (listened_at, track_name, user_name, data, recording_msid) rows with a multi row INSERT
+            and return the (listened_at, track_name, user_name, created) of the rows which were inserted. """
+        query = """INSERT INTO listen (listened_at, track_name, user_name, data, recording_msid)
+                        VALUES %s
+                   ON CONFLICT (listened_at, track_name, user_name)
+                    DO NOTHING
+                     RETURNING listened_at, track_name, user_name, created"""
+
+        # fetch=True collects the returned rows of every page, not only those of the last one
+        result = execute_values(curs, query, rows, template=None, page_size=INSERT_VALUES_PAGE_SIZE, fetch=True)
+        return [tuple(row) for row in result]
+
+    def _insert_rows_with_copy(self, curs, rows):
+        """ COPY (listened_at, track_name, user_name, data, recording_msid) rows into a staging table, insert
+            them from there in one statement and return the (listened_at, track_name, user_name, created) of
+            the rows which were inserted. Duplicates are skipped exactly like _insert_rows_with_values does.
+
+            The staging table lives as long as the database connection and is emptied on commit. Its data
+            column is JSONB so that invalid listen data fails the COPY like it would fail the INSERT.
+        """
+        curs.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS listen_staging (
+                            listened_at     BIGINT NOT NULL,
+                            track_name      TEXT   NOT NULL,
+                            user_name       TEXT   NOT NULL,
+                            data            JSONB  NOT NULL,
+                            recording_msid  UUID
+                        ) ON COMMIT DELETE ROWS""")
+
+        buf = io.StringIO()
+        for listened_at, track_name, user_name, data, recording_msid in rows:
+            buf.write("%d\t%s\t%s\t%s\t%s\n" % (listened_at, _escape_copy_text(track_name),
+                                                   _escape_copy_text(user_name), _escape_copy_text(data),
+                                                   "\\N" if recording_msid is None else _escape_copy_text(recording_msid)))
+        buf.seek(0)
+        curs.copy_expert("COPY listen_staging (listened_at, track_name, user_name, data, recording_msid) FROM STDIN", buf)
+
+        curs.execute("""INSERT INTO listen (listened_at, track_name, user_name, data, recording_msid)
+                             SELECT listened_at, track_name, user_name, data, recording_msid
+                               FROM listen_staging
+                        ON CONFLICT (listened_at, track_name, user_name)
+                         DO NOTHING
+                          RETURNING listened_at, track_name, user_name, created""")
+        return [tuple(row) for row in curs.fetchall()]
 
     def fetch_listens_from_storage(self, user_name, from_ts, to_ts, limit, order):
         """ The timestamps are stored as UTC in the postgres datebase while on retrieving
@@ -290,10 +709,97 @@ class TimescaleListenStore(ListenStore):
             to_ts: seconds since epoch, in float
             limit: the maximum number of items to return
             order: 0 for ASCending order, 1 for DESCending order
+
+            The latest listens, fetched without from_ts and to_ts, come from the cache of the latest
+            listens of the user if it is enabled.
         """
+        if self.latest_listens_cache_size and from_ts is None and to_ts is None \
+                and limit <= self.latest_listens_cache_size:
+            return self._fetch_latest_listens(user_name, limit)
 
         return self.fetch_listens_for_multiple_users_from_storage([user_name], from_ts, to_ts, limit, order)
 
+    def _fetch_latest_listens(self, user_name, limit):
+        """ Return the latest listens of a user from the cache, reading and caching the latest
+            LATEST_LISTENS_CACHE_SIZE listens first if they aren't cached. Returns the same as
+            fetch_listens_from_storage.
+
+            The cache is written through by insert_rows and invalidated when listens are deleted. If
+            that happens while the listens are read from timescale, they may be outdated and aren't cached.
+        """
+        listens = self._get_cached_latest_listens(user_name, limit)
+        if listens is not None:
+            self.latest_listens_cache_hits += 1
+            min_ts, max_ts = self.get_timestamps_for_user(user_name)
+        else:
+            self.latest_listens_cache_misses += 1
+            # read before the timestamps, so that any insert after which they are outdated also changes it
+            version_key = cache._prep_key(REDIS_USER_LATEST_LISTENS_VERSION + user_name)
+            version = cache._r.get(version_key) or b""
+            rows, min_ts, max_ts = self._fetch_listen_rows_for_multiple_users(
+                [user_name], None, None, self.latest_listens_cache_size, ORDER_DESC)
+            self._set_cached_latest_listens(user_name, version, rows)
+            listens = [Listen.from_timescale(*row) for row in rows[:limit]]
+
+        self._submit_metrics()
+        return listens, min_ts, max_ts
+
+    def _get_cached_latest_listens(self, user_name, limit):
+        """ Return the latest limit listens of a user from the cache, or None if they aren't cached """
+        members = cache._r.zrevrange(cache._prep_key(REDIS_USER_LATEST_LISTENS + user_name), 0, -1, withscores=True)
+        if not members:
+            return None
+
+        all_cached = not members[-1][0]
+        rows = [ujson.loads(member) for member, _ in members if member]
+        rows.sort(key=lambda row: (-row[0], row[1]))
+        # a listen cached both by a cache miss and by the insert which wrote it has two members, as their
+        # data may be serialized differently
+        rows = [row for i, row in enumerate(rows) if i == 0 or row[:2] != rows[i - 1][:2]]
+        if len(rows) > limit:
+            # the order of listens with the same listened_at depends on the collation of the
+            # database, so the first page must not end between two of them
+            if rows[limit - 1][0] == rows[limit][0]:
+                return None
+        elif not all_cached:
+            return None
+
+        # members cached before the recording_msid was added to them end at the data
+        return [Listen.from_timescale(listened_at, track_name, user_name, datetime.fromisoformat(created), *data)
+                for listened_at, track_name, user_name, created, *data in rows[:limit]]
+
+    def _set_cached_latest_listens(self, user_name, version, rows):
+        """ Cache the latest listens of a user read from timescale, unless the listens of the user
+            changed since version was read.
+
+            Args:
+                rows: the (listened_at, track_name, user_name, created, data, recording_msid) rows of the
+                    listens, with the data as the JSON text read from timescale
+        """
+        args = [version, LATEST_LISTENS_CACHE_EXPIRY_TIME]
+        if len(rows) < self.latest_listens_cache_size:
+            args.extend(("-inf", LATEST_LISTENS_ALL_CACHED))
+        for row in rows:
+            args.extend((row[0], _latest_listens_cache_member(*row)))
+
+        self.set_latest_listens_script(keys=[cache._prep_key(REDIS_USER_LATEST_LISTENS + user_name),
+                                             cache._prep_key(REDIS_USER_LATEST_LISTENS_VERSION + user_name)],
+                                       args=args)
+
+    def _submit_metrics(self):
+        if time.monotonic() < self.metric_submission_time:
+            return
+
+        self.metric_submission_time = time.monotonic() + METRIC_UPDATE_INTERVAL
+        try:
+            if self.latest_listens_cache_hits:
+                metrics.increment("latest_listens_cache_hits", amount=self.latest_listens_cache_hits)
+            if self.latest_listens_cache_misses:
+                metrics.increment("latest_listens_cache_misses", amount=self.latest_listens_cache_misses)
+        except Exception:
+            return
+        self.latest_listens_cache_hits = self.latest_listens_cache_misses = 0
+
     def fetch_listens_for_multiple_users_from_storage(self, user_names: List[str], from_ts: float, to_ts: float, limit: int, order: int):
         """ The timestamps are stored as UTC in the postgres datebase while on retrieving
             the value they are converted to the local server's timezone. So to compare
@@ -306,100 +812,188 @@ class TimescaleListenStore(ListenStore):
             to_ts: seconds since epoch, in float
             limit: the maximum number of items to return
             order: 0 for DESCending order, 1 for ASCending order
-        """
-
-        min_user_ts = max_user_ts = None
-        for user_name in user_names:
-            min_ts, max_ts = self.get_timestamps_for_user(user_name)
-            min_user_ts = min(min_ts, min_user_ts or min_ts)
-            max_user_ts = max(max_ts, max_user_ts or max_ts)
 
-        if to_ts is None and from_ts is None:
-            to_ts = max_user_ts + 1
+            The first limit listens of each user are fetched with an index scan per user and the
+            listens of all users are merged, so the cost of a fetch grows with the number of users
+            and limit, but not with the number of their listens.
+        """
+        rows, min_user_ts, max_user_ts = self._fetch_listen_rows_for_multiple_users(user_names, from_ts, to_ts,
+                                                                                    limit, order)
+        # the data is parsed by Listen when it is needed, see Listen.from_timescale
+        listens = [Listen.from_timescale(*row) for row in rows]
+        if order == ORDER_ASC:
+            listens.reverse()
+        return (listens, min_user_ts, max_user_ts)
 
-        if min_user_ts == 0 and max_user_ts == 0:
-            return ([], min_user_ts, max_user_ts)
+    def _fetch_listen_rows_for_multiple_users(self, user_names, from_ts, to_ts, limit, order):
+        """ Fetch the rows of the listens returned by fetch_listens_for_multiple_users_from_storage.
 
-        window_size = DEFAULT_FETCH_WINDOW
-        query = """SELECT listened_at, track_name, user_name, created, data
-                     FROM listen
-                    WHERE user_name IN :user_names
-                      AND listened_at > :from_ts
-                      AND listened_at < :to_ts
-                 ORDER BY listened_at """ + ORDER_TEXT[order] + " LIMIT :limit"
-
-        if from_ts and to_ts:
-            to_dynamic = False
-            from_dynamic = False
-        elif from_ts is not None:
-            to_ts = from_ts + window_size
-            to_dynamic = True
-            from_dynamic = False
-        else:
-            from_ts = to_ts - window_size
-            to_dynamic = False
-            from_dynamic = True
+            Returns: a tuple of (rows, min_user_timestamp, max_user_timestamp), the rows being
+                (listened_at, track_name, user_name, created, data, recording_msid) with the data as
+                JSON text, ordered by listened_at and track_name in the given order
+        """
+        user_timestamps = self.get_timestamps_for_users(user_names)
+        # users without listens have the timestamps 0, 0
+        user_timestamps = {user_name: (min_ts, max_ts) for user_name, (min_ts, max_ts) in user_timestamps.items()
+                           if max_ts}
+        if not user_timestamps:
+            return ([], 0, 0)
+        min_user_ts = min(min_ts for min_ts, _ in user_timestamps.values())
+        max_user_ts = max(max_ts for _, max_ts in user_timestamps.values())
 
-        listens = []
-        done = False
         with timescale.engine.connect() as connection:
             t0 = time.monotonic()
 
-            passes = 0
-            while True:
-                passes += 1
+            # the range of a single user is bounded on both ends with the day counts of the user, so
+            # that the scan of the user's listens stops at the range holding the next limit listens
+            if len(user_timestamps) == 1 and not (from_ts and to_ts):
+                if from_ts is not None:
+                    to_ts = self._get_fetch_range_end(connection, list(user_timestamps), from_ts, limit, max_user_ts)
+                else:
+                    if to_ts is None:
+                        to_ts = max_user_ts + 1
+                    from_ts = self._get_fetch_range_start(connection, list(user_timestamps), to_ts, limit, min_user_ts)
+
+            # each user's range ends at their own listens, users without listens in the range are skipped
+            user_ranges = []
+            for user_name, (min_ts, max_ts) in user_timestamps.items():
+                user_from_ts = min_ts - 1 if from_ts is None else max(math.floor(from_ts), min_ts - 1)
+                user_to_ts = max_ts + 1 if to_ts is None else min(math.ceil(to_ts), max_ts + 1)
+                if user_to_ts - user_from_ts > 1:
+                    user_ranges.append((user_name, user_from_ts, user_to_ts))
+
+            user_rows = self._fetch_listens_per_user(connection, user_ranges, limit, order)
+            rows = list(itertools.islice(_merge_listen_rows(user_rows, order), limit))
 
-                # Oh shit valve. I'm keeping it here for the time being. :)
-                if passes == 10:
-                    done = True
-                    break
+            fetch_listens_time = time.monotonic() - t0
 
-                curs = connection.execute(sqlalchemy.text(query), user_names=tuple(user_names),
-                                          from_ts=from_ts, to_ts=to_ts, limit=limit)
-                while True:
-                    result = curs.fetchone()
-                    if not result:
-                        if not to_dynamic and not from_dynamic:
-                            done = True
-                            break
+        self.log.info("fetch listens %s %.2fs" % (str(user_names), fetch_listens_time))
 
-                        if from_ts < min_user_ts - 1:
-                            done = True
-                            break
+        return (rows, min_user_ts, max_user_ts)
 
-                        if to_ts > int(time.time()) + ListenStore.MAX_FUTURE_SECONDS:
-                            done = True
-                            break
+    def _fetch_listens_per_user(self, connection, user_ranges, limit, order):
+        """ Fetch the first limit listens of each user in a range, with one index scan per user.
 
-                        if to_dynamic:
-                            from_ts += window_size - 1
-                            window_size *= WINDOW_SIZE_MULTIPLIER
-                            to_ts += window_size
+            Args:
+                user_ranges: list of (user_name, from_ts, to_ts), the listens of each user with
+                    from_ts < listened_at < to_ts are fetched
+                limit: the maximum number of listens of each user
+                order: ORDER_DESC or ORDER_ASC
 
-                        if from_dynamic:
-                            to_ts -= window_size
-                            window_size *= WINDOW_SIZE_MULTIPLIER
-                            from_ts -= window_size
+            Returns: a list of the (listened_at, track_name, user_name, created, data, recording_msid) rows
+                of each user, each ordered by listened_at and track_name in the given order
+        """
+        if not user_ranges:
+            return []
+
+        query = """SELECT l.listened_at, l.track_name, l.user_name, l.created, l.data::text AS data,
+                          l.recording_msid::text AS recording_msid
+                     FROM unnest(CAST(:user_names AS TEXT[]), CAST(:from_ts AS BIGINT[]), CAST(:to_ts AS BIGINT[]))
+                          AS u (user_name, from_ts, to_ts)
+               CROSS JOIN LATERAL (
+                          SELECT listened_at, track_name, user_name, created, data, recording_msid
+                            FROM listen
+                           WHERE listen.user_name = u.user_name
+                             AND listen.listened_at > u.from_ts
+                             AND listen.listened_at < u.to_ts
+                             AND listen.listened_at > :min_from_ts
+                             AND listen.listened_at < :max_to_ts
+                        ORDER BY listened_at %s, track_name %s
+                           LIMIT :limit
+                          ) AS l
+                 ORDER BY l.user_name, l.listened_at %s, l.track_name %s""" % (
+            ORDER_TEXT[order], ORDER_TEXT[1 - order], ORDER_TEXT[order], ORDER_TEXT[1 - order])
+
+        # the bounds of all ranges are repeated as constants, so that chunks outside of them are excluded
+        # when the query is planned
+        user_names, from_ts, to_ts = zip(*user_ranges)
+        result = connection.execute(sqlalchemy.text(query), user_names=list(user_names), from_ts=list(from_ts),
+                                    to_ts=list(to_ts), min_from_ts=min(from_ts), max_to_ts=max(to_ts),
+                                    limit=limit)
+        return [list(rows) for _, rows in itertools.groupby(result.fetchall(), key=lambda row: row["user_name"])]
+
+    def fetch_listens_after_cursor(self, user_name: str, listened_at: int, track_name: str, limit: int, order: int):
+        """ Fetch the listens of a user which follow a listen in the given direction, see
+            listenbrainz.listenstore.listens_cursor. The listens are found with a range scan starting
+            at the listen, so every page costs the same however far into the listens it is.
 
-                        break
+            Args:
+                user_name: the user to get listens for
+                listened_at: the listened_at of the listen to continue from
+                track_name: the track_name of the listen to continue from
+                limit: the maximum number of listens to return
+                order: ORDER_DESC for the older listens, ORDER_ASC for the newer listens
 
-                    listens.append(Listen.from_timescale(*result))
-                    if len(listens) == limit:
-                        done = True
-                        break
+            Returns: the listens, ordered by listened_at descending and track_name ascending
+        """
+        if order == ORDER_ASC:
+            condition = "listened_at >= :listened_at AND (listened_at > :listened_at OR track_name < :track_name)"
+        else:
+            condition = "listened_at <= :listened_at AND (listened_at < :listened_at OR track_name > :track_name)"
 
-                if done:
-                    break
+        # the data is parsed by Listen when it is needed, see Listen.from_timescale
+        query = """SELECT listened_at, track_name, user_name, created, data::text AS data,
+                          recording_msid::text AS recording_msid
+                     FROM listen
+                    WHERE user_name = :user_name
+                      AND %s
+                 ORDER BY listened_at %s, track_name %s
+                    LIMIT :limit""" % (condition, ORDER_TEXT[order], ORDER_TEXT[1 - order])
 
-            fetch_listens_time = time.monotonic() - t0
+        with timescale.engine.connect() as connection:
+            result = connection.execute(sqlalchemy.text(query), user_name=user_name, listened_at=listened_at,
+                                        track_name=track_name, limit=limit)
+            listens = [Listen.from_timescale(*row) for row in result.fetchall()]
 
         if order == ORDER_ASC:
             listens.reverse()
+        return listens
 
-        self.log.info("fetch listens %s %.2fs (%d passes)" %
-                      (str(user_names), fetch_listens_time, passes))
+    def _get_fetch_range_start(self, connection, user_names, to_ts, limit, min_user_ts):
+        """ Return the latest from_ts such that the listens of the users with from_ts < listened_at < to_ts
+            are at least limit listens or all listens before to_ts, using listen_user_day_count.
 
-        return (listens, min_user_ts, max_user_ts)
+            Only the days which end before to_ts are counted, as the count of the day of to_ts also
+            includes listens after to_ts.
+        """
+        query = """SELECT day
+                     FROM (SELECT day, sum(count) OVER (ORDER BY day DESC) AS listen_count
+                             FROM listen_user_day_count
+                            WHERE user_name IN :user_names
+                              AND day + :bucket_width <= :to_ts
+                          ) AS days
+                    WHERE listen_count >= :limit
+                 ORDER BY day DESC
+                    LIMIT 1"""
+        result = connection.execute(sqlalchemy.text(query), user_names=tuple(user_names), to_ts=to_ts,
+                                    limit=limit, bucket_width=LISTEN_DAY_COUNT_BUCKET_WIDTH)
+        row = result.fetchone()
+        if row is None:
+            return min_user_ts - 1
+        return row["day"] - 1
+
+    def _get_fetch_range_end(self, connection, user_names, from_ts, limit, max_user_ts):
+        """ Return the earliest to_ts such that the listens of the users with from_ts < listened_at < to_ts
+            are at least limit listens or all listens after from_ts, using listen_user_day_count.
+
+            Only the days which start after from_ts are counted, as the count of the day of from_ts
+            also includes listens before from_ts.
+        """
+        query = """SELECT day
+                     FROM (SELECT day, sum(count) OVER (ORDER BY day) AS listen_count
+                             FROM listen_user_day_count
+                            WHERE user_name IN :user_names
+                              AND day > :from_ts
+                          ) AS days
+                    WHERE listen_count >= :limit
+                 ORDER BY day
+                    LIMIT 1"""
+        result = connection.execute(sqlalchemy.text(query), user_names=tuple(user_names), from_ts=from_ts,
+                                    limit=limit)
+        row = result.fetchone()
+        if row is None:
+            return max_user_ts + 1
+        return row["day"] + LISTEN_DAY_COUNT_BUCKET_WIDTH
 
     def fetch_recent_listens_for_users(self, user_list, limit=2, max_age=3600):
         """ Fetch recent listens for a list of users, given a limit which applies per user. If you
@@ -410,30 +1004,16 @@ class TimescaleListenStore(ListenStore):
             max_age: Only return listens if they are no more than max_age seconds old. Default 3600 seconds
         """
 
-        args = {'user_list': tuple(user_list), 'ts': int(
-            time.time()) - max_age, 'limit': limit}
-        query = """SELECT * FROM (
-                              SELECT listened_at, track_name, user_name, created, data,
-                                     row_number() OVER (partition by user_name ORDER BY listened_at DESC) AS rownum
-                                FROM listen
-                               WHERE user_name IN :user_list
-                                 AND listened_at > :ts
-                            GROUP BY user_name, listened_at, track_name, created, data
-                            ORDER BY listened_at DESC) tmp
-                           WHERE rownum <= :limit"""
+        from_ts = int(time.time()) - max_age
+        # users whose latest listen is older than max_age are skipped without a scan
+        user_ranges = [(user_name, from_ts, max_ts + 1)
+                       for user_name, (_, max_ts) in self.get_timestamps_for_users(user_list).items()
+                       if max_ts > from_ts]
 
-        listens = []
         with timescale.engine.connect() as connection:
-            curs = connection.execute(sqlalchemy.text(query), args)
-            while True:
-                result = curs.fetchone()
-                if not result:
-                    break
+            user_rows = self._fetch_listens_per_user(connection, user_ranges, limit, ORDER_DESC)
 
-                listens.append(Listen.from_timescale(
-                    result[0], result[1], result[2], result[3], result[4]))
-
-        return listens
+        return [Listen.from_timescale(*row) for row in _merge_listen_rows(user_rows, ORDER_DESC)]
 
     def get_listens_query_for_dump(self, start_time, end_time):
         """
@@ -441,7 +1021,7 @@ class TimescaleListenStore(ListenStore):
             Use listened_at timestamp, since not all listens have the created timestamp.
         """
 
-        query = """SELECT listened_at, track_name, user_name, created, data
+        query = """SELECT listened_at, track_name, user_name, created, data::text AS data
                      FROM listen
                     WHERE listened_at >= :start_time
                       AND listened_at <= :end_time
@@ -459,7 +1039,7 @@ class TimescaleListenStore(ListenStore):
             This uses the `created` column to fetch listens.
         """
 
-        query = """SELECT listened_at, track_name, user_name, created, data
+        query = """SELECT listened_at, track_name, user_name, created, data::text AS data
                      FROM listen
                     WHERE created > :start_ts
                       AND created <= :end_ts
@@ -748,12 +1328,26 @@ class TimescaleListenStore(ListenStore):
         """
 
         self.set_empty_cache_values_for_user(musicbrainz_id)
+        self.mark_listens_deleted(musicbrainz_id)
         args = {'user_name': musicbrainz_id}
-        query = "DELETE FROM listen WHERE user_name = :user_name"
+        query = """DELETE FROM listen
+                    WHERE user_name = :user_name
+                      AND listened_at >= :first_day
+                      AND listened_at < :last_day_end"""
+        day_count_query = "DELETE FROM listen_user_day_count WHERE user_name = :user_name"
+        user_count_query = "DELETE FROM listen_user_metadata WHERE user_name = :user_name"
 
         try:
             with timescale.engine.connect() as connection:
-                connection.execute(sqlalchemy.text(query), args)
+                with connection.begin():
+                    day_range = self._get_listen_day_range(connection, musicbrainz_id)
+                    if day_range is not None:
+                        connection.execute(sqlalchemy.text(query), user_name=musicbrainz_id, first_day=day_range[0],
+                                           last_day_end=day_range[1] + LISTEN_DAY_COUNT_BUCKET_WIDTH)
+                    connection.execute(sqlalchemy.text(day_count_query), args)
+                    connection.execute(sqlalchemy.text(user_count_query), args)
+            self.invalidate_latest_listens_cache([musicbrainz_id])
+            invalidate_cached_user_metadata([musicbrainz_id])
         except psycopg2.OperationalError as e:
             self.log.error("Cannot delete listens for user: %s" % str(e))
             raise
@@ -772,13 +1366,41 @@ class TimescaleListenStore(ListenStore):
         query = """DELETE FROM listen
                     WHERE listened_at = :listened_at
                       AND user_name = :user_name
-                      AND data -> 'track_metadata' -> 'additional_info' ->> 'recording_msid' = :recording_msid """
+                      AND (recording_msid = :recording_msid
+                           OR recording_msid IS NULL
+                          AND data -> 'track_metadata' -> 'additional_info' ->> 'recording_msid' = :recording_msid)"""
+        day_count_query = """UPDATE listen_user_day_count
+                                SET count = count - :deleted
+                              WHERE user_name = :user_name
+                                AND day = :day"""
+        user_count_query = """UPDATE listen_user_metadata
+                                 SET count = count - :deleted
+                               WHERE user_name = :user_name
+                           RETURNING min_listened_at, max_listened_at"""
+        user_timestamps_query = """UPDATE listen_user_metadata
+                                      SET min_listened_at = :min_ts, max_listened_at = :max_ts
+                                    WHERE user_name = :user_name"""
 
         try:
+            self.mark_listens_deleted(user_name)
             with timescale.engine.connect() as connection:
-                connection.execute(sqlalchemy.text(query), args)
-
-            cache._r.decrby(cache._prep_key(REDIS_USER_LISTEN_COUNT + user_name))
+                with connection.begin():
+                    result = connection.execute(sqlalchemy.text(query), args)
+                    if result.rowcount:
+                        connection.execute(sqlalchemy.text(day_count_query), deleted=result.rowcount, user_name=user_name,
+                                           day=listened_at - listened_at % LISTEN_DAY_COUNT_BUCKET_WIDTH)
+                        row = connection.execute(sqlalchemy.text(user_count_query), deleted=result.rowcount,
+                                                 user_name=user_name).fetchone()
+                        timestamps_changed = row is not None and listened_at in (row["min_listened_at"],
+                                                                                 row["max_listened_at"])
+                        if timestamps_changed:
+                            connection.execute(sqlalchemy.text(user_timestamps_query), user_name=user_name,
+                                               min_ts=self._select_single_timestamp(connection, True, user_name),
+                                               max_ts=self._select_single_timestamp(connection, False, user_name))
+            self.invalidate_latest_listens_cache([user_name])
+
+            # read from listen_user_metadata the next time they are needed
+            invalidate_cached_user_metadata([user_name])
         except psycopg2.OperationalError as e:
             self.log.error("Cannot delete listen for user: %s" % str(e))
             raise TimescaleListenStoreException
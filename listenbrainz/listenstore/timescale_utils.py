@@ -1,3 +1,6 @@
+import math
+import random
+import statistics
 import time
 from collections import defaultdict
 from datetime import datetime, timedelta
@@ -11,7 +14,9 @@ from brainzutils import cache
 from listenbrainz.utils import init_cache
 from listenbrainz import db
 from listenbrainz.db import timescale
-from listenbrainz.listenstore.timescale_listenstore import REDIS_USER_LISTEN_COUNT, REDIS_USER_TIMESTAMPS, DATA_START_YEAR_IN_SECONDS
+from listenbrainz.listenstore import DEFAULT_LISTENS_PER_FETCH, ORDER_ASC, ORDER_DESC
+from listenbrainz.listenstore.timescale_listenstore import REDIS_USER_LISTEN_COUNT, REDIS_USER_TIMESTAMPS, DATA_START_YEAR_IN_SECONDS, \
+    LISTEN_DAY_COUNT_BUCKET_WIDTH, TimescaleListenStore, invalidate_cached_user_metadata
 from listenbrainz import config
 
 
@@ -19,6 +24,8 @@ logger = logging.getLogger(__name__)
 
 NUM_YEARS_TO_PROCESS_FOR_CONTINUOUS_AGGREGATE_REFRESH = 3
 SECONDS_IN_A_YEAR = 31536000
+# the chunk_time_interval of the listen hypertable, see admin/timescale/create_tables.sql
+LISTEN_CHUNK_TIME_INTERVAL = 432000
 
 
 def recalculate_all_user_data():
@@ -182,5 +189,175 @@ def refresh_listen_count_aggregate():
     unlock_cron()
 
 
+def rebuild_listen_user_metadata():
+    """
+        Recalculate the listen counts and timestamps of all users in listen_user_metadata. The counts
+        come from listen_user_day_count, which is maintained in the same transactions, and the
+        timestamps from the first and last day of listens of each user. The counts and timestamps
+        cached in redis which were wrong are removed so that they are read again. Inserts and deletes
+        of listens wait until the metadata is rebuilt.
+    """
+
+    timescale.init_db_connection(config.SQLALCHEMY_TIMESCALE_URI)
+    init_cache(host=config.REDIS_HOST, port=config.REDIS_PORT,
+               namespace=config.REDIS_NAMESPACE)
+
+    # the metadata of the users whose listens are being inserted or deleted is read after those
+    # transactions commit, and later transactions apply their changes to the rebuilt metadata
+    lock_query = "LOCK TABLE listen_user_metadata IN SHARE ROW EXCLUSIVE MODE"
+    query = """WITH days AS (
+                    SELECT user_name, sum(count) AS count,
+                           min(day) FILTER (WHERE count > 0) AS first_day,
+                           max(day) FILTER (WHERE count > 0) AS last_day
+                      FROM listen_user_day_count
+                  GROUP BY user_name
+               ), metadata AS (
+                    SELECT user_name, count,
+                           (SELECT min(listened_at)
+                              FROM listen
+                             WHERE listen.user_name = days.user_name
+                               AND listened_at >= first_day
+                               AND listened_at < first_day + :bucket_width) AS min_listened_at,
+                           (SELECT max(listened_at)
+                              FROM listen
+                             WHERE listen.user_name = days.user_name
+                               AND listened_at >= last_day
+                               AND listened_at < last_day + :bucket_width) AS max_listened_at
+                      FROM days
+               ), deleted AS (
+               DELETE FROM listen_user_metadata
+                     WHERE user_name NOT IN (SELECT user_name FROM metadata)
+                 RETURNING user_name
+               ), updated AS (
+               INSERT INTO listen_user_metadata (user_name, count, min_listened_at, max_listened_at)
+                    SELECT user_name, count, min_listened_at, max_listened_at
+                      FROM metadata
+               ON CONFLICT (user_name)
+             DO UPDATE SET count = EXCLUDED.count,
+                           min_listened_at = EXCLUDED.min_listened_at,
+                           max_listened_at = EXCLUDED.max_listened_at
+                     WHERE (listen_user_metadata.count, listen_user_metadata.min_listened_at, listen_user_metadata.max_listened_at)
+                           IS DISTINCT FROM (EXCLUDED.count, EXCLUDED.min_listened_at, EXCLUDED.max_listened_at)
+                 RETURNING user_name
+               )
+               SELECT user_name FROM deleted
+                UNION ALL
+               SELECT user_name FROM updated"""
+    t0 = time.monotonic()
+    try:
+        with timescale.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(sqlalchemy.text(lock_query))
+                result = connection.execute(sqlalchemy.text(query), bucket_width=LISTEN_DAY_COUNT_BUCKET_WIDTH)
+                user_names = [row["user_name"] for row in result]
+    except psycopg2.OperationalError as e:
+        logger.error("Cannot rebuild listen_user_metadata: %s" % str(e), exc_info=True)
+        raise
+
+    if user_names:
+        invalidate_cached_user_metadata(user_names)
+    logger.info("Rebuilt listen_user_metadata in %.2fs, corrected %d users" % (time.monotonic() - t0, len(user_names)))
+
+
+def backfill_recording_msids():
+    """
+        Fill in the recording_msid column of the listens which were inserted before it was added,
+        from the recording_msid in their data. The listens are updated one chunk of the listen
+        hypertable at a time, newest first, each in a transaction of its own, so that only the
+        inserts into the chunk being updated wait for it. Listens which already have a
+        recording_msid are skipped, so the backfill can be stopped and run again.
+    """
+
+    timescale.init_db_connection(config.SQLALCHEMY_TIMESCALE_URI)
+
+    range_query = "SELECT min(listened_at) AS min_ts, max(listened_at) AS max_ts FROM listen"
+    query = """UPDATE listen
+                  SET recording_msid = (data -> 'track_metadata' -> 'additional_info' ->> 'recording_msid')::uuid
+                WHERE listened_at >= :start_ts
+                  AND listened_at < :end_ts
+                  AND recording_msid IS NULL
+                  AND data -> 'track_metadata' -> 'additional_info' ->> 'recording_msid' IS NOT NULL"""
+    t0 = time.monotonic()
+    updated = 0
+    try:
+        with timescale.engine.connect() as connection:
+            row = connection.execute(sqlalchemy.text(range_query)).fetchone()
+            if row["min_ts"] is None:
+                logger.info("There are no listens to backfill")
+                return
+
+            end_ts = row["max_ts"] - row["max_ts"] % LISTEN_CHUNK_TIME_INTERVAL + LISTEN_CHUNK_TIME_INTERVAL
+            while end_ts > row["min_ts"]:
+                start_ts = end_ts - LISTEN_CHUNK_TIME_INTERVAL
+                with connection.begin():
+                    result = connection.execute(sqlalchemy.text(query), start_ts=start_ts, end_ts=end_ts)
+                updated += result.rowcount
+                logger.info("Backfilled %d listens from %s" % (result.rowcount, datetime.utcfromtimestamp(start_ts)))
+                end_ts = start_ts
+    except psycopg2.OperationalError as e:
+        logger.error("Cannot backfill recording_msids: %s" % str(e), exc_info=True)
+        raise
+
+    logger.info("Backfilled the recording_msids of %d listens in %.2fs" % (updated, time.monotonic() - t0))
+
+
+def benchmark_user_queries(user_count, runs):
+    """
+        Measure the latency of the queries of the listens of single users on a random sample of
+        users, grouped by the number of chunks of the listen hypertable their listens are spread
+        over, and log the median latency of each query in each group. Run it before and after
+        changing the layout or the indexes of the listen table to compare them.
+
+        Args:
+            user_count: the number of users in the sample
+            runs: how many times the queries are run for each user
+    """
+
+    ls = TimescaleListenStore({
+        'REDIS_HOST': config.REDIS_HOST,
+        'REDIS_PORT': config.REDIS_PORT,
+        'REDIS_NAMESPACE': config.REDIS_NAMESPACE,
+        'SQLALCHEMY_TIMESCALE_URI': config.SQLALCHEMY_TIMESCALE_URI,
+    }, logger)
+
+    query = """SELECT user_name, min(day) AS first_day, max(day) AS last_day,
+                      count(DISTINCT day - day % :chunk_time_interval) AS chunks
+                 FROM listen_user_day_count
+                WHERE count > 0
+             GROUP BY user_name"""
+    with timescale.engine.connect() as connection:
+        users = connection.execute(sqlalchemy.text(query), chunk_time_interval=LISTEN_CHUNK_TIME_INTERVAL).fetchall()
+    users = random.sample(users, min(user_count, len(users)))
+
+    def select_single_timestamp(select_min_timestamp, user_name):
+        with timescale.engine.connect() as connection:
+            return ls._select_single_timestamp(connection, select_min_timestamp, user_name)
+
+    queries = {
+        "min timestamp": lambda user: select_single_timestamp(True, user["user_name"]),
+        "max timestamp": lambda user: select_single_timestamp(False, user["user_name"]),
+        "latest listens": lambda user: ls.fetch_listens_for_multiple_users_from_storage(
+            [user["user_name"]], None, None, DEFAULT_LISTENS_PER_FETCH, ORDER_DESC),
+        "oldest listens": lambda user: ls.fetch_listens_for_multiple_users_from_storage(
+            [user["user_name"]], user["first_day"] - 1, None, DEFAULT_LISTENS_PER_FETCH, ORDER_ASC),
+    }
+
+    # the users are grouped by the power of 10 of their number of chunks
+    timings = defaultdict(lambda: defaultdict(list))
+    group_users = defaultdict(int)
+    for user in users:
+        group = 10 ** int(math.log10(user["chunks"]))
+        group_users[group] += 1
+        for name, run_query in queries.items():
+            for _ in range(runs):
+                t0 = time.monotonic()
+                run_query(user)
+                timings[group][name].append(time.monotonic() - t0)
+
+    for group in sorted(timings):
+        logger.info("%d-%d chunks, %d users: %s" % (group, group * 10 - 1, group_users[group], ", ".join(
+            "%s %.1fms" % (name, statistics.median(timings[group][name]) * 1000) for name in queries)))
+
+
 class TimescaleListenStoreException(Exception):
     pass
@@ -118,12 +118,14 @@ class MappingJobQueue(threading.Thread):
         # Load listens
         self.app.logger.info("Load more legacy listens for %s" % datetime.datetime.fromtimestamp(
             self.legacy_listens_index_date).strftime("%Y-%m-%d"))
-        query = """SELECT data->'track_metadata'->'additional_info'->>'recording_msid',
+        # listens which haven't been backfilled yet have no recording_msid column
+        query = """SELECT COALESCE(listen.recording_msid::text, data->'track_metadata'->'additional_info'->>'recording_msid'),
                           track_name,
                           data->'track_metadata'->'artist_name'
                      FROM listen
                 LEFT JOIN listen_mbid_mapping mbid
-                       ON data->'track_metadata'->'additional_info'->>'recording_msid' = mbid.recording_msid::text
+                       ON COALESCE(listen.recording_msid, (data->'track_metadata'->'additional_info'->>'recording_msid')::uuid)
+                          = mbid.recording_msid
                     WHERE mbid.match_type is null
                       AND listened_at <= :max_ts
                       AND listened_at > :min_ts"""
@@ -1,9 +1,9 @@
-import json
 import pika
 import time
 import threading
 
 from flask import current_app
+from listenbrainz import listen_codec
 from listenbrainz.webserver import create_app
 from listenbrainz.webserver.views.api_tools import LISTEN_TYPE_PLAYING_NOW
 from listenbrainz.mbid_mapping_writer.job_queue import MappingJobQueue
@@ -20,7 +20,7 @@ class MBIDMappingWriter(threading.Thread):
         self.queue = None
 
     def callback(self, channel, method, properties, body):
-        listens = json.loads(body)
+        listens = listen_codec.decode(body, properties)
         self.queue.add_new_listens(listens)
         channel.basic_ack(method.delivery_tag)
 
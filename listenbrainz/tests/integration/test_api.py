@@ -1,15 +1,19 @@
+import gzip
 import json
 import time
+from unittest.mock import patch
 
 import pytest
-from flask import url_for, current_app
+from flask import url_for, current_app, jsonify
 
 import listenbrainz.db.user as db_user
 import listenbrainz.db.user_relationship as db_user_relationship
 from listenbrainz import db
+from listenbrainz.listenstore import ORDER_ASC, ORDER_DESC
+from listenbrainz.listenstore.listens_cursor import encode_listens_cursor
 from listenbrainz.tests.integration import ListenAPIIntegrationTestCase
 from listenbrainz.webserver import timescale_connection
-from listenbrainz.webserver.views.api_tools import is_valid_uuid
+from listenbrainz.webserver.views.api_tools import is_valid_uuid, MAX_LISTEN_SIZE
 
 
 class APITestCase(ListenAPIIntegrationTestCase):
@@ -151,6 +155,31 @@ class APITestCase(ListenAPIIntegrationTestCase):
         self.assertEqual(data['count'], 0)
 
 
+    def test_get_listens_same_as_jsonify(self):
+        """ Test that the streamed listens have the same JSON as the listens serialized by jsonify """
+        with open(self.path_to_data_file('valid_import.json'), 'r') as f:
+            payload = json.load(f)
+        response = self.send_data(payload)
+        self.assert200(response)
+
+        user_name = self.user['musicbrainz_id']
+        url = url_for('api_v1.get_listens', user_name=user_name)
+        response = self.wait_for_query_to_have_items(url, len(payload['payload']))
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertTrue(response.data.endswith(b'\n'))
+
+        listens, _, max_ts = timescale_connection._ts.fetch_listens(user_name)
+        expected = jsonify({'payload': {
+            'user_id': user_name,
+            'count': len(listens),
+            'listens': [listen.to_api() for listen in listens],
+            'latest_listen_ts': max_ts,
+            'next_cursor': encode_listens_cursor(listens[-1], ORDER_DESC),
+            'previous_cursor': encode_listens_cursor(listens[0], ORDER_ASC),
+        }})
+        self.assertEqual(json.loads(response.data), json.loads(expected.data))
+
     def test_get_listens_order(self):
         """ Test to make sure that the api sends listens in valid order.
         """
@@ -890,3 +919,135 @@ class APITestCase(ListenAPIIntegrationTestCase):
     def test_unfollow_user_requires_login(self):
         r = self.client.post(url_for("social_api_v1.unfollow_user", user_name=self.followed_user["musicbrainz_id"]))
         self.assert401(r)
+
+    def send_import(self, lines, gzipped=True):
+        """ Sends newline delimited listens to api.import_listens and return the response """
+        data = "\n".join(lines).encode("utf-8")
+        headers = {'Authorization': 'Token {}'.format(self.user['auth_token'])}
+        if gzipped:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        return self.client.post(
+            url_for('api_v1.import_listens'),
+            data=data,
+            headers=headers,
+            content_type='application/x-ndjson'
+        )
+
+    @patch('listenbrainz.webserver.views.api.IMPORT_CHUNK_SIZE', 2)
+    def test_import_listens(self):
+        """ Test for a valid streaming import, split into chunks """
+        with open(self.path_to_data_file('valid_single.json'), 'r') as f:
+            listen = json.load(f)['payload'][0]
+        ts = int(time.time())
+        lines = []
+        for i in range(5):
+            listen['listened_at'] = ts - i
+            lines.append(json.dumps(listen))
+        lines.insert(2, "")
+
+        response = self.send_import(lines)
+        self.assert200(response)
+        self.assertEqual(response.json['status'], 'ok')
+        self.assertEqual(response.json['listens_imported'], 5)
+        self.assertEqual(response.json['chunks'], [
+            {'first_line': 1, 'last_line': 2, 'listens': 2},
+            {'first_line': 4, 'last_line': 5, 'listens': 2},
+            {'first_line': 6, 'last_line': 6, 'listens': 1},
+        ])
+
+        url = url_for('api_v1.get_listens', user_name=self.user['musicbrainz_id'])
+        response = self.wait_for_query_to_have_items(url, 5)
+        self.assertEqual(json.loads(response.data)['payload']['count'], 5)
+
+    def test_import_listens_uncompressed(self):
+        with open(self.path_to_data_file('valid_single.json'), 'r') as f:
+            listen = json.load(f)['payload'][0]
+        listen['listened_at'] = int(time.time())
+        response = self.send_import([json.dumps(listen)], gzipped=False)
+        self.assert200(response)
+        self.assertEqual(response.json['listens_imported'], 1)
+
+    @patch('listenbrainz.webserver.views.api.IMPORT_CHUNK_SIZE', 2)
+    def test_import_listens_invalid_line(self):
+        """ Listens of the chunks before an invalid listen are imported, the error reports where to resume """
+        with open(self.path_to_data_file('valid_single.json'), 'r') as f:
+            listen = json.load(f)['payload'][0]
+        listen['listened_at'] = int(time.time())
+        lines = [json.dumps(listen)] * 3
+        del listen['listened_at']
+        lines.append(json.dumps(listen))
+
+        response = self.send_import(lines)
+        self.assert400(response)
+        self.assertEqual(response.json['error'],
+                         'Line 4: JSON document must contain the key listened_at at the top level.')
+        self.assertEqual(response.json['line'], 4)
+        self.assertEqual(response.json['listens_imported'], 2)
+
+        response = self.send_import(["{not json"])
+        self.assert400(response)
+        self.assertTrue(response.json['error'].startswith('Line 1: cannot parse JSON document'))
+
+        for line in ['42', '["listened_at"]', 'null']:
+            response = self.send_import([line])
+            self.assert400(response)
+            self.assertEqual(response.json['error'], 'Line 1: listen must be a JSON object.')
+
+    @patch('listenbrainz.webserver.views.api.IMPORT_CHUNK_SIZE', 2)
+    def test_import_listens_submit_error(self):
+        """ A failed chunk submission reports the chunks already imported and the line to resume from """
+        with open(self.path_to_data_file('valid_single.json'), 'r') as f:
+            listen = json.load(f)['payload'][0]
+        ts = int(time.time())
+        lines = []
+        for i in range(5):
+            listen['listened_at'] = ts - i
+            lines.append(json.dumps(listen))
+
+        with patch('listenbrainz.webserver.views.api.insert_payload',
+                   side_effect=[None, Exception('unavailable')]):
+            response = self.send_import(lines)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json['line'], 3)
+        self.assertEqual(response.json['listens_imported'], 2)
+        self.assertEqual(response.json['chunks'], [{'first_line': 1, 'last_line': 2, 'listens': 2}])
+
+    def test_import_listens_crlf(self):
+        """ Lines ending in \r\n are counted once, also when the listen has the maximum size """
+        with open(self.path_to_data_file('valid_single.json'), 'r') as f:
+            listen = json.load(f)['payload'][0]
+        listen['listened_at'] = int(time.time())
+        listen['track_metadata']['additional_info']['padding'] = ''
+        padding = MAX_LISTEN_SIZE - len(json.dumps(listen).encode('utf-8'))
+        listen['track_metadata']['additional_info']['padding'] = 'x' * padding
+        line = json.dumps(listen)
+        self.assertEqual(len(line.encode('utf-8')), MAX_LISTEN_SIZE)
+        del listen['listened_at']
+
+        response = self.send_import([line + '\r', json.dumps(listen)])
+        self.assert400(response)
+        self.assertEqual(response.json['error'],
+                         'Line 2: JSON document must contain the key listened_at at the top level.')
+        self.assertEqual(response.json['line'], 2)
+
+        response = self.send_import([line + '\r', line + '\r', 'x' * (MAX_LISTEN_SIZE + 1) + '\r'])
+        self.assert400(response)
+        self.assertEqual(response.json['error'],
+                         'Line 3: listens may not be larger than %d characters.' % MAX_LISTEN_SIZE)
+
+    def test_import_listens_invalid_body(self):
+        response = self.send_import([])
+        self.assert400(response)
+        self.assertEqual(response.json['error'], 'Request body does not contain any listens')
+
+        response = self.client.post(
+            url_for('api_v1.import_listens'),
+            data=b'this is not gzip',
+            headers={'Authorization': 'Token {}'.format(self.user['auth_token']), 'Content-Encoding': 'gzip'},
+        )
+        self.assert400(response)
+
+        response = self.client.post(url_for('api_v1.import_listens'), data=b'{}',
+                                    headers={'Authorization': 'Token thisisinvalid'})
+        self.assert401(response)
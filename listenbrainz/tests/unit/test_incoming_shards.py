@@ -0,0 +1,33 @@
+import unittest
+
+from listenbrainz.incoming_shards import get_incoming_shard, get_incoming_shard_count, \
+    get_incoming_exchange_and_queue, group_listens_by_incoming_shard
+
+CONFIG = {"INCOMING_EXCHANGE": "incoming", "INCOMING_QUEUE": "incoming"}
+
+
+class IncomingShardsTestCase(unittest.TestCase):
+
+    def test_shard_count(self):
+        self.assertEqual(get_incoming_shard_count(CONFIG), 1)
+        self.assertEqual(get_incoming_shard_count({**CONFIG, "INCOMING_QUEUE_SHARDS": ""}), 1)
+        self.assertEqual(get_incoming_shard_count({**CONFIG, "INCOMING_QUEUE_SHARDS": "4"}), 4)
+
+    def test_shard_is_stable(self):
+        # the shard of a user must not change between processes and releases
+        self.assertEqual(get_incoming_shard("iliekcomputers", 4), 0)
+        self.assertEqual(get_incoming_shard("ishaanshah", 4), 2)
+        self.assertEqual(get_incoming_shard("ishaanshah", 1), 0)
+
+    def test_exchange_and_queue(self):
+        self.assertEqual(get_incoming_exchange_and_queue(CONFIG), ("incoming", "incoming"))
+        self.assertEqual(get_incoming_exchange_and_queue(CONFIG, 3), ("incoming.3", "incoming.3"))
+
+    def test_group_listens(self):
+        listens = [{"user_name": "iliekcomputers", "listened_at": 1}, {"user_name": "ishaanshah", "listened_at": 2},
+                   {"user_name": "iliekcomputers", "listened_at": 3}]
+        self.assertEqual(group_listens_by_incoming_shard(CONFIG, listens), [("incoming", "incoming", listens)])
+        self.assertEqual(group_listens_by_incoming_shard({**CONFIG, "INCOMING_QUEUE_SHARDS": 4}, listens), [
+            ("incoming.0", "incoming.0", [listens[0], listens[2]]),
+            ("incoming.2", "incoming.2", [listens[1]]),
+        ])
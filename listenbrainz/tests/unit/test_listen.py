@@ -1,6 +1,7 @@
+import json
 import unittest
-from listenbrainz.listen import Listen
-from datetime import datetime
+from listenbrainz.listen import Listen, listens_to_timescale_rows
+from datetime import datetime, timezone
 import time
 import uuid
 import ujson
@@ -97,7 +98,7 @@ class ListenTestCase(unittest.TestCase):
             }
         )
 
-        listened_at, track_name, user_name, data = listen.to_timescale()
+        listened_at, track_name, user_name, data, recording_msid = listen.to_timescale()
 
         # Check data is of type string
         self.assertIsInstance(data, str)
@@ -113,6 +114,7 @@ class ListenTestCase(unittest.TestCase):
         self.assertEqual(listened_at, listen.ts_since_epoch)
         self.assertEqual(track_name, listen.data['track_name'])
         self.assertEqual(user_name, listen.user_name)
+        self.assertEqual(recording_msid, listen.recording_msid)
         self.assertEqual(json_data['user_id'], listen.user_id)
         self.assertEqual(json_data['track_metadata']['artist_name'], listen.data['artist_name'])
 
@@ -146,3 +148,112 @@ class ListenTestCase(unittest.TestCase):
             }
         with self.assertRaises(ValueError):
             Listen.from_json(data)
+
+    def test_from_timescale_json_text(self):
+        """ Listens read with the JSON text of the data column equal those read with the parsed data """
+        data = {
+            "user_id": 1,
+            "track_metadata": {
+                "artist_name": "Majid Jordan",
+                "additional_info": {
+                    "artist_msid": "aa6130f2-a12d-47f3-8ffd-d0f71340de1f",
+                    "release_msid": "cf138a00-05d5-4b35-8fce-181efcc15785",
+                    "recording_msid": "db9a7483-a8f4-4a2c-99af-c8ab58850200",
+                    "tags": ["sing, song"],
+                }
+            }
+        }
+        parsed = Listen.from_timescale(1525557084, "Every Step Every Way", "iliekcomputers", None, ujson.loads(ujson.dumps(data)))
+        lazy = Listen.from_timescale(1525557084, "Every Step Every Way", "iliekcomputers", None, ujson.dumps(data))
+
+        self.assertEqual(lazy.to_api(), parsed.to_api())
+        self.assertEqual(lazy.to_timescale(), parsed.to_timescale())
+        self.assertEqual(lazy.timestamp, datetime.utcfromtimestamp(1525557084))
+        self.assertEqual(lazy.recording_msid, "db9a7483-a8f4-4a2c-99af-c8ab58850200")
+
+        # setting a field keeps the other fields of the stored data
+        lazy = Listen.from_timescale(1525557084, "Every Step Every Way", "iliekcomputers", None, ujson.dumps(data))
+        lazy.user_id = 2
+        self.assertEqual(lazy.user_id, 2)
+        self.assertEqual(lazy.data['track_name'], "Every Step Every Way")
+
+    def test_conversions_do_not_change_listen(self):
+        listen = Listen(
+            timestamp=1525557084,
+            user_name='testuser',
+            artist_msid=str(uuid.uuid4()),
+            recording_msid=str(uuid.uuid4()),
+            user_id=1,
+            data={
+                'artist_name': 'Radiohead',
+                'track_name': 'True Love Waits',
+                'additional_info': {'tags': ['rock']},
+            }
+        )
+        listen.to_timescale()
+        listen.to_api()
+        self.assertEqual(listen.data, {
+            'artist_name': 'Radiohead',
+            'track_name': 'True Love Waits',
+            'additional_info': {'tags': ['rock']},
+        })
+
+    def test_listens_to_timescale_rows(self):
+        listen = {
+            "listened_at": 1618353413,
+            "user_id": 1,
+            "user_name": "iliekcomputers",
+            "recording_msid": "db9a7483-a8f4-4a2c-99af-c8ab58850200",
+            "track_metadata": {
+                "artist_name": "Majid Jordan",
+                "track_name": "Every Step Every Way",
+                "additional_info": {"artist_msid": "aa6130f2-a12d-47f3-8ffd-d0f71340de1f", "nested": {"key": 1}},
+            },
+        }
+        null_listen = {**listen, "track_metadata": {**listen["track_metadata"], "additional_info": {"tags": "a\u0000b"}}}
+        original = ujson.loads(ujson.dumps(listen))
+
+        rows = listens_to_timescale_rows([listen, null_listen])
+        self.assertEqual(rows, [Listen.from_json(ujson.loads(ujson.dumps(listen))).to_timescale()])
+        self.assertEqual(listen, original)
+
+    def test_to_api_json(self):
+        recording_msid = "db9a7483-a8f4-4a2c-99af-c8ab58850200"
+        # the JSONB text of postgres for the data of the listen
+        stored_data = '{"user_id": 1, "track_metadata": {"artist_name": "Majid Jordan \u00e9/\\"", ' \
+                      '"release_name": null, "additional_info": {"tags": ["a", {"recording_msid": "x"}], ' \
+                      '"duration": 1.2345678901234, "artist_msid": "aa6130f2-a12d-47f3-8ffd-d0f71340de1f", ' \
+                      '"release_msid": null, "recording_msid": "db9a7483-a8f4-4a2c-99af-c8ab58850200"}}}'
+        created = datetime(2021, 5, 18, 10, 0, 0, tzinfo=timezone.utc)
+
+        listen = Listen.from_timescale(1525557084, "Every/Step \u2603", "iliekcomputers", created, stored_data,
+                                       recording_msid)
+        self.assertEqual(listen.to_api_json(),
+                         '{"track_metadata":{"artist_name": "Majid Jordan \u00e9/\\"", "release_name": null, '
+                         '"additional_info": {"tags": ["a", {"recording_msid": "x"}], "duration": 1.2345678901234, '
+                         '"artist_msid": "aa6130f2-a12d-47f3-8ffd-d0f71340de1f", "release_msid": null, '
+                         '"recording_msid": "db9a7483-a8f4-4a2c-99af-c8ab58850200"},'
+                         '"track_name":"Every/Step \\u2603"},"listened_at":1525557084,'
+                         '"recording_msid":"db9a7483-a8f4-4a2c-99af-c8ab58850200","user_name":"iliekcomputers",'
+                         '"inserted_at":"Tue, 18 May 2021 10:00:00 GMT"}')
+        # the stored data was spliced into the JSON without being parsed
+        self.assertIsNotNone(listen._stored_data)
+
+        # the JSON has the same value as the api serialization of to_api for data in every form in which
+        # it is read from the listenstore, and for listens whose data cannot be spliced
+        data = json.loads(stored_data)
+        variants = [
+            (stored_data, recording_msid),
+            (ujson.dumps(data), recording_msid),
+            (stored_data.encode("utf-8"), recording_msid),
+            (stored_data, None),
+            ('{"track_metadata": {"additional_info": {}}, "user_id": "1"}', recording_msid),
+        ]
+        for j, msid in variants:
+            for inserted_at in (created, None):
+                listen = Listen.from_timescale(1525557084, "Every/Step \u2603", "iliekcomputers", inserted_at, j, msid)
+                expected = Listen.from_timescale(1525557084, "Every/Step \u2603", "iliekcomputers", inserted_at,
+                                                 json.loads(j)).to_api()
+                if inserted_at is not None:
+                    expected['inserted_at'] = "Tue, 18 May 2021 10:00:00 GMT"
+                self.assertEqual(json.loads(listen.to_api_json()), expected)
@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from listenbrainz import listen_codec
+from listenbrainz.listen_augmenter import listen_augmenter
+from listenbrainz.listen_augmenter.listen_augmenter import ListenAugmenter
+from listenbrainz.webserver import create_app
+from listenbrainz.webserver.errors import APIBadRequest, APIServiceUnavailable
+
+
+def _message(delivery_tag, count):
+    listens = [{"listened_at": i, "user_id": 1, "user_name": "iliekcomputers",
+                "track_metadata": {"artist_name": "Kanye West", "track_name": "Fade", "additional_info": {}}}
+               for i in range(count)]
+    body, properties = listen_codec.encode(listens)
+    return MagicMock(delivery_tag=delivery_tag), properties, body
+
+
+class ListenAugmenterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.augmenter = ListenAugmenter()
+        self.augmenter.raw_ch = MagicMock()
+        self.augmenter.incoming_ch = MagicMock()
+
+    @patch.object(listen_augmenter, "BATCH_SIZE", 5)
+    @patch("listenbrainz.listen_augmenter.listen_augmenter.get_augmented_listens", side_effect=lambda listens: listens)
+    def test_batching(self, mock_augment):
+        with self.app.app_context():
+            self.augmenter.add_message(*_message(1, 2))
+            self.augmenter.add_message(*_message(2, 2))
+            mock_augment.assert_not_called()
+
+            self.augmenter.add_message(*_message(3, 2))
+            mock_augment.assert_called_once()
+            self.assertEqual(len(mock_augment.call_args[0][0]), 6)
+            self.augmenter.incoming_ch.basic_publish.assert_called_once()
+            self.augmenter.raw_ch.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+            self.assertEqual(self.augmenter.messages, [])
+
+    @patch("listenbrainz.listen_augmenter.listen_augmenter.get_augmented_listens")
+    def test_bad_message_is_dropped(self, mock_augment):
+        def augment(listens):
+            if len(listens) != 1:
+                raise APIBadRequest("bad listen")
+            return listens
+        mock_augment.side_effect = augment
+
+        with self.app.app_context():
+            self.augmenter.add_message(*_message(1, 1))
+            self.augmenter.add_message(*_message(2, 2))
+            self.augmenter.process_batch()
+
+            call_kwargs = self.augmenter.incoming_ch.basic_publish.call_args[1]
+            published = listen_codec.decode(call_kwargs["body"], call_kwargs["properties"])
+            self.assertEqual(len(published), 1)
+            self.assertEqual(self.augmenter.dropped_listens, 2)
+            self.augmenter.raw_ch.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+    @patch("listenbrainz.listen_augmenter.listen_augmenter.sleep", return_value=None)
+    @patch("listenbrainz.listen_augmenter.listen_augmenter.get_augmented_listens",
+           side_effect=APIServiceUnavailable("MessyBrainz is down"))
+    def test_messybrainz_error_requeues_batch(self, mock_augment, mock_sleep):
+        with self.app.app_context():
+            self.augmenter.add_message(*_message(1, 1))
+            self.augmenter.add_message(*_message(2, 1))
+            self.augmenter.process_batch()
+
+            self.augmenter.incoming_ch.basic_publish.assert_not_called()
+            self.augmenter.raw_ch.basic_nack.assert_called_once_with(delivery_tag=2, multiple=True, requeue=True)
+            self.assertEqual(self.augmenter.messages, [])
@@ -0,0 +1,68 @@
+import unittest
+import zlib
+from datetime import datetime
+
+import msgpack
+import pika
+
+from listenbrainz import listen_codec
+from listenbrainz.listen import Listen
+
+
+class ListenCodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listens = [{
+            "listened_at": 1618500200,
+            "user_id": 1,
+            "user_name": "iliekcomputers",
+            "recording_msid": "c7a41965-9f1e-456c-8b1d-27c0f0dde280",
+            "track_metadata": {
+                "artist_name": "Kanye West",
+                "track_name": "Fade",
+                "additional_info": {"artist_msid": "8a3a1ade-bfc6-4b69-8d4a-2b11ef1e5ddd", "tags": ["rap", "hip hop"]},
+            },
+        }]
+
+    def test_json_round_trip(self):
+        body, properties = listen_codec.encode(self.listens, listen_codec.JSON_CODEC)
+        self.assertEqual(properties.content_type, listen_codec.JSON_CONTENT_TYPE)
+        self.assertEqual(properties.delivery_mode, 2)
+        self.assertEqual(listen_codec.decode(body, properties), self.listens)
+
+    def test_msgpack_round_trip(self):
+        body, properties = listen_codec.encode(self.listens, listen_codec.MSGPACK_CODEC)
+        self.assertEqual(properties.content_type, listen_codec.MSGPACK_CONTENT_TYPE)
+        self.assertEqual(properties.content_encoding, listen_codec.ZLIB_CONTENT_ENCODING)
+        self.assertEqual(properties.delivery_mode, 2)
+        self.assertEqual(msgpack.unpackb(zlib.decompress(body), raw=False), self.listens)
+        self.assertEqual(listen_codec.decode(body, properties), self.listens)
+
+    def test_decode_messages_without_content_type(self):
+        """ Messages published before content types were introduced are JSON """
+        body = b'[{"listened_at": 1618500200}]'
+        self.assertEqual(listen_codec.decode(body, pika.BasicProperties(delivery_mode=2)), [{"listened_at": 1618500200}])
+        self.assertEqual(listen_codec.decode(body), [{"listened_at": 1618500200}])
+
+    def test_unknown_formats(self):
+        with self.assertRaises(ValueError):
+            listen_codec.encode(self.listens, "xml")
+        with self.assertRaises(ValueError):
+            listen_codec.decode(b"", pika.BasicProperties(content_type="application/xml"))
+        with self.assertRaises(ValueError):
+            listen_codec.decode(b"", pika.BasicProperties(content_type=listen_codec.JSON_CONTENT_TYPE,
+                                                          content_encoding="zstd"))
+
+    def test_msgpack_listen_objects(self):
+        """ Listen objects and datetimes are encoded like ujson encodes them """
+        listen = Listen.from_json(self.listens[0])
+        body, properties = listen_codec.encode([listen], listen_codec.MSGPACK_CODEC)
+        decoded = listen_codec.decode(body, properties)[0]
+        self.assertEqual(decoded["user_name"], "iliekcomputers")
+        self.assertEqual(decoded["recording_msid"], "c7a41965-9f1e-456c-8b1d-27c0f0dde280")
+        self.assertEqual(decoded["timestamp"], 1618500200)
+        self.assertEqual(decoded["ts_since_epoch"], 1618500200)
+        self.assertEqual(decoded["data"]["track_name"], "Fade")
+        self.assertNotIn("to_json", decoded)
+
+        self.assertEqual(listen_codec._encode_object(datetime(2021, 4, 15, 15, 23, 20)), 1618500200)
@@ -0,0 +1,114 @@
+import random
+import time
+import unittest
+import uuid
+from copy import deepcopy
+
+from listenbrainz.webserver import create_app
+from listenbrainz.webserver.views.api_tools import validate_listen, validate_listens, LISTEN_TYPE_SINGLE, \
+    LISTEN_TYPE_IMPORT, LISTEN_TYPE_PLAYING_NOW, MAX_TAGS_PER_LISTEN, MAX_TAG_SIZE
+
+MBID = "a22fb4c6-1d4b-4b57-bd9e-2a0c4a6b9e55"
+
+# values of a field, chosen to hit every branch of validate_listen
+STRING_VALUES = ["Fade", "  Fade ", "", "   ", None, 1, ["Fade"], {"name": "Fade"}]
+TIMESTAMP_VALUES = [1618500200, "1618500200", 1618500200.5, "1618500200.5", "abc", None, True,
+                    int(time.time()) + 10 * 24 * 60 * 60]
+TAG_VALUES = [["rock"], [], ["rock", "x" * MAX_TAG_SIZE], ["x" * (MAX_TAG_SIZE + 1)],
+              ["tag"] * (MAX_TAGS_PER_LISTEN + 1), "rock", None, [1], {}]
+SINGLE_MBID_VALUES = [MBID, MBID.upper(), MBID.replace("-", ""), "{%s}" % MBID, "urn:uuid:" + MBID,
+                      MBID + "\n", MBID[:-1], "not an mbid", "", None, 0, 1, [MBID], "%s-%s" % (MBID[:3], MBID[3:])]
+MULTIPLE_MBID_VALUES = [[MBID], [MBID, None, ""], [MBID, "not an mbid"], [], None, "", MBID, [None], [1], 1,
+                        {MBID: 1}]
+
+
+def _pick(rng, values):
+    """ Pick the first, valid value most of the time and any of the values otherwise """
+    return deepcopy(values[0] if rng.random() < 0.8 else rng.choice(values))
+
+
+def _random_listen(rng):
+    """ Build a random listen, most of them valid and the rest broken in one or a few ways """
+    track_metadata = {
+        "artist_name": _pick(rng, STRING_VALUES),
+        "track_name": _pick(rng, STRING_VALUES),
+    }
+    for key in ("artist_name", "track_name"):
+        if rng.random() < 0.05:
+            del track_metadata[key]
+
+    if rng.random() < 0.8:
+        additional_info = {}
+        if rng.random() < 0.3:
+            additional_info["tags"] = _pick(rng, TAG_VALUES)
+        for key in ("release_mbid", "recording_mbid", "release_group_mbid", "track_mbid"):
+            if rng.random() < 0.3:
+                additional_info[key] = _pick(rng, SINGLE_MBID_VALUES)
+        for key in ("artist_mbids", "work_mbids"):
+            if rng.random() < 0.3:
+                additional_info[key] = _pick(rng, MULTIPLE_MBID_VALUES)
+        if rng.random() < 0.2:
+            additional_info["spotify_id"] = "https://open.spotify.com/track/1"
+        if rng.random() < 0.03:
+            additional_info = rng.choice([None, "tags", ["tags"], 1])
+        track_metadata["additional_info"] = additional_info
+
+    listen = {"track_metadata": track_metadata}
+    if rng.random() < 0.7:
+        listen["listened_at"] = _pick(rng, TIMESTAMP_VALUES)
+    if rng.random() < 0.05:
+        listen["extra"] = 1
+    if rng.random() < 0.03:
+        del listen["track_metadata"]
+    if rng.random() < 0.03:
+        listen["track_metadata"] = rng.choice([None, "track_name", ["track_name", "artist_name"]])
+    if rng.random() < 0.02:
+        listen = rng.choice([None, [], "listened_at"])
+    return listen
+
+
+def _outcome(validate, listen):
+    """ Run a validator and return its result or the details of the exception it raised """
+    try:
+        return "ok", validate(listen)
+    except Exception as e:
+        return type(e).__name__, getattr(e, "message", None), getattr(e, "payload", None), listen
+
+
+class ListenValidationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+
+    def test_validate_listens_matches_validate_listen(self):
+        """ The fast validator must accept, reject and mutate listens exactly like validate_listen """
+        rng = random.Random(20210415)
+        with self.app.app_context():
+            for _ in range(20000):
+                listen = _random_listen(rng)
+                for listen_type in (LISTEN_TYPE_SINGLE, LISTEN_TYPE_IMPORT, LISTEN_TYPE_PLAYING_NOW, "listens"):
+                    expected = _outcome(lambda l: validate_listen(l, listen_type), deepcopy(listen))
+                    actual = _outcome(lambda l: validate_listens([l], listen_type)[0], deepcopy(listen))
+                    self.assertEqual(expected, actual, "listen: %r, listen_type: %r" % (listen, listen_type))
+
+    def test_validate_listens_reports_first_invalid_listen(self):
+        listens = [
+            {"listened_at": 1618500200, "track_metadata": {"artist_name": "Kanye West", "track_name": "Fade"}},
+            {"listened_at": 1618500200, "track_metadata": {"artist_name": "Kanye West", "track_name": ""}},
+            {"listened_at": 1618500200, "track_metadata": {"artist_name": "", "track_name": "Fade"}},
+        ]
+        with self.app.app_context():
+            status, message, _, _ = _outcome(lambda l: validate_listens(l, LISTEN_TYPE_IMPORT), listens)
+        self.assertEqual(status, "APIBadRequest")
+        self.assertEqual(message, "required field track_metadata.track_name is empty.")
+
+    def test_mbid_forms(self):
+        """ All forms of UUIDs accepted by uuid.UUID are valid MBIDs """
+        mbid = uuid.uuid4()
+        with self.app.app_context():
+            for form in (str(mbid), mbid.hex, mbid.urn, "{%s}" % mbid, str(mbid).upper()):
+                listen = {"listened_at": 1618500200, "track_metadata": {
+                    "artist_name": "Kanye West", "track_name": "Fade",
+                    "additional_info": {"recording_mbid": form, "artist_mbids": [form]},
+                }}
+                validate_listens([listen], LISTEN_TYPE_SINGLE)
@@ -0,0 +1,21 @@
+import unittest
+
+from listenbrainz.listen import Listen
+from listenbrainz.listenstore import ORDER_ASC, ORDER_DESC
+from listenbrainz.listenstore.listens_cursor import encode_listens_cursor, decode_listens_cursor
+
+
+class ListensCursorTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        listen = Listen(timestamp=1618500200, data={"artist_name": "Kanye West", "track_name": "Fade ü/+?",
+                                                    "additional_info": {}})
+        for order in (ORDER_ASC, ORDER_DESC):
+            cursor = encode_listens_cursor(listen, order)
+            self.assertRegex(cursor, r"^[A-Za-z0-9_-]+$")
+            self.assertEqual(decode_listens_cursor(cursor), (1618500200, "Fade ü/+?", order))
+
+    def test_invalid_cursor(self):
+        for cursor in ("", "abc", "!!!", "WzAsIDEsIDJd", "WzIsIDE2MTg1MDAyMDAsICJGYWRlIl0", "WzAsICIxIiwgIkZhZGUiXQ"):
+            with self.assertRaises(ValueError):
+                decode_listens_cursor(cursor)
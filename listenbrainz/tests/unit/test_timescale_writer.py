@@ -0,0 +1,279 @@
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import psycopg2
+
+from listenbrainz import listen_codec
+from listenbrainz.listen import Listen
+from listenbrainz.timescale_writer import timescale_writer
+from listenbrainz.listenstore.timescale_listenstore import INSERT_METHOD_COPY
+from listenbrainz.timescale_writer.recent_listens import RecentListensFilter
+from listenbrainz.timescale_writer.spool import ListenSpool
+from listenbrainz.timescale_writer.timescale_writer import TimescaleWriterSubscriber, LISTEN_INSERT_ERROR_SENTINEL
+from listenbrainz.webserver import create_app
+
+
+RECORDING_MSID = "c7a41965-9f1e-456c-8b1d-27c0f0dde280"
+
+
+def _row(listened_at):
+    """ A listen row in the shape produced by Listen.to_timescale """
+    return list(Listen.from_json({
+        "listened_at": listened_at, "user_id": 1, "user_name": "iliekcomputers", "recording_msid": RECORDING_MSID,
+        "track_metadata": {"artist_name": "Kanye West", "track_name": "Fade", "additional_info": {}},
+    }).to_timescale())
+
+
+def _message(delivery_tag, count):
+    listens = [{"listened_at": 1618500200 + delivery_tag * 100 + i, "user_id": 1, "user_name": "iliekcomputers",
+                "recording_msid": RECORDING_MSID,
+                "track_metadata": {"artist_name": "Kanye West", "track_name": "Fade", "additional_info": {}}}
+               for i in range(count)]
+    body, properties = listen_codec.encode(listens)
+    return MagicMock(delivery_tag=delivery_tag), properties, body
+
+
+class TimescaleWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.writer = TimescaleWriterSubscriber()
+        self.writer.incoming_ch = MagicMock()
+
+    @patch.object(timescale_writer, "BATCH_SIZE", 5)
+    @patch.object(TimescaleWriterSubscriber, "insert_to_listenstore", side_effect=lambda listens: len(listens))
+    def test_batching(self, mock_insert):
+        with self.app.app_context():
+            self.assertEqual(self.writer.add_message(*_message(1, 2)), 0)
+            self.assertEqual(self.writer.add_message(*_message(2, 2)), 0)
+            mock_insert.assert_not_called()
+
+            self.assertEqual(self.writer.add_message(*_message(3, 2)), 6)
+            mock_insert.assert_called_once()
+            self.assertEqual(len(mock_insert.call_args[0][0]), 6)
+            self.writer.incoming_ch.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+            self.assertEqual(self.writer.batch, [])
+
+            # nothing to do until the next message arrives
+            self.assertEqual(self.writer.process_batch(), 0)
+            mock_insert.assert_called_once()
+
+    @patch.object(timescale_writer, "BATCH_TIMEOUT", 10)
+    @patch.object(TimescaleWriterSubscriber, "insert_to_listenstore", side_effect=lambda listens: len(listens))
+    @patch("listenbrainz.timescale_writer.timescale_writer.monotonic")
+    def test_batch_timeout(self, mock_monotonic, mock_insert):
+        with self.app.app_context():
+            mock_monotonic.return_value = 100
+            self.writer.add_message(*_message(1, 1))
+            mock_monotonic.return_value = 109
+            self.writer.add_message(*_message(2, 1))
+            mock_insert.assert_not_called()
+
+            mock_monotonic.return_value = 110
+            self.writer.add_message(*_message(3, 1))
+            self.assertEqual(len(mock_insert.call_args[0][0]), 3)
+            self.writer.incoming_ch.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+    @patch.object(TimescaleWriterSubscriber, "insert_to_listenstore", return_value=LISTEN_INSERT_ERROR_SENTINEL)
+    def test_insert_error_requeues_batch(self, mock_insert):
+        with self.app.app_context():
+            self.writer.add_message(*_message(1, 1))
+            self.writer.add_message(*_message(2, 1))
+            self.assertEqual(self.writer.process_batch(), LISTEN_INSERT_ERROR_SENTINEL)
+
+            self.writer.incoming_ch.basic_ack.assert_not_called()
+            self.writer.incoming_ch.basic_nack.assert_called_once_with(delivery_tag=2, multiple=True, requeue=True)
+            self.assertEqual(self.writer.batch, [])
+
+    @patch.object(TimescaleWriterSubscriber, "insert_to_listenstore", side_effect=lambda rows: len(rows))
+    def test_rows_message(self, mock_insert):
+        rows = [[1618500200, "Fade", "iliekcomputers", '{"user_id": 1, "track_metadata": {}}', RECORDING_MSID]]
+        body, properties = listen_codec.encode(rows)
+        properties.type = listen_codec.TIMESCALE_ROWS_MESSAGE_TYPE
+        with self.app.app_context():
+            self.writer.add_message(MagicMock(delivery_tag=1), properties, body)
+            self.writer.add_message(*_message(2, 1))
+            self.writer.process_batch()
+
+        batch = mock_insert.call_args[0][0]
+        self.assertEqual(batch[0], rows[0])
+        # listens of messages without a type are converted to rows by the writer
+        self.assertEqual(tuple(batch[1][:3]), (1618500400, "Fade", "iliekcomputers"))
+
+    def test_unique_listens(self):
+        self.writer.ls = MagicMock()
+        self.writer.unique_ch = MagicMock()
+        self.writer.redis_listenstore = MagicMock()
+        data = '{"user_id": 1, "track_metadata": {"artist_name": "Kanye West", "additional_info": {"recording_msid": "%s"}}}'
+        rows = [
+            _row(1618500200),
+            _row(1618500300),
+            _row(1618500300),
+            # rows spooled before the recording_msid column was added
+            [1618500400, "Fade", "iliekcomputers", data % RECORDING_MSID],
+        ]
+        self.writer.ls.insert_rows.return_value = [(1618500300, "Fade", "iliekcomputers"),
+                                                   (1618500400, "Fade", "iliekcomputers")]
+        self.app.config["LISTEN_MESSAGE_CODEC"] = listen_codec.MSGPACK_CODEC
+        with self.app.app_context():
+            self.assertEqual(self.writer.insert_to_listenstore(rows), 4)
+
+        unique = self.writer.redis_listenstore.update_for_inserted_listens.call_args[1]["unique"]
+        self.assertEqual(len(unique), 2)
+        self.assertEqual(unique[1].ts_since_epoch, 1618500400)
+        self.assertEqual(unique[1].recording_msid, RECORDING_MSID)
+        self.assertEqual(unique[0].ts_since_epoch, 1618500300)
+        self.assertEqual(unique[0].recording_msid, RECORDING_MSID)
+        self.assertEqual(unique[0].data["track_name"], "Fade")
+        self.assertEqual(unique[0].data["artist_name"], "Kanye West")
+        call_kwargs = self.writer.unique_ch.basic_publish.call_args[1]
+        published = listen_codec.decode(call_kwargs["body"], call_kwargs["properties"])
+        self.assertEqual(published[0]["recording_msid"], RECORDING_MSID)
+        self.assertEqual(published[0]["ts_since_epoch"], 1618500300)
+
+    def test_recent_duplicates_are_dropped(self):
+        self.writer.ls = MagicMock()
+        self.writer.ls.insert_rows.return_value = []
+        self.writer.ls.get_users_with_deleted_listens.return_value = set()
+        self.writer.recent_listens = RecentListensFilter(window=3600, max_size=100)
+        rows = [_row(1618500200), _row(1618500300)]
+        with self.app.app_context():
+            self.assertEqual(self.writer.insert_to_listenstore(rows), 2)
+            self.assertEqual(self.writer.ls.insert_rows.call_args[0][0], rows)
+
+            # the written listens are not sent to the listenstore again
+            new_row = _row(1618500400)
+            self.assertEqual(self.writer.insert_to_listenstore(rows + [new_row]), 3)
+            self.assertEqual(self.writer.ls.insert_rows.call_args[0][0], [new_row])
+            self.assertEqual(self.writer.duplicate_listens, 2)
+
+            self.writer.ls.insert_rows.reset_mock()
+            self.assertEqual(self.writer.insert_to_listenstore(rows), 2)
+            self.writer.ls.insert_rows.assert_not_called()
+            self.assertEqual(self.writer.duplicate_listens, 4)
+
+            # all listens of users whose listens were deleted go to the listenstore
+            self.writer.ls.get_users_with_deleted_listens.return_value = {"iliekcomputers"}
+            self.writer.insert_to_listenstore(rows)
+            self.assertEqual(self.writer.ls.insert_rows.call_args[0][0], rows)
+            self.assertEqual(self.writer.duplicate_listens, 4)
+
+    def test_failed_insert_is_not_remembered(self):
+        self.writer.ls = MagicMock()
+        self.writer.ls.insert_rows.side_effect = psycopg2.OperationalError
+        self.writer.recent_listens = RecentListensFilter(window=3600, max_size=100)
+        self.writer.ERROR_RETRY_DELAY = 0
+        rows = [_row(1618500200)]
+        with self.app.app_context():
+            self.assertEqual(self.writer.insert_to_listenstore(rows), LISTEN_INSERT_ERROR_SENTINEL)
+        self.assertEqual(len(self.writer.recent_listens), 0)
+
+    @patch("listenbrainz.timescale_writer.timescale_writer.monotonic")
+    def test_spool(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.writer.ls = MagicMock()
+        self.writer.ls.insert_rows.side_effect = psycopg2.OperationalError
+        self.writer.unique_ch = MagicMock()
+        self.writer.redis_listenstore = MagicMock()
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.writer.spool = ListenSpool(spool_dir.name, segment_max_listens=2)
+        self.app.config["LISTEN_MESSAGE_CODEC"] = listen_codec.MSGPACK_CODEC
+        with self.app.app_context():
+            # the batch is spooled and its messages are acked
+            self.writer.add_message(*_message(1, 2))
+            self.assertEqual(self.writer.process_batch(), 2)
+            self.writer.incoming_ch.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+            self.assertEqual(self.writer.ls.insert_rows.call_count, 1)
+
+            # later batches go to the spool without trying timescale until ERROR_RETRY_DELAY has passed
+            self.writer.add_message(*_message(2, 1))
+            self.writer.process_batch()
+            self.writer.add_message(*_message(3, 1))
+            self.writer.process_batch()
+            self.assertEqual(self.writer.ls.insert_rows.call_count, 1)
+            self.assertEqual(self.writer.spooled_listens, 4)
+
+            # the spool is drained in order, one segment at a time, once timescale is back
+            self.writer.ls.insert_rows.side_effect = None
+            self.writer.ls.insert_rows.return_value = [(1618500300, "Fade", "iliekcomputers")]
+            mock_monotonic.return_value = 100 + self.writer.ERROR_RETRY_DELAY
+            self.assertEqual(self.writer.process_batch(), 0)
+            rows = self.writer.ls.insert_rows.call_args[0][0]
+            self.assertEqual([row[0] for row in rows], [1618500300, 1618500301])
+            self.assertEqual(self.writer.ls.insert_rows.call_args[1]["method"], INSERT_METHOD_COPY)
+            unique = self.writer.redis_listenstore.update_for_inserted_listens.call_args[1]["unique"]
+            self.assertEqual([(listen.ts_since_epoch, listen.recording_msid) for listen in unique],
+                             [(1618500300, RECORDING_MSID)])
+            self.writer.ls.insert_rows.return_value = []
+
+            self.writer.process_batch()
+            rows = self.writer.ls.insert_rows.call_args[0][0]
+            self.assertEqual([row[0] for row in rows], [1618500400, 1618500500])
+            self.assertTrue(self.writer.spool.is_empty())
+
+            # with an empty spool, batches are inserted directly again
+            self.writer.add_message(*_message(4, 1))
+            self.writer.process_batch()
+            self.assertIsNone(self.writer.ls.insert_rows.call_args[1]["method"])
+            self.assertEqual(self.writer.spooled_listens, 4)
+
+
+class ListenSpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+
+    def test_segments(self):
+        spool = ListenSpool(self.spool_dir, segment_max_listens=3)
+        self.assertTrue(spool.is_empty())
+        spool.append([[1, "Fade", "iliekcomputers", "{}"], [2, "Fade", "iliekcomputers", '{"a": "\\n"}']])
+        spool.append([[3, "Fade", "iliekcomputers", "{}"]])
+        spool.append([[4, "Fade", "iliekcomputers", "{}"]])
+
+        # a spool opened later, e.g. after a restart, holds the same segments
+        spool = ListenSpool(self.spool_dir, segment_max_listens=3)
+        segment, rows = spool.read_oldest()
+        self.assertEqual([row[0] for row in rows], [1, 2, 3])
+        self.assertEqual(rows[1][3], '{"a": "\\n"}')
+        spool.remove(segment)
+
+        spool.append([[5, "Fade", "iliekcomputers", "{}"]])
+        segment, rows = spool.read_oldest()
+        self.assertEqual([row[0] for row in rows], [4])
+        spool.remove(segment)
+        segment, rows = spool.read_oldest()
+        self.assertEqual([row[0] for row in rows], [5])
+        spool.remove(segment)
+        self.assertTrue(spool.is_empty())
+
+    def test_incomplete_batch_is_skipped(self):
+        spool = ListenSpool(self.spool_dir)
+        spool.append([[1, "Fade", "iliekcomputers", "{}"]])
+        spool.current.write('[[2, "Fade", "iliek')
+        segment, rows = spool.read_oldest()
+        self.assertEqual(rows, [[1, "Fade", "iliekcomputers", "{}"]])
+
+
+class RecentListensFilterTestCase(unittest.TestCase):
+
+    @patch("listenbrainz.timescale_writer.recent_listens.monotonic")
+    def test_expiry(self, mock_monotonic):
+        recent_listens = RecentListensFilter(window=10, max_size=3)
+        mock_monotonic.return_value = 100
+        recent_listens.add([(1, "Fade", "iliekcomputers"), (2, "Fade", "iliekcomputers")])
+        mock_monotonic.return_value = 105
+        recent_listens.add([(3, "Fade", "iliekcomputers"), (1, "Fade", "iliekcomputers")])
+        self.assertEqual(len(recent_listens), 3)
+
+        # the oldest listens are forgotten first when the filter is full
+        recent_listens.add([(4, "Fade", "iliekcomputers")])
+        self.assertNotIn((2, "Fade", "iliekcomputers"), recent_listens)
+        self.assertIn((1, "Fade", "iliekcomputers"), recent_listens)
+
+        mock_monotonic.return_value = 115
+        recent_listens.expire()
+        self.assertEqual(len(recent_listens), 0)
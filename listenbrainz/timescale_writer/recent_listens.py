@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class RecentListensFilter:
+    """ Remembers the keys of the listens which were recently written to timescale, so that
+    resubmissions of those listens (by the spotify reader, retrying clients and re-imports) can be
+    dropped before they reach the database.
+
+    A key is only added once the listen is known to be in the listen table, i.e. after its insert
+    either added the row or hit the unique index, so a listen found here is certainly a duplicate.
+    Listens not found here are still inserted and deduplicated by the database. Because the
+    incoming listens of a user are all inserted by the same writer (see listenbrainz.incoming_shards),
+    a filter in the memory of each writer sees all recent listens of its users.
+
+    Keys are forgotten after window seconds, or earlier if the filter holds more than max_size keys.
+
+    Args:
+        window (int): the number of seconds a key is remembered
+        max_size (int): the maximum number of keys remembered
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        # the keys, in the order in which they were added, with the time they were added
+        self.keys = OrderedDict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, keys):
+        """ Remember the keys of listens which are in the listen table.
+
+        Args:
+            keys: iterable of (listened_at, track_name, user_name) tuples
+        """
+        now = monotonic()
+        for key in keys:
+            self.keys[key] = now
+            self.keys.move_to_end(key)
+        self.expire()
+
+    def expire(self):
+        """ Forget the keys older than the window and the oldest keys above max_size """
+        oldest = monotonic() - self.window
+        while self.keys:
+            key, added = next(iter(self.keys.items()))
+            if added > oldest and len(self.keys) <= self.max_size:
+                break
+            self.keys.popitem(last=False)
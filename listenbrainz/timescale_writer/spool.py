@@ -0,0 +1,97 @@
+import os
+
+import ujson
+
+from listenbrainz.utils import create_path
+
+SEGMENT_SUFFIX = ".spool"
+# A new segment is started once the current one holds this many listens. The listens of a segment
+# are inserted together when the spool is drained.
+SEGMENT_MAX_LISTENS = 100000
+
+
+class ListenSpool:
+    """ An append only spool on local disk for the listen rows which the timescale writer cannot
+    insert while timescale is down, so that their messages can be acked instead of piling up in
+    rabbitmq.
+
+    Batches of rows are appended as JSON lines to numbered segment files, and synced to disk
+    before append returns. Segments are read and removed oldest first, so rows come out of the
+    spool in the order they went in. The segments of a previous run found in the directory are
+    part of the spool.
+
+    Args:
+        directory (str): the directory of the segment files, created if it does not exist
+        segment_max_listens (int): see SEGMENT_MAX_LISTENS
+    """
+
+    def __init__(self, directory, segment_max_listens=SEGMENT_MAX_LISTENS):
+        create_path(directory)
+        self.directory = directory
+        self.segment_max_listens = segment_max_listens
+        # the sequence numbers of the segments in the spool, oldest first
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        # the segment being written, always the last one of self.segments
+        self.current = None
+        self.current_listens = 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, "%020d%s" % (segment, SEGMENT_SUFFIX))
+
+    def is_empty(self):
+        return not self.segments
+
+    def append(self, rows):
+        """ Append a batch of (listened_at, track_name, user_name, data, recording_msid) rows to the
+        spool.
+
+        Raises: OSError if the rows could not be written to disk
+        """
+        if self.current is None or self.current_listens >= self.segment_max_listens:
+            self._close_current()
+            segment = self.segments[-1] + 1 if self.segments else 0
+            self.current = open(self._segment_path(segment), "a", encoding="utf-8")
+            self.segments.append(segment)
+
+        try:
+            self.current.write(ujson.dumps(rows) + "\n")
+            self.current.flush()
+            os.fsync(self.current.fileno())
+        except OSError:
+            # the batch may be partly written, so later batches go to a new segment
+            self._close_current()
+            raise
+        self.current_listens += len(rows)
+
+    def _close_current(self):
+        if self.current is not None:
+            current, self.current = self.current, None
+            self.current_listens = 0
+            current.close()
+
+    def read_oldest(self):
+        """ Read the rows of the oldest segment. If it is being written, later rows are appended
+        to a new segment.
+
+        Returns: (segment, rows) where segment is to be passed to remove once the rows are inserted
+        """
+        segment = self.segments[0]
+        if self.current is not None and segment == self.segments[-1]:
+            self._close_current()
+
+        rows = []
+        with open(self._segment_path(segment), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.extend(ujson.loads(line))
+                except ValueError:
+                    # the last batch was not written completely before the writer stopped, so
+                    # its messages were not acked and rabbitmq delivers them again
+                    break
+        return segment, rows
+
+    def remove(self, segment):
+        """ Remove a segment returned by read_oldest from the spool """
+        os.remove(self._segment_path(segment))
+        self.segments.remove(segment)
@@ -1,20 +1,25 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import traceback
 from time import sleep, monotonic
 from datetime import datetime
 
 import pika
-import ujson
 from flask import current_app
 from redis import Redis
 import psycopg2
 
-from listenbrainz.listen import Listen
+from listenbrainz import listen_codec
+from listenbrainz.incoming_shards import get_incoming_exchange_and_queue
+from listenbrainz.listen import Listen, listens_to_timescale_rows
 from listenbrainz.listenstore import RedisListenStore
 from listenbrainz.listen_writer import ListenWriter
 from listenbrainz.listenstore import TimescaleListenStore
+from listenbrainz.listenstore.timescale_listenstore import LISTENS_DELETED_EXPIRY_TIME, INSERT_METHOD_COPY
+from listenbrainz.timescale_writer.recent_listens import RecentListensFilter
+from listenbrainz.timescale_writer.spool import ListenSpool
 from listenbrainz.webserver import create_app
 from listenbrainz.utils import init_cache
 from brainzutils import metrics, cache
@@ -22,56 +27,149 @@ from brainzutils import metrics, cache
 METRIC_UPDATE_INTERVAL = 60  # seconds
 LISTEN_INSERT_ERROR_SENTINEL = -1  #
 
+# Listens of several messages are inserted together. A batch is inserted once it holds this many
+# listens or its first message arrived BATCH_TIMEOUT ago, whichever comes first.
+BATCH_SIZE = 1000  # listens
+BATCH_TIMEOUT = 0.5  # seconds
+PREFETCH_COUNT = 500  # messages
+
+# The size of the filter of recently written listens if RECENT_LISTENS_FILTER_SIZE is not set
+RECENT_LISTENS_FILTER_DEFAULT_SIZE = 500000  # listens
+
 class TimescaleWriterSubscriber(ListenWriter):
+    """ Inserts the incoming listens into timescale and publishes the new ones to the unique exchange.
 
-    def __init__(self):
+    Args:
+        shard (int): the incoming shard to consume, see listenbrainz.incoming_shards. If None,
+            the unsharded incoming queue is consumed.
+    """
+
+    def __init__(self, shard=None):
         super().__init__()
 
+        self.shard = shard
         self.ls = None
         self.incoming_ch = None
         self.unique_ch = None
         self.redis_listenstore = None
+        # drops resubmissions of recently written listens, None if disabled
+        self.recent_listens = None
+        # holds the listens which could not be inserted while timescale is down, None if disabled
+        self.spool = None
+        self.spool_drain_time = 0
 
         self.incoming_listens = 0
         self.unique_listens = 0
+        self.duplicate_listens = 0
+        self.spooled_listens = 0
         self.metric_submission_time = monotonic() + METRIC_UPDATE_INTERVAL
 
+        # the listen rows of the current batch and the delivery tag of its last message
+        self.batch = []
+        self.last_delivery_tag = None
+        self.batch_start_time = None
+
+    def add_message(self, method, properties, body):
+        """ Add the listens of a message to the current batch and insert the batch if it is full
+        or old enough. """
+        if self.last_delivery_tag is None:
+            self.batch_start_time = monotonic()
+
+        data = listen_codec.decode(body, properties)
+        if getattr(properties, "type", None) == listen_codec.TIMESCALE_ROWS_MESSAGE_TYPE:
+            self.batch.extend(data)
+        else:
+            self.batch.extend(listens_to_timescale_rows(data))
+        self.last_delivery_tag = method.delivery_tag
+        self.incoming_listens += len(data)
+
+        if len(self.batch) >= BATCH_SIZE or monotonic() - self.batch_start_time >= BATCH_TIMEOUT:
+            return self.process_batch()
+        return 0
 
-    def callback(self, ch, method, properties, body):
+    def process_batch(self):
+        """ Insert the listens of the current batch and ack all of its messages at once.
 
-        listens = ujson.loads(body)
+        If there is an error, the listens are added to the spool if there is one, otherwise the
+        messages are requeued so that rabbitmq redelivers them later. While the spool holds listens,
+        new batches are added to it too so that listens are inserted in the order they arrived.
+        Then some of the spooled listens are inserted, see drain_spool.
 
-        submit = []
-        for listen in listens:
-            try:
-                submit.append(Listen.from_json(listen))
-            except ValueError:
-                pass
+        Returns: the return value of insert_to_listenstore for the batch, 0 if the batch is empty
+        """
+        if self.last_delivery_tag is None:
+            self.drain_spool()
+            return 0
 
-        ret = self.insert_to_listenstore(submit)
+        if self.spool is not None and not self.spool.is_empty():
+            ret = self.spool_batch()
+        else:
+            ret = self.insert_to_listenstore(self.batch)
+            if ret == LISTEN_INSERT_ERROR_SENTINEL and self.spool is not None:
+                self.spool_drain_time = monotonic() + self.ERROR_RETRY_DELAY
+                ret = self.spool_batch()
 
-        # If there is an error, we do not ack the message so that rabbitmq redelivers it later.
+        # if the connection is closed here, the consumer loop reconnects and the unacked
+        # messages of the batch are redelivered
         if ret == LISTEN_INSERT_ERROR_SENTINEL:
-            return ret
+            self.incoming_ch.basic_nack(delivery_tag=self.last_delivery_tag, multiple=True, requeue=True)
+        else:
+            self.incoming_ch.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)
 
-        while True:
-            try:
-                self.incoming_ch.basic_ack(delivery_tag=method.delivery_tag)
-                break
-            except pika.exceptions.ConnectionClosed:
-                self.connect_to_rabbitmq()
+        self.clear_batch()
+        self.drain_spool()
+        return ret
 
+    def spool_batch(self):
+        """ Add the listens of the current batch to the spool.
+
+        Returns: the number of listens spooled or LISTEN_INSERT_ERROR_SENTINEL if they could not be written
+        """
+        try:
+            self.spool.append(self.batch)
+        except OSError as err:
+            current_app.logger.error("Cannot write data to spool: %s. Sleep." % str(err), exc_info=True)
+            sleep(self.ERROR_RETRY_DELAY)
+            return LISTEN_INSERT_ERROR_SENTINEL
+        self.spooled_listens += len(self.batch)
+        return len(self.batch)
+
+    def drain_spool(self):
+        """ Insert the listens of the oldest segment of the spool in one batch, using COPY.
+
+        If timescale is still down, the spool is not drained again for ERROR_RETRY_DELAY seconds. Only
+        one segment is inserted at a time, so that the consumer loop keeps serving rabbitmq.
+
+        Returns: the return value of insert_to_listenstore for the segment, 0 if nothing was inserted
+        """
+        if self.spool is None or self.spool.is_empty() or monotonic() < self.spool_drain_time:
+            return 0
+
+        segment, rows = self.spool.read_oldest()
+        ret = self.insert_to_listenstore(rows, method=INSERT_METHOD_COPY)
+        if ret == LISTEN_INSERT_ERROR_SENTINEL:
+            self.spool_drain_time = monotonic() + self.ERROR_RETRY_DELAY
+            return ret
+
+        # if the writer stops before this, the segment is inserted again and its duplicates are skipped
+        self.spool.remove(segment)
+        current_app.logger.info("Inserted %d spooled listens", len(rows))
         return ret
 
-    def insert_to_listenstore(self, data):
+    def clear_batch(self):
+        self.batch = []
+        self.last_delivery_tag = None
+        self.batch_start_time = None
+
+    def insert_to_listenstore(self, data, method=None):
         """
         Inserts a batch of listens to the ListenStore. Timescale will report back as
         to which rows were actually inserted into the DB, allowing us to send those
         down the unique queue.
 
         Args:
-            data: the data to be inserted into the ListenStore
-            retries: the number of retries to make before deciding that we've failed
+            data: the (listened_at, track_name, user_name, data, recording_msid) rows to be inserted into the ListenStore
+            method: the insert method of TimescaleListenStore.insert_rows to use, the configured one if None
 
         Returns: number of listens successfully sent or LISTEN_INSERT_ERROR_SENTINEL
         if there was an error in inserting listens
@@ -80,61 +178,108 @@ class TimescaleWriterSubscriber(ListenWriter):
         if not data:
             return 0
 
-        self.incoming_listens += len(data)
+        self.submit_metrics()
+
+        rows = data
+        if self.recent_listens is not None:
+            rows = self.drop_recent_duplicates(data)
+            if not rows:
+                return len(data)
+
         try:
-            rows_inserted = self.ls.insert(data)
+            rows_inserted = self.ls.insert_rows(rows, method=method)
         except psycopg2.OperationalError as err:
-            current_app.logger.error("Cannot write data to listenstore: %s. Sleep." % str(err), exc_info=True)
-            sleep(self.ERROR_RETRY_DELAY)
+            current_app.logger.error("Cannot write data to listenstore: %s." % str(err), exc_info=True)
+            if self.spool is None:
+                sleep(self.ERROR_RETRY_DELAY)
             return LISTEN_INSERT_ERROR_SENTINEL
 
+        if self.recent_listens is not None:
+            # every row is in the listen table now, whether it was inserted or already there
+            self.recent_listens.add((row[0], row[1], row[2]) for row in rows)
+
         if not rows_inserted:
             return len(data)
 
-        try:
-            self.redis_listenstore.increment_listen_count_for_day(day=datetime.utcnow(), count=len(rows_inserted))
-        except Exception:
-            # Not critical, so if this errors out, just log it to Sentry and move forward
-            current_app.logger.error("Could not update listen count per day in redis", exc_info=True)
-
         unique = []
-        inserted_index = {}
-        for inserted in rows_inserted:
-            inserted_index['%d-%s-%s' % (inserted[0], inserted[1], inserted[2])] = 1
-
-        for listen in data:
-            k = '%d-%s-%s' % (listen.ts_since_epoch, listen.data['track_name'], listen.user_name)
-            if k in inserted_index:
-                unique.append(listen)
+        inserted_index = set((inserted[0], inserted[1], inserted[2]) for inserted in rows_inserted)
+        for row in rows:
+            key = (row[0], row[1], row[2])
+            # remove, so that a listen which was submitted more than once in the batch is sent only once
+            if key in inserted_index:
+                inserted_index.remove(key)
+                # the listen data is only parsed when the unique message is encoded. rows spooled
+                # before the recording_msid column was added have no recording_msid element.
+                unique.append(Listen.from_timescale(row[0], row[1], row[2], None, row[3],
+                                                    row[4] if len(row) > 4 else None))
 
         if not unique:
             return len(data)
 
+        body, properties = listen_codec.encode(unique, current_app.config.get('LISTEN_MESSAGE_CODEC', listen_codec.JSON_CODEC))
         while True:
             try:
                 self.unique_ch.basic_publish(
                     exchange=current_app.config['UNIQUE_EXCHANGE'],
                     routing_key='',
-                    body=ujson.dumps(unique),
-                    properties=pika.BasicProperties(delivery_mode=2,),
+                    body=body,
+                    properties=properties,
                 )
                 break
             except pika.exceptions.ConnectionClosed:
                 self.connect_to_rabbitmq()
 
-        self.redis_listenstore.update_recent_listens(unique)
+        try:
+            self.redis_listenstore.update_for_inserted_listens(day=datetime.utcnow(), count=len(rows_inserted),
+                                                               unique=unique)
+        except Exception:
+            # Not critical, so if this errors out, just log it to Sentry and move forward
+            current_app.logger.error("Could not update listen count per day and recent listens in redis", exc_info=True)
         self.unique_listens += len(unique)
 
+        return len(data)
+
+    def drop_recent_duplicates(self, rows):
+        """ Remove the listen rows which were written to the listenstore recently, see RecentListensFilter.
+
+        The filter is not used for users whose listens were deleted recently, as some of the listens
+        it remembers for them may not be in the listenstore anymore.
+
+        Args:
+            rows: the (listened_at, track_name, user_name, data, recording_msid) rows to be inserted into the ListenStore
+
+        Returns: the rows which are not known duplicates
+        """
+        self.recent_listens.expire()
+        duplicate_users = set(row[2] for row in rows if (row[0], row[1], row[2]) in self.recent_listens)
+        if not duplicate_users:
+            return rows
+
+        try:
+            duplicate_users -= self.ls.get_users_with_deleted_listens(duplicate_users)
+        except Exception:
+            # let the listenstore deduplicate all listens of the batch
+            current_app.logger.error("Could not check for deleted listens in redis", exc_info=True)
+            return rows
+
+        kept = []
+        for row in rows:
+            if row[2] in duplicate_users and (row[0], row[1], row[2]) in self.recent_listens:
+                self.duplicate_listens += 1
+            else:
+                kept.append(row)
+        return kept
+
+    def submit_metrics(self):
         if monotonic() > self.metric_submission_time:
             self.metric_submission_time += METRIC_UPDATE_INTERVAL
-            metrics.set("timescale_writer", incoming_listens=self.incoming_listens, unique_listens=self.unique_listens)
-
-        return len(data)
+            metrics.set("timescale_writer", incoming_listens=self.incoming_listens, unique_listens=self.unique_listens,
+                        duplicate_listens=self.duplicate_listens, spooled_listens=self.spooled_listens)
 
     def start(self):
         app = create_app()
         with app.app_context():
-            current_app.logger.info("timescale-writer init")
+            current_app.logger.info("timescale-writer init, shard: %s", self.shard)
             self._verify_hosts_in_config()
 
             if "SQLALCHEMY_TIMESCALE_URI" not in current_app.config:
@@ -143,6 +288,19 @@ class TimescaleWriterSubscriber(ListenWriter):
                 sleep(self.ERROR_RETRY_DELAY)
                 sys.exit(-1)
 
+            # a window of 0 disables the filter of recently written listens
+            window = int(current_app.config.get('RECENT_LISTENS_FILTER_WINDOW') or 0)
+            if window > 0:
+                self.recent_listens = RecentListensFilter(
+                    window=min(window, LISTENS_DELETED_EXPIRY_TIME),
+                    max_size=int(current_app.config.get('RECENT_LISTENS_FILTER_SIZE') or RECENT_LISTENS_FILTER_DEFAULT_SIZE),
+                )
+
+            spool_dir = current_app.config.get('TIMESCALE_WRITER_SPOOL_DIR')
+            if spool_dir:
+                # each shard needs its own spool, as they may be on the same machine
+                self.spool = ListenSpool(os.path.join(spool_dir, "incoming" if self.shard is None else "incoming.%d" % self.shard))
+
             try:
                 while True:
                     try:
@@ -150,7 +308,9 @@ class TimescaleWriterSubscriber(ListenWriter):
                             'REDIS_HOST': current_app.config['REDIS_HOST'],
                             'REDIS_PORT': current_app.config['REDIS_PORT'],
                             'REDIS_NAMESPACE': current_app.config['REDIS_NAMESPACE'],
-                            'SQLALCHEMY_TIMESCALE_URI': current_app.config['SQLALCHEMY_TIMESCALE_URI']
+                            'SQLALCHEMY_TIMESCALE_URI': current_app.config['SQLALCHEMY_TIMESCALE_URI'],
+                            'LISTEN_INSERT_METHOD': current_app.config.get('LISTEN_INSERT_METHOD'),
+                            'LATEST_LISTENS_CACHE_SIZE': current_app.config.get('LATEST_LISTENS_CACHE_SIZE'),
                         }, logger=current_app.logger)
                         break
                     except Exception as err:
@@ -172,23 +332,28 @@ class TimescaleWriterSubscriber(ListenWriter):
 
                 while True:
                     self.connect_to_rabbitmq()
+                    incoming_exchange, incoming_queue = get_incoming_exchange_and_queue(current_app.config, self.shard)
                     self.incoming_ch = self.connection.channel()
-                    self.incoming_ch.exchange_declare(exchange=current_app.config['INCOMING_EXCHANGE'], exchange_type='fanout')
-                    self.incoming_ch.queue_declare(current_app.config['INCOMING_QUEUE'], durable=True)
-                    self.incoming_ch.queue_bind(exchange=current_app.config['INCOMING_EXCHANGE'],
-                                                queue=current_app.config['INCOMING_QUEUE'])
-                    self.incoming_ch.basic_consume(
-                        queue=current_app.config['INCOMING_QUEUE'],
-                        on_message_callback=lambda ch, method, properties, body: self.static_callback(ch, method, properties, body, obj=self)
-                    )
+                    self.incoming_ch.exchange_declare(exchange=incoming_exchange, exchange_type='fanout')
+                    self.incoming_ch.queue_declare(incoming_queue, durable=True)
+                    self.incoming_ch.queue_bind(exchange=incoming_exchange, queue=incoming_queue)
+                    self.incoming_ch.basic_qos(prefetch_count=PREFETCH_COUNT)
 
                     self.unique_ch = self.connection.channel()
                     self.unique_ch.exchange_declare(exchange=current_app.config['UNIQUE_EXCHANGE'], exchange_type='fanout')
 
                     try:
-                        self.incoming_ch.start_consuming()
+                        # wake up regularly to insert batches which are old enough when no messages arrive
+                        for method, properties, body in self.incoming_ch.consume(incoming_queue,
+                                                                                 inactivity_timeout=BATCH_TIMEOUT):
+                            if method is None:
+                                self.process_batch()
+                            else:
+                                self.add_message(method, properties, body)
                     except pika.exceptions.ConnectionClosed:
                         current_app.logger.warn("Connection to rabbitmq closed. Re-opening.", exc_info=True)
+                        # unacked messages are redelivered by rabbitmq on the new connection
+                        self.clear_batch()
                         self.connection = None
                         continue
 
@@ -200,5 +365,7 @@ class TimescaleWriterSubscriber(ListenWriter):
 
 
 if __name__ == "__main__":
-    rc = TimescaleWriterSubscriber()
+    # each writer of a sharded deployment is started with the shard it consumes in TIMESCALE_WRITER_SHARD
+    shard = os.environ.get("TIMESCALE_WRITER_SHARD")
+    rc = TimescaleWriterSubscriber(shard=int(shard) if shard else None)
     rc.start()
@@ -28,6 +28,8 @@ def create_timescale(app):
         'REDIS_PORT': app.config['REDIS_PORT'],
         'REDIS_NAMESPACE': app.config['REDIS_NAMESPACE'],
         'LISTEN_DUMP_TEMP_DIR_ROOT': app.config['LISTEN_DUMP_TEMP_DIR_ROOT'],
+        'LISTEN_INSERT_METHOD': app.config.get('LISTEN_INSERT_METHOD'),
+        'LATEST_LISTENS_CACHE_SIZE': app.config.get('LATEST_LISTENS_CACHE_SIZE'),
     })
 
 
@@ -3,11 +3,14 @@ import os
 import psycopg2
 import time
 
+from listenbrainz.webserver.external.msid_cache import _msid_cache
+
 try:
     # Should be able to continue if messybrainz package is unavailable during
     # documentation generation (we don't need it in this case).
     import messybrainz
     from messybrainz import exceptions
+    from messybrainz.db.data import get_data_sha256
 except ImportError:
     on_rtd = os.environ.get('READTHEDOCS', None) == 'True'
     if not on_rtd:
@@ -25,4 +28,29 @@ def init_db_connection(uri):
             time.sleep(2)
 
 def submit_listens(listens):
-    return messybrainz.submit_listens_and_sing_me_a_sweet_song(listens)
+    """ Look up the MessyBrainz ids of the listens, submitting them to MessyBrainz if needed.
+
+    Recordings which have been looked up recently are served from the MSID cache, only
+    the remaining ones are sent to the MessyBrainz database in one batch.
+
+    Args:
+        listens (list): the MessyBrainz recording dicts to look up
+    Returns:
+        A dict with key 'payload' and value set to a list of dicts, each with the key 'ids'
+        containing the MessyBrainz ids of the corresponding listen.
+    """
+    data_sha256s = [get_data_sha256(listen) for listen in listens]
+    ids = _msid_cache.get_many(set(data_sha256s))
+
+    missing = {}
+    for data_sha256, listen in zip(data_sha256s, listens):
+        if data_sha256 not in ids and data_sha256 not in missing:
+            missing[data_sha256] = listen
+
+    if missing:
+        result = messybrainz.submit_listens_and_sing_me_a_sweet_song(list(missing.values()))
+        submitted = {data_sha256: recording["ids"] for data_sha256, recording in zip(missing, result["payload"])}
+        _msid_cache.set_many(submitted)
+        ids.update(submitted)
+
+    return {"payload": [{"ids": ids[data_sha256]} for data_sha256 in data_sha256s]}
@@ -0,0 +1,137 @@
+""" A two level cache of MessyBrainz IDs placed in front of the MessyBrainz database.
+
+The cache is keyed by the sha256 of the canonical MessyBrainz JSON of a recording (the
+data_sha256 column of recording_json), so a listen for a track that has been submitted
+before can be augmented without touching the MessyBrainz database. The first level is a
+small LRU local to the process (i.e. the uwsgi worker), the second level is shared by all
+processes through redis.
+
+The ids of a recording are derived from its data only, so the cached entries never go stale
+and are not invalidated, they only expire.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from brainzutils import cache, metrics
+from flask import current_app
+
+
+MSID_CACHE_NAMESPACE = "msid"
+MSID_CACHE_EXPIRY = 7 * 24 * 60 * 60  # 7 days, in seconds
+
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_EXPIRY = 5 * 60  # in seconds
+
+METRIC_UPDATE_INTERVAL = 60  # in seconds
+
+
+class LRUCache:
+    """ A thread safe, size bounded LRU cache whose items expire after a fixed time. """
+
+    def __init__(self, max_size, expiry):
+        self.max_size = max_size
+        self.expiry = expiry
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+
+            value, expires_at = item
+            if expires_at < monotonic():
+                del self.items[key]
+                return None
+
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, monotonic() + self.expiry)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class MsidCache:
+    """ Caches the ids returned by MessyBrainz for a recording, keyed by the recording's data_sha256. """
+
+    def __init__(self, local_size=LOCAL_CACHE_SIZE, local_expiry=LOCAL_CACHE_EXPIRY):
+        self.local = LRUCache(local_size, local_expiry)
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.metric_submission_time = monotonic() + METRIC_UPDATE_INTERVAL
+
+    def get_many(self, data_sha256s):
+        """ Returns a dict of data_sha256 to MessyBrainz ids for all of the given hashes that are cached. """
+        found = {}
+        remote = []
+        for data_sha256 in data_sha256s:
+            ids = self.local.get(data_sha256)
+            if ids is None:
+                remote.append(data_sha256)
+            else:
+                found[data_sha256] = ids
+        self.local_hits += len(found)
+
+        if remote:
+            try:
+                cached = cache.get_many(remote, namespace=MSID_CACHE_NAMESPACE)
+            except Exception as e:
+                # the redis tier is an optimization, everything works without it
+                current_app.logger.error("Cannot read from the MSID cache: %s", str(e))
+                cached = {}
+
+            for data_sha256, ids in cached.items():
+                self.local.set(data_sha256, ids)
+                found[data_sha256] = ids
+            self.redis_hits += len(cached)
+            self.misses += len(remote) - len(cached)
+
+        self._submit_metrics()
+        return found
+
+    def set_many(self, items):
+        """ Cache the MessyBrainz ids for recordings.
+
+        Args:
+            items (dict): a map of data_sha256 to the ids returned by MessyBrainz for the recording
+        """
+        if not items:
+            return
+
+        for data_sha256, ids in items.items():
+            self.local.set(data_sha256, ids)
+
+        try:
+            cache.set_many(items, expirein=MSID_CACHE_EXPIRY, namespace=MSID_CACHE_NAMESPACE)
+        except Exception as e:
+            current_app.logger.error("Cannot write to the MSID cache: %s", str(e))
+
+    def _submit_metrics(self):
+        if monotonic() < self.metric_submission_time:
+            return
+
+        self.metric_submission_time = monotonic() + METRIC_UPDATE_INTERVAL
+        try:
+            if self.local_hits:
+                metrics.increment("msid_cache_local_hits", amount=self.local_hits)
+            if self.redis_hits:
+                metrics.increment("msid_cache_redis_hits", amount=self.redis_hits)
+            if self.misses:
+                metrics.increment("msid_cache_misses", amount=self.misses)
+        except Exception:
+            return
+        self.local_hits = self.redis_hits = self.misses = 0
+
+
+_msid_cache = MsidCache()
@@ -40,18 +40,25 @@ def init_rabbitmq_connection(app):
             connection_parameters,
             app.config['MAXIMUM_RABBITMQ_CONNECTIONS'],
             app.config['INCOMING_EXCHANGE'],
+            publisher_confirms=app.config.get('RABBITMQ_PUBLISHER_CONFIRMS', False),
         )
 
 
 class RabbitMQConnectionPool:
     """ The RabbitMQ connection pool used by the api and api_compat to publish messages to
-    the incoming queue."""
-    def __init__(self, logger, connection_parameters, max_size, exchange):
+    the incoming queue.
+
+    If publisher_confirms is True, publish calls only return after the broker has accepted
+    the messages. Since a BlockingChannel in confirm mode waits for each message separately,
+    this is done with an AMQP transaction which is committed once for all messages of a call.
+    """
+    def __init__(self, logger, connection_parameters, max_size, exchange, publisher_confirms=False):
         self.log = logger
         self.connection_parameters = connection_parameters
         self.max_size = max_size
         self.queue = queue.Queue(maxsize=max_size)
         self.exchange = exchange
+        self.publisher_confirms = publisher_confirms
 
     def add(self):
         try:
@@ -96,35 +103,59 @@ class RabbitMQConnectionPool:
 class RabbitMQConnection:
     def __init__(self, connection, pool):
         self.connection = connection
-        self.channel = connection.channel()
         self.pool = pool
+        self.channel = None
+        # the exchanges and queues declared on the current channel
+        self.declared = set()
+        self.recreate_channel()
 
     def __enter__(self):
-        if not self.is_channel_open:
+        if self.channel is None:
             self.recreate_channel()
         return self
 
     def __exit__(self, type, value, traceback):
+        # Note: We cannot use channel.is_open because this is a BlockingChannel where the is_open
+        # property is not trustworthy (https://github.com/pika/pika/issues/877). Instead of checking
+        # the channel with an extra round trip each time it is used, it is dropped after any error
+        # and a new one is created the next time the connection is acquired.
+        if isinstance(value, (pika.exceptions.AMQPError, OSError)):
+            self.channel = None
         self.pool.release(self)
 
-    @property
-    def is_channel_open(self):
-        """ Checks if current channel is open or not.
-
-        Note: We cannot use channel.is_open because this is a BlockingChannel where the is_open
-        property is not trustworthy (https://github.com/pika/pika/issues/877)
-
-        So we check if an exchange exists each time, to check if the channel is ok. This exchange
-        is the exchange which houses incoming listens.
-
-        Returns:
-            bool: True if channel is open, False otherwise
+    def declare(self, exchange, queue):
+        """ Declare a fanout exchange and a durable queue unless they have already been
+        declared on the current channel.
         """
-        try:
-            self.channel.exchange_declare(exchange=self.pool.exchange, exchange_type='fanout', passive=True)
-            return True
-        except (pika.exceptions.ConnectionClosed, pika.exceptions.ChannelClosed, FileNotFoundError, OSError) as e:
-            return False
+        if ("exchange", exchange) not in self.declared:
+            self.channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+            self.declared.add(("exchange", exchange))
+        if ("queue", queue) not in self.declared:
+            self.channel.queue_declare(queue, durable=True)
+            self.declared.add(("queue", queue))
+
+    def publish(self, exchange, queue, bodies, properties=None):
+        """ Publish messages to the given exchange, declaring it and the queue if needed.
+
+        Args:
+            exchange (str): the name of the exchange
+            queue (str): the name of the queue
+            bodies (list): the bodies of the messages to publish
+            properties (pika.BasicProperties): the properties of the messages, persistent
+                messages without a content type by default
+        """
+        if properties is None:
+            properties = pika.BasicProperties(delivery_mode=2, )
+        self.declare(exchange, queue)
+        for body in bodies:
+            self.channel.basic_publish(
+                exchange=exchange,
+                routing_key='',
+                body=body,
+                properties=properties,
+            )
+        if self.pool.publisher_confirms:
+            self.channel.tx_commit()
 
     @property
     def is_open(self):
@@ -141,6 +172,9 @@ class RabbitMQConnection:
 
     def recreate_channel(self):
         self.channel = self.connection.channel()
+        self.declared = set()
+        if self.pool.publisher_confirms:
+            self.channel.tx_select()
 
     def close(self):
         if self.connection.is_open:
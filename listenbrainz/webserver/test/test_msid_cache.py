@@ -0,0 +1,75 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from listenbrainz.webserver.external.msid_cache import LRUCache, MsidCache, MSID_CACHE_NAMESPACE
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_size=2, expiry=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)  # "b" is now the least recently used item
+        lru.set("c", 3)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+
+    @patch("listenbrainz.webserver.external.msid_cache.monotonic")
+    def test_expiry(self, mock_monotonic):
+        lru = LRUCache(max_size=2, expiry=60)
+        mock_monotonic.return_value = 100
+        lru.set("a", 1)
+        mock_monotonic.return_value = 159
+        self.assertEqual(lru.get("a"), 1)
+        mock_monotonic.return_value = 161
+        self.assertIsNone(lru.get("a"))
+
+
+@patch("listenbrainz.webserver.external.msid_cache.cache")
+class MsidCacheTestCase(TestCase):
+
+    ids = {
+        "recording_msid": "c7a41965-9f1e-456c-8b1d-27c0f0dde280",
+        "artist_msid": "8a3a1ade-bfc6-4b69-8d4a-2b11ef1e5ddd",
+        "release_msid": None,
+        "recording_mbid": "",
+        "artist_mbids": [],
+        "release_mbid": "",
+    }
+
+    def test_local_hit_does_not_query_redis(self, mock_cache):
+        msid_cache = MsidCache()
+        msid_cache.set_many({"sha": self.ids})
+        self.assertDictEqual(msid_cache.get_many(["sha"]), {"sha": self.ids})
+        mock_cache.get_many.assert_not_called()
+        self.assertEqual(msid_cache.local_hits, 1)
+
+    def test_redis_hit_and_miss(self, mock_cache):
+        mock_cache.get_many.return_value = {"sha1": self.ids}
+        msid_cache = MsidCache()
+        self.assertDictEqual(msid_cache.get_many(["sha1", "sha2"]), {"sha1": self.ids})
+        mock_cache.get_many.assert_called_once_with(["sha1", "sha2"], namespace=MSID_CACHE_NAMESPACE)
+        self.assertEqual(msid_cache.redis_hits, 1)
+        self.assertEqual(msid_cache.misses, 1)
+
+        # the redis hit has been put into the local cache
+        mock_cache.get_many.reset_mock()
+        self.assertDictEqual(msid_cache.get_many(["sha1"]), {"sha1": self.ids})
+        mock_cache.get_many.assert_not_called()
+
+    def test_redis_errors_are_ignored(self, mock_cache):
+        mock_cache.get_many.side_effect = Exception("redis is down")
+        mock_cache.set_many.side_effect = Exception("redis is down")
+        msid_cache = MsidCache()
+        app = Flask(__name__)
+        with app.app_context(), self.assertLogs(app.logger, level="ERROR") as logs:
+            self.assertDictEqual(msid_cache.get_many(["sha"]), {})
+            self.assertEqual(msid_cache.misses, 1)
+
+            msid_cache.set_many({"sha": self.ids})
+            self.assertDictEqual(msid_cache.get_many(["sha"]), {"sha": self.ids})
+        self.assertEqual(len(logs.output), 2)
@@ -1,11 +1,12 @@
 from flask import Flask
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
-from pika.exceptions import ConnectionClosed
+from pika.exceptions import ConnectionClosed, ChannelClosed
 
 import listenbrainz.webserver.rabbitmq_connection as rabbitmq_connection
 
-from listenbrainz.webserver.rabbitmq_connection import RabbitMQConnectionPool, CONNECTION_RETRIES, init_rabbitmq_connection
+from listenbrainz.webserver.rabbitmq_connection import RabbitMQConnectionPool, RabbitMQConnection, CONNECTION_RETRIES, \
+    init_rabbitmq_connection
 
 
 
@@ -31,3 +32,51 @@ class RabbitMQConnectionPoolTestCase(TestCase):
         with self.assertRaises(ConnectionError):
             rabbitmq_connection._rabbitmq = None
             init_rabbitmq_connection(app)
+
+
+class RabbitMQConnectionTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = RabbitMQConnectionPool(MagicMock(), MagicMock(), 10, 'test_exchange')
+        self.pool.release = MagicMock()
+        self.connection = RabbitMQConnection(MagicMock(), self.pool)
+
+    def test_declarations_are_cached(self):
+        for _ in range(3):
+            with self.connection as connection:
+                connection.publish('test_exchange', 'test_queue', ['{}'])
+
+        channel = self.connection.channel
+        channel.exchange_declare.assert_called_once_with(exchange='test_exchange', exchange_type='fanout')
+        channel.queue_declare.assert_called_once_with('test_queue', durable=True)
+        self.assertEqual(channel.basic_publish.call_count, 3)
+        channel.tx_commit.assert_not_called()
+
+    def test_channel_recreated_after_error(self):
+        channel = self.connection.channel
+        channel.basic_publish.side_effect = ChannelClosed(reply_code=404, reply_text='NOT_FOUND')
+        with self.assertRaises(ChannelClosed):
+            with self.connection as connection:
+                connection.publish('test_exchange', 'test_queue', ['{}'])
+        self.assertIsNone(self.connection.channel)
+
+        new_channel = MagicMock()
+        self.connection.connection.channel.return_value = new_channel
+        with self.connection as connection:
+            connection.publish('test_exchange', 'test_queue', ['{}'])
+        # the exchange and queue have to be declared again on the new channel
+        new_channel.exchange_declare.assert_called_once()
+        new_channel.queue_declare.assert_called_once()
+        new_channel.basic_publish.assert_called_once()
+
+    def test_publisher_confirms(self):
+        self.pool.publisher_confirms = True
+        self.connection.recreate_channel()
+        channel = self.connection.channel
+        channel.tx_select.assert_called_once()
+
+        with self.connection as connection:
+            connection.publish('test_exchange', 'test_queue', ['{}', '{}', '{}'])
+        self.assertEqual(channel.basic_publish.call_count, 3)
+        # all messages of a call are confirmed together
+        channel.tx_commit.assert_called_once()
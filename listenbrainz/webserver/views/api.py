@@ -1,12 +1,16 @@
+import gzip
+import json
+import zlib
 from operator import itemgetter
 from typing import Tuple
 
 import ujson
 import psycopg2
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app
 from brainzutils.musicbrainz_db import engine as mb_engine
 
-from listenbrainz.listenstore import TimescaleListenStore
+from listenbrainz.listenstore import TimescaleListenStore, ORDER_ASC, ORDER_DESC
+from listenbrainz.listenstore.listens_cursor import encode_listens_cursor, decode_listens_cursor
 from listenbrainz.webserver.errors import APIBadRequest, APIInternalServerError, APINotFound, APIServiceUnavailable, \
     APIUnauthorized
 from listenbrainz.webserver.decorators import api_listenstore_needed
@@ -18,9 +22,10 @@ import listenbrainz.db.user as db_user
 from brainzutils.ratelimit import ratelimit
 import listenbrainz.webserver.redis_connection as redis_connection
 from listenbrainz.webserver.utils import REJECT_LISTENS_WITHOUT_EMAIL_ERROR
-from listenbrainz.webserver.views.api_tools import insert_payload, log_raise_400, validate_listen, parse_param_list,\
+from listenbrainz.webserver.views.api_tools import insert_payload, enqueue_payload, log_raise_400, validate_listens, parse_param_list,\
     is_valid_uuid, MAX_LISTEN_SIZE, MAX_ITEMS_PER_GET, DEFAULT_ITEMS_PER_GET, LISTEN_TYPE_SINGLE, LISTEN_TYPE_IMPORT,\
-    LISTEN_TYPE_PLAYING_NOW, validate_auth_header, get_non_negative_param
+    LISTEN_TYPE_PLAYING_NOW, validate_auth_header, get_non_negative_param, read_ndjson_listens, IMPORT_CHUNK_SIZE,\
+    MAX_LISTENS_PER_IMPORT_REQUEST
 from listenbrainz.webserver.views.playlist_api import serialize_jspf
 from listenbrainz.listenstore.timescale_listenstore import TimescaleListenStoreException
 from listenbrainz.webserver.timescale_connection import _ts
@@ -29,6 +34,9 @@ api_bp = Blueprint('api_v1', __name__)
 
 DEFAULT_NUMBER_OF_PLAYLISTS_PER_CALL = 25
 
+# the number of listens serialized for each chunk of a streamed listens response
+LISTENS_STREAM_BATCH_SIZE = 100
+
 
 @api_bp.route("/submit-listens", methods=["POST", "OPTIONS"])
 @crossdomain(headers="Authorization, Content-Type")
@@ -84,17 +92,122 @@ def submit_listen():
         log_raise_400("Invalid JSON document submitted.", raw_data)
 
     # validate listens to make sure json is okay
-    validated_payload = [validate_listen(listen, listen_type) for listen in payload]
+    validated_payload = validate_listens(payload, listen_type)
+
+    _submit_payload(validated_payload, user, listen_type)
+    return jsonify({'status': 'ok'})
+
+
+@api_bp.route("/import-listens", methods=["POST", "OPTIONS"])
+@crossdomain(headers="Authorization, Content-Type, Content-Encoding")
+@ratelimit()
+def import_listens():
+    """
+    Import a large number of listens in a single request. A user token (found on
+    https://listenbrainz.org/profile/ ) must be provided in the Authorization header!
+
+    The request body is newline delimited JSON: each line contains one listen in the format of
+    the listens in the payload of an ``import`` submission (see :ref:`json-doc`). The body may be
+    compressed with gzip, in which case the Content-Encoding header must be set to *gzip*.
+
+    Listens are validated as they are read and submitted in chunks of 1000 listens, so a
+    request can contain up to 100000 listens. If a line is invalid, the listens of the previous
+    chunks have already been imported. The error response then contains the line number of the
+    invalid listen and the number of listens imported, so the import can be resumed after fixing
+    the line. If a chunk cannot be submitted, the error response contains the first line of that
+    chunk instead, along with the chunks already imported.
+
+    A successful response contains the number of listens imported and the lines of each chunk:
+
+    .. code-block:: json
+
+        {
+          "status": "ok",
+          "listens_imported": 1500,
+          "chunks": [
+            {"first_line": 1, "last_line": 1000, "listens": 1000},
+            {"first_line": 1001, "last_line": 1500, "listens": 500}
+          ]
+        }
+
+    :reqheader Authorization: Token <user token>
+    :reqheader Content-Type: *application/x-ndjson*
+    :reqheader Content-Encoding: *gzip* (optional)
+    :statuscode 200: listens imported.
+    :statuscode 400: invalid listen or body, see error message for details.
+    :statuscode 401: invalid authorization. See error message for details.
+    :statuscode 500: a chunk could not be submitted, retry from the line in the error response.
+    :statuscode 503: a chunk could not be submitted, retry from the line in the error response.
+    :resheader Content-Type: *application/json*
+    """
+    user = validate_auth_header(fetch_email=True)
+    if mb_engine and current_app.config["REJECT_LISTENS_WITHOUT_USER_EMAIL"] and not user["email"]:
+        raise APIUnauthorized(REJECT_LISTENS_WITHOUT_EMAIL_ERROR)
 
+    stream = request.stream
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+
+    chunks = []
+    chunk = []
+    listens_imported = 0
+    first_line = line_number = 0
     try:
-        insert_payload(validated_payload, user, listen_type)
+        for line_number, listen in read_ndjson_listens(stream):
+            if listens_imported + len(chunk) >= MAX_LISTENS_PER_IMPORT_REQUEST:
+                raise APIBadRequest("Line %d: a request may not contain more than %d listens."
+                                    % (line_number, MAX_LISTENS_PER_IMPORT_REQUEST))
+            try:
+                chunk.extend(validate_listens([listen], LISTEN_TYPE_IMPORT))
+            except APIBadRequest as e:
+                raise APIBadRequest("Line %d: %s" % (line_number, e.message))
+
+            if not first_line:
+                first_line = line_number
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                _submit_payload(chunk, user, LISTEN_TYPE_IMPORT)
+                chunks.append({"first_line": first_line, "last_line": line_number, "listens": len(chunk)})
+                listens_imported += len(chunk)
+                chunk = []
+                first_line = 0
+
+        if chunk:
+            _submit_payload(chunk, user, LISTEN_TYPE_IMPORT)
+            chunks.append({"first_line": first_line, "last_line": line_number, "listens": len(chunk)})
+            listens_imported += len(chunk)
+    except APIBadRequest as e:
+        raise APIBadRequest(e.message, {"line": line_number, "listens_imported": listens_imported, "chunks": chunks})
+    except (APIInternalServerError, APIServiceUnavailable) as e:
+        # the chunks before the failed one are already submitted, tell the client where to resume
+        raise type(e)(e.message, {"line": first_line, "listens_imported": listens_imported, "chunks": chunks})
+    except (OSError, EOFError, zlib.error) as e:
+        raise APIBadRequest("Cannot decompress the request body: %s" % e,
+                            {"listens_imported": listens_imported, "chunks": chunks})
+
+    if not listens_imported:
+        log_raise_400("Request body does not contain any listens")
+
+    return jsonify({
+        "status": "ok",
+        "listens_imported": listens_imported,
+        "chunks": chunks,
+    })
+
+
+def _submit_payload(payload, user, listen_type):
+    """ Submit validated listens, see insert_payload """
+    try:
+        # with deferred augmentation, the MessyBrainz lookup is done by the listen augmenter
+        # instead of blocking the request. playing now listens are always looked up directly.
+        if current_app.config.get('DEFER_LISTEN_AUGMENTATION', False) and listen_type != LISTEN_TYPE_PLAYING_NOW:
+            enqueue_payload(payload, user)
+        else:
+            insert_payload(payload, user, listen_type)
     except APIServiceUnavailable as e:
         raise
     except Exception as e:
         raise APIInternalServerError("Something went wrong. Please try again.")
 
-    return jsonify({'status': 'ok'})
-
 
 @api_bp.route("/user/<user_name>/listens")
 @crossdomain()
@@ -108,8 +221,13 @@ def get_listens(user_name):
     The optional ``max_ts`` and ``min_ts`` UNIX epoch timestamps control at which point in time to start returning listens. You may specify max_ts or
     min_ts, but not both in one call. Listens are always returned in descending timestamp order.
 
+    The returned ``next_cursor`` and ``previous_cursor`` continue from the last and the first returned listen, to
+    the older and the newer listens respectively. They are null if no listens are returned. Paging with cursors
+    never skips or repeats listens which share a timestamp.
+
     :param max_ts: If you specify a ``max_ts`` timestamp, listens with listened_at less than (but not including) this value will be returned.
     :param min_ts: If you specify a ``min_ts`` timestamp, listens with listened_at greater than (but not including) this value will be returned.
+    :param cursor: The ``next_cursor`` or ``previous_cursor`` of an earlier response. It cannot be used with ``min_ts`` or ``max_ts``.
     :param count: Optional, number of listens to return. Default: :data:`~webserver.views.api.DEFAULT_ITEMS_PER_GET` . Max: :data:`~webserver.views.api.MAX_ITEMS_PER_GET`
     :statuscode 200: Yay, you have data!
     :resheader Content-Type: *application/json*
@@ -120,22 +238,43 @@ def get_listens(user_name):
     if min_ts and max_ts and min_ts >= max_ts:
         raise APIBadRequest("min_ts should be less than max_ts")
 
-    listens, _, max_ts_per_user = db_conn.fetch_listens(
+    cursor = request.args.get("cursor")
+    if cursor:
+        if min_ts or max_ts:
+            raise APIBadRequest("cursor cannot be used with min_ts or max_ts")
+        try:
+            listened_at, track_name, order = decode_listens_cursor(cursor)
+        except ValueError as e:
+            raise APIBadRequest(str(e))
+        listens = db_conn.fetch_listens_after_cursor(user_name, listened_at, track_name, limit=count, order=order)
+        _, max_ts_per_user = db_conn.get_timestamps_for_user(user_name)
+    else:
+        listens, _, max_ts_per_user = db_conn.fetch_listens(
+            user_name,
+            limit=count,
+            from_ts=min_ts,
+            to_ts=max_ts
+        )
+
+    return Response(_stream_listens_payload(
+        listens,
         user_name,
-        limit=count,
-        from_ts=min_ts,
-        to_ts=max_ts
-    )
-    listen_data = []
-    for listen in listens:
-        listen_data.append(listen.to_api())
+        max_ts_per_user,
+        encode_listens_cursor(listens[-1], ORDER_DESC) if listens else None,
+        encode_listens_cursor(listens[0], ORDER_ASC) if listens else None,
+    ), mimetype='application/json')
 
-    return jsonify({'payload': {
-        'user_id': user_name,
-        'count': len(listen_data),
-        'listens': listen_data,
-        'latest_listen_ts': max_ts_per_user,
-    }})
+
+def _stream_listens_payload(listens, user_name, latest_listen_ts, next_cursor, previous_cursor):
+    """ Yield the JSON of the payload of get_listens in batches of listens, with the same members and
+    order of keys as jsonify gives it. Each listen is serialized by Listen.to_api_json, which splices
+    the listen data read from the listenstore into the JSON without parsing it. """
+    yield '{"payload":{"count":%d,"latest_listen_ts":%s,"listens":[' % (len(listens), json.dumps(latest_listen_ts))
+    for i in range(0, len(listens), LISTENS_STREAM_BATCH_SIZE):
+        batch = ','.join(listen.to_api_json() for listen in listens[i:i + LISTENS_STREAM_BATCH_SIZE])
+        yield batch if i == 0 else ',' + batch
+    yield '],"next_cursor":%s,"previous_cursor":%s,"user_id":%s}}\n' % (
+        json.dumps(next_cursor), json.dumps(previous_cursor), json.dumps(user_name))
 
 
 @api_bp.route("/user/<user_name>/listen-count")
@@ -371,11 +510,6 @@ def latest_import():
             raise APIInternalServerError(
                 'Could not update latest_import, try again')
 
-        # During unrelated tests _ts may be None -- improving this would be a great headache. 
-        # However, during the test of this code and while serving requests _ts is set.
-        if _ts:
-            _ts.set_listen_count_expiry_for_user(user['musicbrainz_id'])
-
         return jsonify({'status': 'ok'})
 
 
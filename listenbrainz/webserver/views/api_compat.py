@@ -14,7 +14,7 @@ from brainzutils.musicbrainz_db import engine as mb_engine
 from listenbrainz.webserver.errors import InvalidAPIUsage, CompatError
 from listenbrainz.webserver.decorators import api_listenstore_needed
 import xmltodict
-from listenbrainz.webserver.views.api_tools import insert_payload, validate_listen
+from listenbrainz.webserver.views.api_tools import insert_payload, validate_listens
 from listenbrainz.db.lastfm_user import User
 from listenbrainz.db.lastfm_session import Session
 from listenbrainz.db.lastfm_token import Token
@@ -276,7 +276,7 @@ def record_listens(request, data):
 
     # Convert to native payload then submit 'em after validation.
     listen_type, native_payload = _to_native_api(lookup, data['method'], output_format)
-    validated_payload = [validate_listen(listen, listen_type) for listen in native_payload]
+    validated_payload = validate_listens(native_payload, listen_type)
 
     augmented_listens = insert_payload(validated_payload, user, listen_type=listen_type)
 
@@ -8,6 +8,7 @@ import listenbrainz.webserver.redis_connection as redis_connection
 import listenbrainz.db.user as db_user
 import pika
 import pika.exceptions
+import re
 import sys
 import time
 import ujson
@@ -16,7 +17,9 @@ import uuid
 from flask import current_app, request
 from sqlalchemy.exc import DataError
 
-from listenbrainz.listen import Listen
+from listenbrainz import listen_codec
+from listenbrainz.incoming_shards import group_listens_by_incoming_shard
+from listenbrainz.listen import Listen, listens_to_timescale_rows
 from listenbrainz.webserver import API_LISTENED_AT_ALLOWED_SKEW
 from listenbrainz.webserver.external import messybrainz
 from listenbrainz.webserver.errors import APIInternalServerError, APIServiceUnavailable, APIBadRequest, APIUnauthorized
@@ -35,7 +38,13 @@ MAX_ITEMS_PER_GET = 100
 #: The default number of listens returned in a single GET request.
 DEFAULT_ITEMS_PER_GET = 25
 
-MAX_ITEMS_PER_MESSYBRAINZ_LOOKUP = 10
+MAX_ITEMS_PER_MESSYBRAINZ_LOOKUP = 100
+
+#: The number of listens submitted together by the streaming import endpoint.
+IMPORT_CHUNK_SIZE = 1000
+
+#: The maximum number of listens imported in a single streaming import request.
+MAX_LISTENS_PER_IMPORT_REQUEST = 100000
 
 
 # Define the values for types of listens
@@ -43,6 +52,14 @@ LISTEN_TYPE_SINGLE = 1
 LISTEN_TYPE_IMPORT = 2
 LISTEN_TYPE_PLAYING_NOW = 3
 
+#: The MBID fields of additional_info, in the order in which they are validated.
+SINGLE_MBID_KEYS = ('release_mbid', 'recording_mbid', 'release_group_mbid', 'track_mbid')
+MULTIPLE_MBID_KEYS = ('artist_mbids', 'work_mbids')
+
+#: Matches UUIDs in the canonical hyphenated form. uuid.UUID accepts other forms too, those
+#: are checked with is_valid_uuid.
+CANONICAL_UUID_REGEX = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
+
 
 def insert_payload(payload, user, listen_type=LISTEN_TYPE_IMPORT):
     """ Convert the payload into augmented listens then submit them.
@@ -61,39 +78,61 @@ def insert_payload(payload, user, listen_type=LISTEN_TYPE_IMPORT):
     return augmented_listens
 
 
-def handle_playing_now(listen):
-    """ Check that the listen doesn't already exist in redis and put it in
-    there if it isn't.
+def enqueue_payload(payload, user):
+    """ Submit the payload without looking up the MessyBrainz ids of its listens.
+
+    The listens are published to the raw listens queue from where the listen augmenter
+    looks them up in batches and forwards them to the incoming queue. Playing now listens
+    need their recording msid immediately and must be submitted with insert_payload.
+    """
+    try:
+        listens = _add_user_to_listens(payload, user)
+        publish_data_to_queue(
+            data=listens,
+            exchange=current_app.config['RAW_LISTENS_EXCHANGE'],
+            queue=current_app.config['RAW_LISTENS_QUEUE'],
+            error_msg='Cannot submit listens to queue, please try again later.',
+        )
+    except APIServiceUnavailable:
+        raise
+    except Exception as e:
+        current_app.logger.error("Error while enqueueing payload: %s", str(e), exc_info=True)
+        raise APIInternalServerError("Something went wrong. Please try again.")
+    return listens
+
+
+def _get_playing_now_timeout(listen):
+    """ Return the time in seconds after which a playing now listen expires """
+    additional_info = listen['track_metadata']['additional_info']
+    if 'duration' in additional_info:
+        return additional_info['duration']
+    elif 'duration_ms' in additional_info:
+        return additional_info['duration_ms'] // 1000
+    return current_app.config['PLAYING_NOW_MAX_DURATION']
+
+
+def handle_playing_now(listens):
+    """ Put the listens in redis as the playing now listens of their users, unless
+    the user's playing now listen already is the same recording. The check and the
+    update happen atomically in redis, in one round trip for all listens.
 
     Returns:
-        listen if new playing now listen, None otherwise
+        the listens which are new playing now listens
     """
-    old_playing_now = redis_connection._redis.get_playing_now(listen['user_id'])
-    if old_playing_now and listen['recording_msid'] == old_playing_now.recording_msid:
-        return None
-    if 'duration' in listen['track_metadata']['additional_info']:
-        listen_timeout = listen['track_metadata']['additional_info']['duration']
-    elif 'duration_ms' in listen['track_metadata']['additional_info']:
-        listen_timeout = listen['track_metadata']['additional_info']['duration_ms'] // 1000
-    else:
-        listen_timeout = current_app.config['PLAYING_NOW_MAX_DURATION']
-    redis_connection._redis.put_playing_now(listen['user_id'], listen, listen_timeout)
-    return listen
+    items = [(listen['user_id'], listen, _get_playing_now_timeout(listen)) for listen in listens]
+    stored = redis_connection._redis.put_playing_now_many(items)
+    return [listen for listen, is_new in zip(listens, stored) if is_new]
 
 
 def _send_listens_to_queue(listen_type, listens):
-    submit = []
-    for listen in listens:
-        if listen_type == LISTEN_TYPE_PLAYING_NOW:
-            try:
-                listen = handle_playing_now(listen)
-                if listen:
-                    submit.append(listen)
-            except Exception as e:
-                current_app.logger.error("Redis rpush playing_now write error: " + str(e))
-                raise APIServiceUnavailable("Cannot record playing_now at this time.")
-        else:
-            submit.append(listen)
+    if listen_type == LISTEN_TYPE_PLAYING_NOW:
+        try:
+            submit = handle_playing_now(listens)
+        except Exception as e:
+            current_app.logger.error("Redis rpush playing_now write error: " + str(e))
+            raise APIServiceUnavailable("Cannot record playing_now at this time.")
+    else:
+        submit = listens
 
     if submit:
         # check if rabbitmq connection exists or not
@@ -105,18 +144,25 @@ def _send_listens_to_queue(listen_type, listens):
             raise APIServiceUnavailable('Cannot submit listens to queue, please try again later.')
 
         if listen_type == LISTEN_TYPE_PLAYING_NOW:
-           exchange = current_app.config['PLAYING_NOW_EXCHANGE']
-           queue = current_app.config['PLAYING_NOW_QUEUE']
+            groups = [(current_app.config['PLAYING_NOW_EXCHANGE'], current_app.config['PLAYING_NOW_QUEUE'], submit)]
         else:
-            exchange = current_app.config['INCOMING_EXCHANGE']
-            queue = current_app.config['INCOMING_QUEUE']
-
-        publish_data_to_queue(
-            data=submit,
-            exchange=exchange,
-            queue=queue,
-            error_msg='Cannot submit listens to queue, please try again later.',
-        )
+            groups = group_listens_by_incoming_shard(current_app.config, submit)
+
+        for exchange, queue, data in groups:
+            message_type = None
+            if listen_type != LISTEN_TYPE_PLAYING_NOW:
+                # the writer inserts these rows as they are, without parsing the listens again
+                data = listens_to_timescale_rows(data)
+                message_type = listen_codec.TIMESCALE_ROWS_MESSAGE_TYPE
+                if not data:
+                    continue
+            publish_data_to_queue(
+                data=data,
+                exchange=exchange,
+                queue=queue,
+                error_msg='Cannot submit listens to queue, please try again later.',
+                message_type=message_type,
+            )
 
 
 def validate_listen(listen: Dict, listen_type) -> Dict:
@@ -189,15 +235,154 @@ def validate_listen(listen: Dict, listen_type) -> Dict:
                     raise APIBadRequest("JSON document may not contain track_metadata.additional_info.tags "
                                         "longer than %d characters." % MAX_TAG_SIZE, listen)
         # MBIDs, both of the mbid validation methods mutate the listen payload if needed.
-        single_mbid_keys = ['release_mbid', 'recording_mbid', 'release_group_mbid', 'track_mbid']
-        for key in single_mbid_keys:
+        for key in SINGLE_MBID_KEYS:
             validate_single_mbid_field(listen, key)
-        multiple_mbid_keys = ['artist_mbids', 'work_mbids']
-        for key in multiple_mbid_keys:
+        for key in MULTIPLE_MBID_KEYS:
             validate_multiple_mbids_field(listen, key)
     return listen
 
 
+def validate_listens(payload, listen_type):
+    """ Validate all listens of a payload, see validate_listen.
+
+    This accepts and rejects exactly the listens validate_listen does, with the same errors
+    and mutations, but looks up each field only once and checks MBIDs with a regex. Listens
+    whose top level, track_metadata or additional_info are not JSON objects are handed to
+    validate_listen, whose behaviour for those depends on the type of the values.
+
+    Returns:
+        the list of validated listens
+    Raises:
+        APIBadRequest for the first invalid listen of the payload
+    """
+    validate = _listen_validators.get(listen_type)
+    if validate is None:
+        validate = compile_listen_validator(listen_type)
+    return [validate(listen) for listen in payload]
+
+
+def compile_listen_validator(listen_type):
+    """ Returns a function which validates a single listen of the given type. """
+    if listen_type in (LISTEN_TYPE_SINGLE, LISTEN_TYPE_IMPORT):
+        validate_top_level = _validate_listened_at
+    elif listen_type == LISTEN_TYPE_PLAYING_NOW:
+        validate_top_level = _validate_playing_now_top_level
+    else:
+        validate_top_level = None
+
+    def validate(listen):
+        if listen is None:
+            raise APIBadRequest("Listen is empty and cannot be validated.")
+
+        track_metadata = listen.get('track_metadata') if type(listen) is dict else None
+        additional_info = track_metadata.get('additional_info', {}) if type(track_metadata) is dict else None
+        if type(additional_info) is not dict:
+            return validate_listen(listen, listen_type)
+
+        if validate_top_level is not None:
+            validate_top_level(listen)
+        _validate_track_metadata(listen, track_metadata)
+        if 'additional_info' in track_metadata:
+            _validate_additional_info(listen, additional_info)
+        return listen
+
+    return validate
+
+
+def _validate_listened_at(listen):
+    if 'listened_at' not in listen:
+        raise APIBadRequest("JSON document must contain the key listened_at at the top level.", listen)
+
+    try:
+        listened_at = listen['listened_at'] = int(listen['listened_at'])
+    except ValueError:
+        raise APIBadRequest("JSON document must contain an int value for listened_at.", listen)
+
+    if len(listen) > 2 and 'track_metadata' in listen:
+        raise APIBadRequest("JSON document may only contain listened_at and "
+                            "track_metadata top level keys", listen)
+
+    if not is_valid_timestamp(listened_at):
+        raise APIBadRequest("Value for key listened_at is too high.", listen)
+
+
+def _validate_playing_now_top_level(listen):
+    if 'listened_at' in listen:
+        raise APIBadRequest("JSON document must not contain listened_at while submitting "
+                            "playing_now.", listen)
+
+    if len(listen) > 1 and 'track_metadata' in listen:
+        raise APIBadRequest("JSON document may only contain track_metadata as top level "
+                            "key when submitting playing_now.", listen)
+
+
+def _validate_track_metadata(listen, track_metadata):
+    track_name = track_metadata.get('track_name', _MISSING)
+    if track_name is _MISSING:
+        raise APIBadRequest("JSON document does not contain required track_metadata.track_name.", listen)
+    if not isinstance(track_name, str):
+        raise APIBadRequest("track_metadata.track_name must be a single string.", listen)
+    track_name = track_metadata['track_name'] = track_name.strip()
+    if not track_name:
+        raise APIBadRequest("required field track_metadata.track_name is empty.", listen)
+
+    artist_name = track_metadata.get('artist_name', _MISSING)
+    if artist_name is _MISSING:
+        raise APIBadRequest("JSON document does not contain required track_metadata.artist_name.", listen)
+    if not isinstance(artist_name, str):
+        raise APIBadRequest("track_metadata.artist_name must be a single string.", listen)
+    artist_name = track_metadata['artist_name'] = artist_name.strip()
+    if not artist_name:
+        raise APIBadRequest("required field track_metadata.artist_name is empty.", listen)
+
+
+def _validate_additional_info(listen, additional_info):
+    tags = additional_info.get('tags', _MISSING)
+    if tags is not _MISSING:
+        if len(tags) > MAX_TAGS_PER_LISTEN:
+            raise APIBadRequest("JSON document may not contain more than %d items in "
+                                "track_metadata.additional_info.tags." % MAX_TAGS_PER_LISTEN, listen)
+        for tag in tags:
+            if len(tag) > MAX_TAG_SIZE:
+                raise APIBadRequest("JSON document may not contain track_metadata.additional_info.tags "
+                                    "longer than %d characters." % MAX_TAG_SIZE, listen)
+
+    for key in SINGLE_MBID_KEYS:
+        mbid = additional_info.get(key, _MISSING)
+        if mbid is _MISSING:
+            continue
+        if not mbid:
+            del additional_info[key]
+        elif not _is_valid_mbid(mbid):
+            log_raise_400("%s MBID format invalid." % (key, ), listen)
+
+    for key in MULTIPLE_MBID_KEYS:
+        mbids = additional_info.get(key, _MISSING)
+        if mbids is _MISSING:
+            continue
+        if not mbids:
+            del additional_info[key]
+            continue
+        mbids = [x for x in mbids if x]
+        for mbid in mbids:
+            if not _is_valid_mbid(mbid):
+                log_raise_400("%s MBID format invalid." % (key,), listen)
+        additional_info[key] = mbids
+
+
+def _is_valid_mbid(mbid):
+    if type(mbid) is str and CANONICAL_UUID_REGEX.match(mbid):
+        return True
+    return is_valid_uuid(mbid)
+
+
+_MISSING = object()
+_listen_validators = {
+    listen_type: compile_listen_validator(listen_type)
+    for listen_type in (LISTEN_TYPE_SINGLE, LISTEN_TYPE_IMPORT, LISTEN_TYPE_PLAYING_NOW)
+}
+
+
 # lifted from AcousticBrainz
 def is_valid_uuid(u):
     try:
@@ -207,18 +392,32 @@ def is_valid_uuid(u):
         return False
 
 
+def _add_user_to_listens(payload, user):
+    """ Returns copies of the listens in the payload with the id and name of the user added """
+    listens = []
+    for l in payload:
+        listen = l.copy()   # Create a local object to prevent the mutation of the passed object
+        listen['user_id'] = user['id']
+        listen['user_name'] = user['musicbrainz_id']
+        listens.append(listen)
+    return listens
+
+
 def _get_augmented_listens(payload, user, listen_type):
     """ Converts the payload to augmented list after lookup
         in the MessyBrainz database
     """
+    return get_augmented_listens(_add_user_to_listens(payload, user))
+
+
+def get_augmented_listens(listens):
+    """ Looks up the MessyBrainz ids of listens which already contain the user's
+        details, in batches of MAX_ITEMS_PER_MESSYBRAINZ_LOOKUP.
+    """
 
     augmented_listens = []
     msb_listens = []
-    for l in payload:
-        listen = l.copy()   # Create a local object to prevent the mutation of the passed object
-        listen['user_id'] = user['id']
-        listen['user_name'] = user['musicbrainz_id']
-
+    for listen in listens:
         msb_listens.append(listen)
         if len(msb_listens) >= MAX_ITEMS_PER_MESSYBRAINZ_LOOKUP:
             augmented_listens.extend(_messybrainz_lookup(msb_listens))
@@ -360,6 +559,42 @@ def validate_multiple_mbids_field(listen, key):
 
         listen['track_metadata']['additional_info'][key] = mbids  # set the filtered in the listen payload
 
+def read_ndjson_listens(stream):
+    """ Read listens from a stream of newline delimited JSON, one listen per line.
+
+    Lines are read one at a time, so only a single listen is held in memory.
+    Empty lines are skipped.
+
+    Args:
+        stream: a binary file-like object
+    Yields:
+        tuples of the line number and the decoded listen
+    Raises:
+        APIBadRequest if a line is too long or is not a valid JSON object
+    """
+    line_number = 0
+    while True:
+        # room for a listen of the maximum size and a \r\n line ending
+        line = stream.readline(MAX_LISTEN_SIZE + 2)
+        if not line:
+            return
+        line_number += 1
+
+        line = line.rstrip(b"\r\n")
+        if len(line) > MAX_LISTEN_SIZE:
+            raise APIBadRequest("Line %d: listens may not be larger than %d characters." % (line_number, MAX_LISTEN_SIZE))
+        if not line.strip():
+            continue
+
+        try:
+            listen = ujson.loads(line.decode("utf-8"))
+        except ValueError as e:
+            raise APIBadRequest("Line %d: cannot parse JSON document: %s" % (line_number, e))
+        if not isinstance(listen, dict):
+            raise APIBadRequest("Line %d: listen must be a JSON object." % line_number)
+        yield line_number, listen
+
+
 def is_valid_timestamp(ts):
     """ Returns True if the timestamp passed is in the API's
     allowed range of timestamps, False otherwise
@@ -373,7 +608,7 @@ def is_valid_timestamp(ts):
     return ts <= int(time.time()) + API_LISTENED_AT_ALLOWED_SKEW
 
 
-def publish_data_to_queue(data, exchange, queue, error_msg):
+def publish_data_to_queue(data, exchange, queue, error_msg, message_type=None):
     """ Publish specified data to the specified queue.
 
     Args:
@@ -381,18 +616,13 @@ def publish_data_to_queue(data, exchange, queue, error_msg):
         exchange (str): the name of the exchange
         queue (str): the name of the queue
         error_msg (str): the error message to be returned in case of an error
+        message_type (str): the AMQP type of the message, if any
     """
     try:
+        body, properties = listen_codec.encode(data, current_app.config.get('LISTEN_MESSAGE_CODEC', listen_codec.JSON_CODEC))
+        properties.type = message_type
         with rabbitmq_connection._rabbitmq.get() as connection:
-            channel = connection.channel
-            channel.exchange_declare(exchange=exchange, exchange_type='fanout')
-            channel.queue_declare(queue, durable=True)
-            channel.basic_publish(
-                exchange=exchange,
-                routing_key='',
-                body=ujson.dumps(data),
-                properties=pika.BasicProperties(delivery_mode=2, ),
-            )
+            connection.publish(exchange, queue, [body], properties)
     except pika.exceptions.ConnectionClosed as e:
         current_app.logger.error("Connection to rabbitmq closed while trying to publish: %s" % str(e), exc_info=True)
         raise APIServiceUnavailable(error_msg)
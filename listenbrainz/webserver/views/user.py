@@ -9,6 +9,8 @@ import ujson
 from flask import Blueprint, render_template, request, url_for, redirect, current_app, jsonify
 from flask_login import current_user, login_required
 from listenbrainz import webserver
+from listenbrainz.listenstore import ORDER_ASC, ORDER_DESC
+from listenbrainz.listenstore.listens_cursor import encode_listens_cursor, decode_listens_cursor
 from listenbrainz.db.playlist import get_playlists_for_user, get_playlists_created_for_user, get_playlists_collaborated_on
 from listenbrainz.webserver.decorators import web_listenstore_needed
 from listenbrainz.webserver import timescale_connection
@@ -79,12 +81,21 @@ def profile(user_name):
         except ValueError:
             raise BadRequest("Incorrect timestamp argument min_ts: %s" % request.args.get("min_ts"))
 
-    args = {}
-    if max_ts:
-        args['to_ts'] = max_ts
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            listened_at, track_name, order = decode_listens_cursor(cursor)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        data = db_conn.fetch_listens_after_cursor(user_name, listened_at, track_name, limit=LISTENS_PER_PAGE, order=order)
+        min_ts_per_user, max_ts_per_user = db_conn.get_timestamps_for_user(user_name)
     else:
-        args['from_ts'] = min_ts
-    data, min_ts_per_user, max_ts_per_user = db_conn.fetch_listens(user_name, limit=LISTENS_PER_PAGE, **args)
+        args = {}
+        if max_ts:
+            args['to_ts'] = max_ts
+        else:
+            args['from_ts'] = min_ts
+        data, min_ts_per_user, max_ts_per_user = db_conn.fetch_listens(user_name, limit=LISTENS_PER_PAGE, **args)
 
     listens = []
     for listen in data:
@@ -124,6 +135,8 @@ def profile(user_name):
         "listens": listens,
         "latest_listen_ts": max_ts_per_user,
         "oldest_listen_ts": min_ts_per_user,
+        "next_listens_cursor": encode_listens_cursor(data[-1], ORDER_DESC) if data else None,
+        "previous_listens_cursor": encode_listens_cursor(data[0], ORDER_ASC) if data else None,
         "latest_spotify_uri": _get_spotify_uri_for_listens(listens),
         "artist_count": format(artist_count, ",d") if artist_count else None,
         "profile_url": url_for('user.profile', user_name=user_name),
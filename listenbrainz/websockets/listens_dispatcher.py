@@ -3,6 +3,7 @@ import pika
 import time
 import threading
 
+from listenbrainz import listen_codec
 from listenbrainz.utils import get_fallback_connection_name
 
 from flask import current_app
@@ -25,12 +26,12 @@ class ListensDispatcher(threading.Thread):
             self.socketio.emit(event_name, json.dumps(listen), to=listen['user_name'])
 
     def callback_listen(self, channel, method, properties, body):
-        listens = json.loads(body)
+        listens = listen_codec.decode(body, properties)
         self.send_listens(listens, LISTEN_TYPE_IMPORT)
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
     def callback_playing_now(self, channel, method, properties, body):
-        listens = json.loads(body)
+        listens = listen_codec.decode(body, properties)
         self.send_listens(listens, LISTEN_TYPE_PLAYING_NOW)
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
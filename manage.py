@@ -3,7 +3,10 @@ from datetime import datetime
 import listenbrainz.db.dump_manager as dump_manager
 import listenbrainz.spark.request_manage as spark_request_manage
 from listenbrainz.listenstore.timescale_utils import recalculate_all_user_data as ts_recalculate_all_user_data, \
-                                                     refresh_listen_count_aggregate as ts_refresh_listen_count_aggregate
+                                                     refresh_listen_count_aggregate as ts_refresh_listen_count_aggregate, \
+                                                     benchmark_user_queries as ts_benchmark_user_queries, \
+                                                     rebuild_listen_user_metadata as ts_rebuild_listen_user_metadata, \
+                                                     backfill_recording_msids as ts_backfill_recording_msids
 from listenbrainz import db
 from listenbrainz.db import timescale as ts
 from listenbrainz import webserver
@@ -284,6 +287,35 @@ def refresh_continuous_aggregates():
     ts_refresh_listen_count_aggregate()
 
 
+@cli.command(name="rebuild_listen_counts")
+def rebuild_listen_counts():
+    """
+        Rebuild the listen counts and timestamps of all users in timescale and drop the cached ones
+        which were wrong.
+    """
+    ts_rebuild_listen_user_metadata()
+
+
+@cli.command(name="backfill_recording_msids")
+def backfill_recording_msids():
+    """
+        Fill in the recording_msid column of the listens inserted before it was added, one chunk
+        of the listen table at a time.
+    """
+    ts_backfill_recording_msids()
+
+
+@cli.command(name="benchmark_user_queries")
+@click.option("--users", "-u", default=100, show_default=True, help="The number of users to sample.")
+@click.option("--runs", "-r", default=3, show_default=True, help="The number of runs of each query for each user.")
+def benchmark_user_queries(users, runs):
+    """
+        Measure the latency of the listen queries of single users against the number of
+        chunks their listens are spread over.
+    """
+    ts_benchmark_user_queries(users, runs)
+
+
 # Add other commands here
 cli.add_command(spark_request_manage.cli, name="spark")
 cli.add_command(dump_manager.cli, name="dump")
@@ -86,9 +86,5 @@ def insert_all_in_transaction(recordings):
         A list of dicts containing the recording data for each inserted recording
     """
 
-    ret = []
     with db.engine.begin() as connection:
-        for recording in recordings:
-            result = insert_single(connection, recording)
-            ret.append(result)
-    return ret
+        return data.submit_recordings(connection, recordings)
@@ -182,6 +182,229 @@ def submit_recording(connection, data):
     return gid
 
 
+def get_artist_credits(connection, artist_credits):
+    """ Returns the MessyBrainz artist IDs for all the specified artist credits
+
+    Args:
+        connection: the sqlalchemy db connection to be used to execute queries
+        artist_credits (iterable): the names of the artists
+
+    Returns:
+        dict: a map of artist name to Artist MessyBrainz ID for all the artists that exist
+    """
+    if not artist_credits:
+        return {}
+
+    query = text("""SELECT a.name
+                         , a.gid
+                      FROM artist_credit a
+                     WHERE a.name IN :names""")
+    result = connection.execute(query, {"names": tuple(artist_credits)})
+    return {row["name"]: str(row["gid"]) for row in result.fetchall()}
+
+
+def get_releases(connection, releases):
+    """ Returns the MessyBrainz release IDs for all the specified release titles
+
+    Args:
+        connection: the sqlalchemy db connection to be used to execute queries
+        releases (iterable): the titles of the releases
+
+    Returns:
+        dict: a map of release title to Release MessyBrainz ID for all the releases that exist
+    """
+    if not releases:
+        return {}
+
+    query = text("""SELECT r.title
+                         , r.gid
+                      FROM release r
+                     WHERE r.title IN :titles""")
+    result = connection.execute(query, {"titles": tuple(releases)})
+    return {row["title"]: str(row["gid"]) for row in result.fetchall()}
+
+
+def add_artist_credits(connection, artist_credits):
+    """ Insert new artists into the MessyBrainz database using a single query
+
+    Args:
+        connection: the sqlalchemy db connection to be used to execute queries
+        artist_credits (list): the names of the artists
+
+    Returns:
+        dict: a map of artist name to the new Artist MessyBrainz ID
+    """
+    if not artist_credits:
+        return {}
+
+    gids = {name: str(uuid.uuid4()) for name in artist_credits}
+    query = text("""INSERT INTO artist_credit (gid, name, submitted)
+                         SELECT gid, name, now()
+                           FROM unnest(CAST(:gids AS UUID[]), CAST(:names AS TEXT[])) AS t(gid, name)""")
+    connection.execute(query, {"gids": list(gids.values()), "names": list(gids.keys())})
+    return gids
+
+
+def add_releases(connection, releases):
+    """ Insert new releases into the MessyBrainz database using a single query
+
+    Args:
+        connection: the sqlalchemy db connection to be used to execute queries
+        releases (list): the titles of the releases
+
+    Returns:
+        dict: a map of release title to the new Release MessyBrainz ID
+    """
+    if not releases:
+        return {}
+
+    gids = {title: str(uuid.uuid4()) for title in releases}
+    query = text("""INSERT INTO release (gid, title, submitted)
+                         SELECT gid, title, now()
+                           FROM unnest(CAST(:gids AS UUID[]), CAST(:titles AS TEXT[])) AS t(gid, title)""")
+    connection.execute(query, {"gids": list(gids.values()), "titles": list(gids.keys())})
+    return gids
+
+
+def load_recordings_from_data_sha256(connection, data_sha256s):
+    """ Return data for all recordings whose data_sha256 is one of the specified hashes.
+
+    Args:
+        connection: sqlalchemy connection to execute db queries with
+        data_sha256s (iterable): the data_sha256 hashes of the recordings
+
+    Returns:
+        dict: a map of data_sha256 to recording data, in the same format as
+            returned by load_recording_from_msid, for the recordings that exist
+    """
+    if not data_sha256s:
+        return {}
+
+    query = text("""SELECT rj.data_sha256
+                         , rj.data
+                         , r.artist
+                         , r.release
+                         , r.gid
+                      FROM recording_json AS rj
+                      JOIN recording AS r
+                        ON rj.id = r.data
+                     WHERE rj.data_sha256 IN :data_sha256s""")
+    result = connection.execute(query, {"data_sha256s": tuple(data_sha256s)})
+    return {row["data_sha256"]: _format_recording(row["data"], row["artist"], row["release"], row["gid"])
+            for row in result.fetchall()}
+
+
+def submit_recordings(connection, recordings):
+    """ Looks up a batch of recordings in MessyBrainz and submits the ones which do not exist yet.
+
+    In contrast to calling get_id_from_recording and submit_recording for every recording,
+    this issues a constant number of queries regardless of the number of recordings: one to
+    resolve all the existing recordings and, if some are missing, a couple more to bulk insert
+    the missing artist credits, releases, recording_json and recording rows.
+
+    Args:
+        connection: the sqlalchemy db connection to execute queries with
+        recordings (list): the recording data dicts
+
+    Returns:
+        A list of dicts containing the recording data for each recording, in the same order as
+        recordings and in the same format as returned by load_recording_from_msid
+    """
+    hashed = []
+    for recording in recordings:
+        data_json, sha256_json = convert_to_messybrainz_json(recording)
+        hashed.append((sha256(sha256_json.encode("utf-8")).hexdigest(), data_json, recording))
+
+    loaded = load_recordings_from_data_sha256(connection, {data_sha256 for data_sha256, _, _ in hashed})
+
+    # recordings which only differ in case have the same hash, only submit the first of those
+    missing = {}
+    for data_sha256, data_json, recording in hashed:
+        if data_sha256 not in loaded and data_sha256 not in missing:
+            missing[data_sha256] = (data_json, recording)
+
+    if missing:
+        loaded.update(_insert_recordings(connection, missing))
+
+    return [loaded[data_sha256] for data_sha256, _, _ in hashed]
+
+
+def _insert_recordings(connection, missing):
+    """ Bulk inserts recordings which do not exist in MessyBrainz yet.
+
+    Args:
+        connection: the sqlalchemy db connection to execute queries with
+        missing (dict): a map of data_sha256 to a tuple of (data_json, recording data)
+
+    Returns:
+        dict: a map of data_sha256 to recording data of the newly inserted recordings
+    """
+    artist_names = {recording["artist"] for _, recording in missing.values()}
+    artists = get_artist_credits(connection, artist_names)
+    artists.update(add_artist_credits(connection, [name for name in artist_names if name not in artists]))
+
+    release_titles = {recording["release"] for _, recording in missing.values() if "release" in recording}
+    releases = get_releases(connection, release_titles)
+    releases.update(add_releases(connection, [title for title in release_titles if title not in releases]))
+
+    data_sha256s, data_jsons, meta_sha256s = [], [], []
+    for data_sha256, (data_json, recording) in missing.items():
+        meta = {"artist": recording["artist"], "title": recording["title"]}
+        _, meta_sha256_json = convert_to_messybrainz_json(meta)
+        data_sha256s.append(data_sha256)
+        data_jsons.append(data_json)
+        meta_sha256s.append(sha256(meta_sha256_json.encode("utf-8")).hexdigest())
+
+    query = text("""INSERT INTO recording_json (data, data_sha256, meta_sha256)
+                         SELECT data, data_sha256, meta_sha256
+                           FROM unnest(CAST(:data AS JSONB[]), CAST(:data_sha256 AS TEXT[]), CAST(:meta_sha256 AS TEXT[]))
+                             AS t(data, data_sha256, meta_sha256)
+                      RETURNING id, data_sha256""")
+    result = connection.execute(query, {
+        "data": data_jsons,
+        "data_sha256": data_sha256s,
+        "meta_sha256": meta_sha256s,
+    })
+    data_ids = {row["data_sha256"]: row["id"] for row in result.fetchall()}
+
+    inserted = {}
+    gids, ids, artist_gids, release_gids = [], [], [], []
+    for data_sha256, (_, recording) in missing.items():
+        gid = str(uuid.uuid4())
+        artist = artists[recording["artist"]]
+        release = releases[recording["release"]] if "release" in recording else None
+        gids.append(gid)
+        ids.append(data_ids[data_sha256])
+        artist_gids.append(artist)
+        release_gids.append(release)
+        inserted[data_sha256] = _format_recording(recording, artist, release, gid)
+
+    query = text("""INSERT INTO recording (gid, data, artist, release, submitted)
+                         SELECT gid, data, artist, release, now()
+                           FROM unnest(CAST(:gids AS UUID[]), CAST(:ids AS INTEGER[]), CAST(:artists AS UUID[]), CAST(:releases AS UUID[]))
+                             AS t(gid, data, artist, release)""")
+    connection.execute(query, {
+        "gids": gids,
+        "ids": ids,
+        "artists": artist_gids,
+        "releases": release_gids,
+    })
+
+    return inserted
+
+
+def _format_recording(data, artist, release, gid):
+    """ Builds the recording data dict returned by the load_recording* functions. """
+    result = {}
+    result["payload"] = data
+    result["ids"] = {"artist_mbids": [], "release_mbid": ""}
+    result["ids"]["recording_mbid"] = str(data["recording_mbid"]) if "recording_mbid" in data else ''
+    result["ids"]["artist_msid"] = str(artist)
+    result["ids"]["release_msid"] = str(release) if release else None
+    result["ids"]["recording_msid"] = str(gid)
+    return result
+
+
 def load_recording_from_msid(connection, messybrainz_id):
     """ Return data for a recording with specified MessyBrainz ID.
 
@@ -206,14 +429,7 @@ def load_recording_from_msid(connection, messybrainz_id):
     row = result.fetchone()
     if not row:
         raise exceptions.NoDataFoundException
-    result = {}
-    result["payload"] = row["data"]
-    result["ids"] = {"artist_mbids": [], "release_mbid": ""}
-    result["ids"]["recording_mbid"] = str(row["data"]["recording_mbid"]) if "recording_mbid" in row["data"] else ''
-    result["ids"]["artist_msid"] = str(row["artist"])
-    result["ids"]["release_msid"] = str(row["release"]) if row["release"] else None
-    result["ids"]["recording_msid"] = str(row["gid"])
-    return result
+    return _format_recording(row["data"], row["artist"], row["release"], row["gid"])
 
 
 def load_recording_from_mbid(connection, musicbrainz_id):
@@ -286,3 +502,15 @@ def convert_to_messybrainz_json(data):
     """
     serialized = json.dumps(data, sort_keys=True, separators=(',', ':'))
     return serialized, serialized.lower()
+
+
+def get_data_sha256(data):
+    """ Returns the data_sha256 hash with which MessyBrainz identifies the specified recording data.
+
+    Args:
+        data (dict): the recording data
+    Returns:
+        str: the sha256 hex digest of the lowercased MessyBrainz JSON of the data
+    """
+    _, sha256_json = convert_to_messybrainz_json(data)
+    return sha256(sha256_json.encode("utf-8")).hexdigest()
@@ -112,3 +112,26 @@ class DataTestCase(DatabaseTestCase):
         self.assertEqual(result['title'], recording['title'].lower())
         self.assertEqual(result['additional_info']['key1'], recording['additional_info']['key1'].lower())
         self.assertDictEqual(json.loads(sorted_keys), recording)
+
+    def test_submit_recordings(self):
+        """ Tests that a batch of recordings is submitted, with existing ones and duplicates
+        within the batch resolved to the same MessyBrainz ID.
+        """
+        other_recording = {
+            'artist': 'Frank Ocean',
+            'title': 'Nikes',
+        }
+        with db.engine.connect() as connection:
+            existing_msid = data.submit_recording(connection, recording)
+            result = data.submit_recordings(connection, [recording_diff_case, other_recording, other_recording])
+            self.assertEqual(len(result), 3)
+            self.assertEqual(result[0]['ids']['recording_msid'], existing_msid)
+            self.assertDictEqual(result[0]['payload'], recording)
+            self.assertEqual(result[1]['ids']['recording_msid'], result[2]['ids']['recording_msid'])
+            self.assertEqual(result[1]['ids']['recording_msid'],
+                             str(data.get_id_from_recording(connection, other_recording)))
+            self.assertIsNone(result[1]['ids']['release_msid'])
+
+            # the artist credit already exists and must be reused
+            self.assertEqual(result[0]['ids']['artist_msid'], result[1]['ids']['artist_msid'])
+            self.assertDictEqual(result[1], data.load_recording_from_msid(connection, result[1]['ids']['recording_msid']))